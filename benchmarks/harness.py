@@ -0,0 +1,89 @@
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from importlib.metadata import PackageNotFoundError, version
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+
+def measure(name, run, setup=None, iterations=200, warmup=5, **extra):
+    """
+    Time ``run(state)`` where ``state`` is a fresh ``setup()`` per iteration.
+
+    Setup isn't timed. Queries are counted on one extra run, kept apart from the
+    timed runs because capturing them slows every query down.
+    """
+    setup = setup or (lambda: None)
+
+    for _ in range(warmup):
+        run(setup())
+
+    state = setup()
+    with CaptureQueriesContext(connection) as queries:
+        run(state)
+    session = getattr(state, "session", None)
+
+    timings = []
+    for _ in range(iterations):
+        state = setup()
+        start = time.perf_counter_ns()
+        run(state)
+        timings.append(time.perf_counter_ns() - start)
+
+    timings.sort()
+    result = dict(
+        name=name,
+        iterations=iterations,
+        queries=len(queries),
+        mean_us=round(statistics.fmean(timings) / 1000, 2),
+        median_us=round(statistics.median(timings) / 1000, 2),
+        min_us=round(timings[0] / 1000, 2),
+        p95_us=round(timings[int(len(timings) * 0.95) - 1] / 1000, 2),
+        **extra,
+    )
+    if session is not None:
+        result["session_modified"] = session.modified
+    return result
+
+
+def _version(package):
+    try:
+        return version(package)
+    except PackageNotFoundError:
+        return None
+
+
+def _commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    import sqlite3
+
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "commit": _commit(),
+        "python": sys.version.split()[0],
+        "implementation": platform.python_implementation(),
+        "platform": platform.platform(),
+        "django": _version("django"),
+        "fido2": _version("fido2"),
+        "pyotp": _version("pyotp"),
+        "sqlite": sqlite3.sqlite_version,
+    }
+
+
+def table(results):
+    lines = [f"{'benchmark':<40} {'median us':>12} {'p95 us':>12} {'queries':>8}"]
+    for r in results:
+        lines.append(f"{r['name']:<40} {r['median_us']:>12.2f} {r['p95_us']:>12.2f} {r['queries']:>8}")
+    return "\n".join(lines)
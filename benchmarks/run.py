@@ -0,0 +1,296 @@
+"""
+Benchmark the authentication hot paths against the testsite.
+
+    PYTHONPATH=. python -m benchmarks.run [--iterations N] [--filter NAME] [--output results.json]
+
+Writes JSON to ``--output`` (or stdout) and a summary table to stderr.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "benchmarks.settings")
+
+import django  # noqa: E402
+
+django.setup()
+
+import pyotp  # noqa: E402
+from cryptography.hazmat.primitives import hashes  # noqa: E402
+from cryptography.hazmat.primitives.asymmetric import ec  # noqa: E402
+from django.conf import settings  # noqa: E402
+from django.contrib.auth import get_user_model  # noqa: E402
+from django.contrib.auth.models import AnonymousUser  # noqa: E402
+from django.contrib.messages.storage.fallback import FallbackStorage  # noqa: E402
+from django.contrib.sessions.backends.db import SessionStore  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.http import HttpResponse  # noqa: E402
+from django.test import RequestFactory, override_settings  # noqa: E402
+from fido2.cose import ES256  # noqa: E402
+from fido2.utils import sha256, websafe_encode  # noqa: E402
+from fido2.webauthn import (  # noqa: E402
+    AttestedCredentialData,
+    AuthenticatorData,
+    CollectedClientData,
+)
+
+from multifactor import views  # noqa: E402
+from multifactor.common import next_check  # noqa: E402
+from multifactor.decorators import multifactor_protected  # noqa: E402
+from multifactor.factors import fido2, totp  # noqa: E402
+from multifactor.models import KeyTypes, UserKey  # noqa: E402
+from multifactor.session import Factor, set_factors  # noqa: E402
+
+from .harness import environment, measure, table  # noqa: E402
+
+HOST = "localhost"
+ORIGIN = f"https://{HOST}"
+
+factory = RequestFactory()
+# signature counters only go up, or the assertion is rejected
+counter = itertools.count(1)
+
+
+def make_user(username, totp_keys=0, fido2_keys=0):
+    """A user with this many keys. Returns the user, TOTP secrets and FIDO2 private keys, oldest first."""
+    user = get_user_model().objects.create_user(username=username, password="password")
+    secrets, private_keys = [], []
+
+    for _ in range(totp_keys):
+        secret = pyotp.random_base32()
+        UserKey.objects.create(user=user, key_type=KeyTypes.TOTP, properties={"secret_key": secret})
+        secrets.append(secret)
+
+    for i in range(fido2_keys):
+        private_key = ec.generate_private_key(ec.SECP256R1())
+        credential = AttestedCredentialData.create(
+            b"\0" * 16,
+            f"{username}-{i}".encode().ljust(32, b"\0"),
+            ES256.from_cryptography_key(private_key.public_key()),
+        )
+        UserKey.objects.create(
+            user=user,
+            key_type=KeyTypes.FIDO2,
+            properties={"device": websafe_encode(credential), "type": "public-key", "domain": HOST},
+            domain=HOST,
+            credential_id=fido2.encode_credential_id(credential.credential_id),
+        )
+        private_keys.append((credential, private_key))
+
+    return user, secrets, private_keys
+
+
+def request(user, method="get", path="/", authenticated=(), **kwargs):
+    """A request for this user, verified with ``authenticated`` keys, with an unsaved session and messages."""
+    req = getattr(factory, method)(path, HTTP_HOST=HOST, **kwargs)
+    req.user = user
+    req.session = SessionStore()
+    if authenticated:
+        set_factors(req.session, [Factor(k.key_type, k.id, 0, next_check()) for k in authenticated])
+    req.session.modified = False
+    req._messages = FallbackStorage(req)
+    return req
+
+
+def assertion(state, credential, private_key, flags=AuthenticatorData.FLAG.UP):
+    """What a browser posts back after signing the challenge in ``state`` with this credential."""
+    client_data = CollectedClientData.create(type="webauthn.get", challenge=state["challenge"], origin=ORIGIN)
+    auth_data = AuthenticatorData.create(sha256(HOST.encode()), flags, next(counter))
+    signature = private_key.sign(auth_data + client_data.hash, ec.ECDSA(hashes.SHA256()))
+    raw_id = websafe_encode(credential.credential_id)
+    return {
+        "id": raw_id,
+        "rawId": raw_id,
+        "type": "public-key",
+        "response": {
+            "clientDataJSON": websafe_encode(client_data),
+            "authenticatorData": websafe_encode(auth_data),
+            "signature": websafe_encode(signature),
+        },
+    }
+
+
+def decorator_benchmarks():
+    view = multifactor_protected(factors=1)(lambda request: HttpResponse())
+
+    no_keys, _, _ = make_user("decorator-no-keys")
+    with_keys, _, _ = make_user("decorator-keys", totp_keys=2)
+    key = with_keys.multifactor_keys.first()
+
+    yield ("decorator.no_keys", view, lambda: request(no_keys))
+    yield ("decorator.not_authenticated", view, lambda: request(with_keys))
+    yield ("decorator.authenticated", view, lambda: request(with_keys, authenticated=[key]))
+
+
+def totp_benchmarks():
+    for count in (1, 5, 20):
+        user, secrets, _ = make_user(f"totp-{count}", totp_keys=count)
+
+        def setup(user=user, secret=secrets[-1]):
+            # let the same code be accepted again
+            UserKey.objects.filter(user=user).update(last_step=None)
+            req = request(user, "post")
+            view = totp.Auth()
+            view.setup(req)
+            req.view, req.token = view, pyotp.TOTP(secret).now()
+            return req
+
+        # the newest key matches, so every key is tried
+        yield (f"totp.verify_login.{count}_keys", lambda r: r.view.verify_login(r.token), setup)
+
+    def setup_miss():
+        req = setup()
+        req.token = "000000"
+        return req
+
+    yield ("totp.verify_login.20_keys_no_match", lambda r: r.view.verify_login(r.token), setup_miss)
+
+    # the generator is suspended here while it's measured
+    with override_settings(MULTIFACTOR={"TOTP_SECRET_CACHE_SIZE": 100}):
+        yield ("totp.verify_login.20_keys_cached", lambda r: r.view.verify_login(r.token), setup)
+
+
+def totp_verifier_benchmarks():
+    """``match_token`` against the per-key pyotp loop it replaced, without the database."""
+
+    def pyotp_loop(secrets, token):
+        for index, secret in enumerate(secrets):
+            if pyotp.TOTP(secret).verify(token, valid_window=60):
+                return index
+
+    for count in (1, 5, 20):
+        secrets = [pyotp.random_base32() for _ in range(count)]
+        hit = lambda secret=secrets[-1]: pyotp.TOTP(secret).now()  # noqa: E731
+        miss = lambda: "000000"  # noqa: E731
+
+        for outcome, token in [("match", hit), ("no_match", miss)]:
+            yield (f"totp.pyotp_loop.{count}_keys_{outcome}", lambda t, s=secrets: pyotp_loop(s, t), token)
+            yield (f"totp.match_token.{count}_keys_{outcome}", lambda t, s=secrets: totp.match_token(s, t), token)
+
+    # a phone 20 minutes slow, with and without its drift on record
+    secrets = [pyotp.random_base32() for _ in range(5)]
+    slow = lambda: pyotp.TOTP(secrets[-1]).at(time.time() - 40 * totp.INTERVAL)  # noqa: E731
+    drifts = [0, 0, 0, 0, -40]
+    yield ("totp.match_token.5_keys_drift_unknown", lambda t: totp.match_token(secrets, t), slow)
+    yield ("totp.match_token.5_keys_drift_known", lambda t: totp.match_token(secrets, t, drifts), slow)
+
+
+def fido2_benchmarks():
+    view = fido2.Authenticate.as_view()
+
+    for count in (1, 10, 50):
+        user, _, private_keys = make_user(f"fido2-{count}", fido2_keys=count)
+        server = fido2.FidoClass().server
+
+        def setup(user=user, credential=private_keys[-1]):
+            options, state = server.authenticate_begin(user_verification="discouraged")
+            req = request(
+                user,
+                "post",
+                data=json.dumps(assertion(state, *credential)),
+                content_type="application/json",
+            )
+            req.session["fido_state"] = state
+            req.session.modified = False
+            return req
+
+        yield (f"fido2.authenticate_post.{count}_keys", view, setup)
+
+    def setup_cached_state(user=user, credential=private_keys[-1]):
+        options, state = server.authenticate_begin(user_verification="discouraged")
+        ceremony = fido2.save_state(SimpleNamespace(user=user), state)
+        return request(
+            user,
+            "post",
+            data=json.dumps({**assertion(state, *credential), **ceremony}),
+            content_type="application/json",
+        )
+
+    # the ceremony's state in the cache, not the session
+    with override_settings(MULTIFACTOR={**settings.MULTIFACTOR, "FIDO_STATE_STORE": "cache"}):
+        yield ("fido2.authenticate_post.cache_state", view, setup_cached_state)
+
+    # one assertion instead of a password check and then a second factor
+    with override_settings(MULTIFACTOR={"FIDO_SERVER_ID": HOST, "PASSKEY_LOGIN": True}):
+        view = fido2.Login.as_view()
+        user, _, private_keys = make_user("passkey", fido2_keys=1)
+        server = fido2.FidoClass().server
+
+        def setup_passkey():
+            options, state = server.authenticate_begin(user_verification="required")
+            flags = AuthenticatorData.FLAG.UP | AuthenticatorData.FLAG.UV
+            req = request(
+                AnonymousUser(),
+                "post",
+                data=json.dumps(assertion(state, *private_keys[0], flags=flags)),
+                content_type="application/json",
+            )
+            req.session["fido_state"] = state
+            req.session.modified = False
+            # a RequestFactory request has no CSRF token, the test client skips the check the same way
+            req._dont_enforce_csrf_checks = True
+            return req
+
+        def passkey_login(req):
+            response = view(req)
+            if response.status_code != 200 or json.loads(response.content)["status"] != "OK":
+                raise RuntimeError(f"Passkey login failed: {response.status_code} {response.content[:200]!r}")
+
+        yield ("fido2.passkey_login", passkey_login, setup_passkey)
+
+
+def view_benchmarks():
+    user, _, _ = make_user("views", totp_keys=3, fido2_keys=2)
+    keys = list(user.multifactor_keys.all())
+
+    def render(view):
+        return lambda req: view(req).render()
+
+    yield (
+        "views.list",
+        render(views.List.as_view()),
+        lambda: request(user, path="/admin/multifactor/", authenticated=keys[:1]),
+    )
+    yield (
+        "views.authenticate",
+        render(views.Authenticate.as_view()),
+        lambda: request(user, path="/admin/multifactor/authenticate/"),
+    )
+
+
+# each yields (name, run, setup), see harness.measure
+GROUPS = [decorator_benchmarks, totp_benchmarks, totp_verifier_benchmarks, fido2_benchmarks, view_benchmarks]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200)
+    parser.add_argument("--filter", default="", help="Only report benchmarks whose name contains this.")
+    parser.add_argument("--output", help="Write JSON here instead of stdout.")
+    args = parser.parse_args(argv)
+
+    call_command("migrate", verbosity=0)
+
+    results = [
+        measure(name, run, setup, args.iterations)
+        for group in GROUPS
+        for name, run, setup in group()
+        if args.filter in name
+    ]
+
+    report = json.dumps({"environment": environment(), "results": results}, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
+    print(table(results), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
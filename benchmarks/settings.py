@@ -0,0 +1,33 @@
+"""
+Settings for the benchmarks: the testsite, minus the development tooling, on an
+in-memory SQLite database and a local-memory cache.
+"""
+
+from testsite.testsite.settings import *  # noqa: F401,F403
+
+DEBUG = False
+
+INSTALLED_APPS = [app for app in INSTALLED_APPS if app not in ("debug_toolbar", "django_extensions")]  # noqa: F405
+MIDDLEWARE = [m for m in MIDDLEWARE if not m.startswith("debug_toolbar.")]  # noqa: F405
+ROOT_URLCONF = "benchmarks.urls"
+
+DATABASES = {
+    "default": {
+        "ENGINE": "django.db.backends.sqlite3",
+        "NAME": ":memory:",
+    }
+}
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    }
+}
+
+PASSWORD_HASHERS = ["django.contrib.auth.hashers.MD5PasswordHasher"]
+
+MULTIFACTOR = {
+    **MULTIFACTOR,  # noqa: F405
+    "FIDO_SERVER_ID": "localhost",
+    "FALLBACKS": {},
+}
@@ -1,7 +1,8 @@
 from django.contrib import admin
-from django.db.models import Exists, OuterRef
+from django.db.models import BooleanField, Case, Exists, OuterRef, Value, When
 from django.utils.translation import gettext_lazy as _
 
+from .app_settings import mf_settings
 from .models import UserKey
 
 
@@ -22,8 +23,8 @@ class HasMultifactorFilter(admin.SimpleListFilter):
 
 class MultiFactorInline(admin.TabularInline):
     model = UserKey
-    readonly_fields = ("key_type",)
-    fields = ("key_type", "enabled")
+    readonly_fields = ("key_type", "device", "certification")
+    fields = ("key_type", "device", "certification", "enabled")
     max_num = 0
 
 
@@ -33,8 +34,19 @@ class MultifactorUserAdmin(admin.ModelAdmin):
     multifactor_inline = True
 
     def get_queryset(self, request):
-        keys = UserKey.objects.filter(user=OuterRef("pk"), enabled=True)
-        return super().get_queryset(request).annotate(has_multifactors=Exists(keys))
+        if mf_settings["STATUS_TABLE"]:
+            has_multifactors = Case(
+                When(
+                    multifactor_status__isnull=True,
+                    then=Exists(UserKey.objects.filter(user=OuterRef("pk"), enabled=True)),
+                ),
+                When(multifactor_status__enabled_count__gt=0, then=Value(True)),
+                default=Value(False),
+                output_field=BooleanField(),
+            )
+        else:
+            has_multifactors = Exists(UserKey.objects.filter(user=OuterRef("pk"), enabled=True))
+        return super().get_queryset(request).annotate(has_multifactors=has_multifactors)
 
     def get_list_display(self, request):
         if not self.multifactor_list_display:
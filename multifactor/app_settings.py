@@ -1,31 +1,116 @@
+from collections.abc import Mapping
+
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.signals import setting_changed
+from django.utils.module_loading import import_string
 from django.utils.translation import gettext_lazy as _
 
-mf_settings = getattr(settings, "MULTIFACTOR", {})
+DEFAULTS = {
+    "LOGIN_MESSAGE": _('You are now multifactor-authenticated. <a href="{}">Multifactor settings</a>.'),
+    "SHOW_LOGIN_MESSAGE": True,
+    "LOGIN_CALLBACK": False,
+    "RECHECK": True,
+    "RECHECK_MIN": 60 * 60 * 3,
+    "RECHECK_MAX": 60 * 60 * 6,
+    "FIDO_SERVER_ID": "example.com",
+    "FIDO_SERVER_NAME": "Django App",
+    "FIDO_SERVER_ICON": None,
+    "FIDO_SERVERS": {},
+    "FIDO2_CREDENTIAL_CACHE_SIZE": 1000,
+    "FIDO_METADATA_INDEX": None,
+    "FIDO_STATE_STORE": "session",
+    "FIDO_STATE_TIMEOUT": 5 * 60,
+    "PASSKEY_LOGIN": False,
+    "PASSKEY_BACKEND": None,
+    "TOKEN_ISSUER_NAME": "Django App",
+    "TOTP_WINDOW": 60,
+    "TOTP_SECRET_CACHE_SIZE": 0,
+    "TOTP_QR": None,
+    "FACTORS": ["FIDO2", "TOTP"],
+    "FALLBACKS": {
+        "email": (lambda user: user.email, "multifactor.factors.fallback.send_email"),
+    },
+    "HTML_EMAIL": True,
+    "BYPASS": None,
+    "CACHE": None,
+    "CACHE_TIMEOUT": 60 * 60,
+    "RULES": [],
+    "COMPACT_SESSION": False,
+    "STATUS_TABLE": False,
+    "THROTTLE": {},
+    "THROTTLE_MAX_LOCKOUT": 60 * 60,
+}
 
-mf_settings["LOGIN_MESSAGE"] = mf_settings.get(
-    "LOGIN_MESSAGE", _('You are now multifactor-authenticated. <a href="{}">Multifactor settings</a>.')
-)
-mf_settings["SHOW_LOGIN_MESSAGE"] = mf_settings.get("SHOW_LOGIN_MESSAGE", True)
-mf_settings["LOGIN_CALLBACK"] = mf_settings.get("LOGIN_CALLBACK", False)
-mf_settings["RECHECK"] = mf_settings.get("RECHECK", True)
-mf_settings["RECHECK_MIN"] = mf_settings.get("RECHECK_MIN", 60 * 60 * 3)
-mf_settings["RECHECK_MAX"] = mf_settings.get("RECHECK_MAX", 60 * 60 * 6)
 
-mf_settings["FIDO_SERVER_ID"] = mf_settings.get("FIDO_SERVER_ID", "example.com")
-mf_settings["FIDO_SERVER_NAME"] = mf_settings.get("FIDO_SERVER_NAME", "Django App")
-mf_settings["FIDO_SERVER_ICON"] = mf_settings.get("FIDO_SERVER_ICON", None)
-mf_settings["TOKEN_ISSUER_NAME"] = mf_settings.get("TOKEN_ISSUER_NAME", "Django App")
+def _unresolved(setting, path, error):
+    def fail(*args, **kwargs):
+        raise ImproperlyConfigured(f'MULTIFACTOR["{setting}"]: could not import {path!r}: {error}')
 
-mf_settings["FACTORS"] = mf_settings.get("FACTORS", ["FIDO2", "TOTP"])
+    return fail
 
-mf_settings["FALLBACKS"] = mf_settings.get(
-    "FALLBACKS",
-    {
-        "email": (lambda user: user.email, "multifactor.factors.fallback.send_email"),
-    },
-)
 
-mf_settings["HTML_EMAIL"] = mf_settings.get("HTML_EMAIL", True)
+class MultifactorSettings(Mapping):
+    """
+    The ``MULTIFACTOR`` setting merged over ``DEFAULTS``, read-only.
+
+    Dotted paths are imported once, when the settings are (re)loaded, and
+    exposed as ready-to-call attributes: ``bypass``, ``login_callback`` and
+    ``fallbacks``. Anything that couldn't be imported is listed in ``errors``
+    and reported by the system checks.
+    """
+
+    def __init__(self):
+        self._settings = None
+
+    def load(self):
+        self._settings = {**DEFAULTS, **getattr(settings, "MULTIFACTOR", {})}
+        self.errors = []
+        self.bypass = self._resolve("BYPASS", self._settings["BYPASS"])
+        self.login_callback = self._resolve("LOGIN_CALLBACK", self._settings["LOGIN_CALLBACK"])
+        self.fallbacks = {
+            name: (field, self._resolve(f"FALLBACKS.{name}", method))
+            for name, (field, method) in self._settings["FALLBACKS"].items()
+        }
+
+    def _resolve(self, setting, path):
+        if not path or callable(path):
+            return path or None
+        try:
+            return import_string(path)
+        except ImportError as e:
+            self.errors.append((setting, path, e))
+            return _unresolved(setting, path, e)
+
+    def __getattr__(self, name):
+        # resolved attributes don't exist until the first load
+        if name.startswith("_") or self._settings is not None:
+            raise AttributeError(name)
+        self.load()
+        return getattr(self, name)
+
+    def __getitem__(self, key):
+        if self._settings is None:
+            self.load()
+        return self._settings[key]
+
+    def __iter__(self):
+        if self._settings is None:
+            self.load()
+        return iter(self._settings)
+
+    def __len__(self):
+        if self._settings is None:
+            self.load()
+        return len(self._settings)
+
+
+mf_settings = MultifactorSettings()
+
+
+def reload_settings(*, setting, **kwargs):
+    if setting == "MULTIFACTOR":
+        mf_settings.load()
+
 
-mf_settings["BYPASS"] = mf_settings.get("BYPASS", None)
+setting_changed.connect(reload_settings, dispatch_uid="multifactor.app_settings.reload_settings")
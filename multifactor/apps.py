@@ -7,3 +7,9 @@ class MultifactorConfig(AppConfig):
     name = "multifactor"
     verbose_name = _("Multifactor")
     default_auto_field = "django.db.models.AutoField"
+
+    def ready(self):
+        from . import checks, signals  # noqa: F401
+        from .app_settings import mf_settings
+
+        mf_settings.load()
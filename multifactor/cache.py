@@ -0,0 +1,223 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models import QuerySet
+
+from .app_settings import mf_settings
+
+# bump when the shape of cached values changes so old entries are ignored
+VERSION = 1
+
+
+def get_cache():
+    """Return the cache configured by ``MULTIFACTOR["CACHE"]``, or None if caching is off."""
+    alias = mf_settings["CACHE"]
+    if not alias:
+        return None
+    return caches[alias]
+
+
+def shared_cache():
+    """The ``MULTIFACTOR["CACHE"]`` cache, or the default one if that's not set, for state every process must see."""
+    return caches[mf_settings["CACHE"] or "default"]
+
+
+def user_keys_cache_key(user_id):
+    return f"multifactor:keys:v{VERSION}:{user_id}"
+
+
+def enabled_keys(user):
+    """
+    List ``(id, key_type)`` for each of the user's enabled keys.
+
+    Served from the cache when ``MULTIFACTOR["CACHE"]`` is set, so a hit costs no queries.
+    """
+    from .models import UserKey
+
+    cache = get_cache()
+    if cache is not None:
+        keys = cache.get(user_keys_cache_key(user.pk))
+        if keys is not None:
+            return keys
+
+    keys = [tuple(k) for k in UserKey.objects.filter(user=user, enabled=True).values_list("id", "key_type")]
+
+    if cache is not None:
+        cache.set(user_keys_cache_key(user.pk), keys, mf_settings["CACHE_TIMEOUT"])
+    return keys
+
+
+async def aenabled_keys(user):
+    """Async version of ``enabled_keys``."""
+    from .models import UserKey
+
+    cache = get_cache()
+    if cache is not None:
+        keys = await cache.aget(user_keys_cache_key(user.pk))
+        if keys is not None:
+            return keys
+
+    keys = [tuple(k) async for k in UserKey.objects.filter(user=user, enabled=True).values_list("id", "key_type")]
+
+    if cache is not None:
+        await cache.aset(user_keys_cache_key(user.pk), keys, mf_settings["CACHE_TIMEOUT"])
+    return keys
+
+
+def user_filter_cache_key(user_id):
+    return f"multifactor:user_filter:v{VERSION}:{user_id}"
+
+
+def qr_cache_key(fmt, uri):
+    # the URI holds the secret, so only a hash of it goes in the key
+    return f"multifactor:qr:v{VERSION}:{fmt}:{hashlib.sha256(uri.encode()).hexdigest()}"
+
+
+def invalidate_user_keys(*user_ids):
+    """
+    Drop cached key data for these users.
+
+    Saving or deleting a ``UserKey`` and ``UserKey.objects.update()`` call this for you.
+    Call it yourself after anything else that changes keys without signals (``bulk_create``, raw SQL).
+    """
+    cache = get_cache()
+    if cache is None or not user_ids:
+        return
+
+    cache_keys = [user_keys_cache_key(user_id) for user_id in user_ids]
+    cache.delete_many(cache_keys)
+    # and again once committed, in case another request re-cached the old rows mid-transaction
+    transaction.on_commit(lambda: cache.delete_many(cache_keys))
+
+
+def invalidate_user_filters(*user_ids):
+    """
+    Drop cached ``user_filter`` decisions for these users.
+
+    Saving or deleting a user and changing their many-to-many relations (eg groups) call this for you.
+    """
+    cache = get_cache()
+    if cache is None or not user_ids:
+        return
+
+    cache.delete_many([user_filter_cache_key(user_id) for user_id in user_ids])
+
+
+class LRU:
+    """
+    A small, thread-safe, in-process least-recently-used cache.
+
+    Its size comes from the ``MULTIFACTOR`` setting named ``setting``, so it can be changed (or
+    turned off with 0) without a restart. ``stats()`` reports how well it's doing.
+    """
+
+    def __init__(self, setting):
+        self.setting = setting
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    @property
+    def maxsize(self):
+        return mf_settings[self.setting]
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        if not self.maxsize:
+            return default
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        maxsize = self.maxsize
+        if not maxsize:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > maxsize:
+                self._data.popitem(last=False)
+
+    def load(self, keys, decode):
+        """
+        ``decode(key.properties)`` for each ``UserKey`` in ``keys``, through this cache.
+
+        Entries are keyed by ``(id, added_on)``. Given a queryset, ``properties`` is deferred and only
+        fetched for the keys the cache is missing. Returns ``(keys, values)``, leaving out any key
+        deleted in between.
+        """
+        if not self.maxsize:
+            keys = list(keys)
+            return keys, [decode(key.properties) for key in keys]
+
+        keys = list(keys.defer("properties") if isinstance(keys, QuerySet) else keys)
+        values = [self.get((key.pk, key.added_on)) for key in keys]
+
+        missing = [key for key, value in zip(keys, values) if value is None]
+        if not missing:
+            return keys, values
+
+        if any(key.get_deferred_fields() for key in missing):
+            manager = type(missing[0])._default_manager
+            properties = dict(manager.filter(pk__in=[key.pk for key in missing]).values_list("pk", "properties"))
+        else:
+            properties = {key.pk: key.properties for key in missing}
+        for i, key in enumerate(keys):
+            if values[i] is None and key.pk in properties:
+                values[i] = decode(properties[key.pk])
+                self.set((key.pk, key.added_on), values[i])
+
+        # anything still missing was deleted in between
+        found = [i for i, value in enumerate(values) if value is not None]
+        return [keys[i] for i in found], [values[i] for i in found]
+
+    def discard(self, predicate):
+        """Drop every entry whose key ``predicate(key)`` is true for."""
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+# both keyed by (key id, added_on), see LRU.load
+decoded_secrets = LRU("TOTP_SECRET_CACHE_SIZE")
+decoded_credentials = LRU("FIDO2_CREDENTIAL_CACHE_SIZE")
+
+
+def holding_keys():
+    """Whether any in-process cache holds key material, so there's anything for ``forget_keys()`` to do."""
+    return bool(len(decoded_secrets) or len(decoded_credentials))
+
+
+def forget_keys(*key_ids):
+    """Drop in-process material held for these keys, eg after they're deleted or disabled."""
+    key_ids = set(key_ids)
+    for lru in (decoded_secrets, decoded_credentials):
+        if key_ids and len(lru):
+            lru.discard(lambda key: key[0] in key_ids)
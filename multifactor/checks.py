@@ -0,0 +1,127 @@
+import importlib.util
+
+from django.conf import settings
+from django.core.checks import Error, register
+from django.core.exceptions import ImproperlyConfigured
+
+from .app_settings import mf_settings
+
+
+@register()
+def check_settings(app_configs, **kwargs):
+    errors = [
+        Error(
+            f'MULTIFACTOR["{setting}"] could not be imported: {path!r}.',
+            hint=str(error),
+            id="multifactor.E001",
+        )
+        for setting, path, error in mf_settings.errors
+    ]
+
+    for setting, value in [
+        ("BYPASS", mf_settings.bypass),
+        ("LOGIN_CALLBACK", mf_settings.login_callback),
+        *((f"FALLBACKS.{name}", method) for name, (field, method) in mf_settings.fallbacks.items()),
+    ]:
+        if value is not None and not callable(value):
+            errors.append(Error(f'MULTIFACTOR["{setting}"] is not callable.', id="multifactor.E002"))
+
+    for name, (field, method) in mf_settings.fallbacks.items():
+        if not callable(field):
+            errors.append(
+                Error(
+                    f'MULTIFACTOR["FALLBACKS"]["{name}"] needs a callable taking the user as its first item.',
+                    id="multifactor.E002",
+                )
+            )
+
+    if mf_settings["RECHECK_MIN"] > mf_settings["RECHECK_MAX"]:
+        errors.append(Error('MULTIFACTOR["RECHECK_MIN"] is larger than RECHECK_MAX.', id="multifactor.E003"))
+
+    if mf_settings["TOTP_QR"]:
+        from .factors.totp import QR_FORMATS
+
+        if mf_settings["TOTP_QR"] not in QR_FORMATS:
+            errors.append(
+                Error(
+                    f'MULTIFACTOR["TOTP_QR"] must be one of {", ".join(QR_FORMATS)} or None.',
+                    id="multifactor.E005",
+                )
+            )
+        elif importlib.util.find_spec("segno") is None:
+            errors.append(
+                Error(
+                    'MULTIFACTOR["TOTP_QR"] needs segno installed.',
+                    hint="pip install django-multifactor[qr]",
+                    id="multifactor.E005",
+                )
+            )
+
+    for pattern, rp in mf_settings["FIDO_SERVERS"].items():
+        if (
+            not isinstance(rp, dict)
+            or not rp.get("id")
+            or "*" in pattern[2:]
+            or pattern.startswith("*") != pattern.startswith("*.")
+        ):
+            errors.append(
+                Error(
+                    f'MULTIFACTOR["FIDO_SERVERS"]["{pattern}"] should map a host or "*.parent" to {{"id": ..., "name": ...}}.',
+                    id="multifactor.E007",
+                )
+            )
+
+    from .factors.fido2 import STATE_STORES
+
+    if mf_settings["FIDO_STATE_STORE"] not in STATE_STORES:
+        errors.append(
+            Error(
+                f'MULTIFACTOR["FIDO_STATE_STORE"] must be one of {", ".join(STATE_STORES)}.',
+                id="multifactor.E008",
+            )
+        )
+
+    backends = settings.AUTHENTICATION_BACKENDS
+    if mf_settings["PASSKEY_LOGIN"]:
+        if mf_settings["PASSKEY_BACKEND"] is None and len(backends) > 1:
+            errors.append(
+                Error(
+                    'MULTIFACTOR["PASSKEY_BACKEND"] must name the backend passkey logins use when there are '
+                    "several AUTHENTICATION_BACKENDS.",
+                    id="multifactor.E009",
+                )
+            )
+        elif mf_settings["PASSKEY_BACKEND"] not in [None, *backends]:
+            errors.append(
+                Error(
+                    f'MULTIFACTOR["PASSKEY_BACKEND"] {mf_settings["PASSKEY_BACKEND"]!r} '
+                    "is not in AUTHENTICATION_BACKENDS.",
+                    id="multifactor.E009",
+                )
+            )
+
+    from .throttle import FACTORS
+
+    for factor, limit in mf_settings["THROTTLE"].items():
+        if (
+            factor not in FACTORS
+            or not isinstance(limit, (list, tuple))
+            or len(limit) != 2
+            or not all(isinstance(n, int) and n > 0 for n in limit)
+        ):
+            errors.append(
+                Error(
+                    f'MULTIFACTOR["THROTTLE"]["{factor}"] should be a factor ({", ".join(FACTORS)}) '
+                    "mapped to (attempts, seconds).",
+                    id="multifactor.E006",
+                )
+            )
+
+    from .middleware import RuleMatcher
+
+    try:
+        RuleMatcher(mf_settings["RULES"])
+    except ImproperlyConfigured as e:
+        errors.append(Error(str(e), id="multifactor.E004"))
+
+    return errors
@@ -1,28 +1,79 @@
+import hashlib
 import random
+from functools import cached_property
 
+from asgiref.sync import iscoroutinefunction, sync_to_async
 from django.conf import settings
 from django.contrib import messages
+from django.contrib.auth import get_user_model
+from django.core.exceptions import FieldDoesNotExist, ValidationError
 from django.shortcuts import redirect
 from django.shortcuts import render as dj_render
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.html import format_html
-from django.utils.module_loading import import_string
 
 from .app_settings import mf_settings
-from .models import DisabledFallback, UserKey
+from .cache import aenabled_keys, enabled_keys, get_cache, user_filter_cache_key
+from .models import DisabledFallback, UserKey, UserStatus
+from .session import Factor, aget_factors, aset_factors, get_factors, set_factors
+
+
+def _status_loaded(user):
+    # true once select_related("multifactor_status") has fetched it, even if there's no row
+    descriptor = getattr(user.__class__, "multifactor_status", None)
+    return descriptor is not None and descriptor.is_cached(user)
 
 
 def has_multifactor(request):
-    return UserKey.objects.filter(user=request.user, enabled=True).exists()
+    user = request.user
+    if mf_settings["STATUS_TABLE"] and (get_cache() is None or _status_loaded(user)):
+        status = getattr(user, "multifactor_status", None)
+        # no row means it hasn't been built yet, the user may have keys from before the table was on
+        if status is not None:
+            return status.has_multifactor
+    if get_cache() is not None:
+        return bool(enabled_keys(user))
+    return UserKey.objects.filter(user=user, enabled=True).exists()
+
+
+async def ahas_multifactor(request):
+    user = await aget_user(request)
+    if mf_settings["STATUS_TABLE"] and _status_loaded(user):
+        status = getattr(user, "multifactor_status", None)
+        if status is not None:
+            return status.has_multifactor
+    if get_cache() is not None:
+        return bool(await aenabled_keys(user))
+    if mf_settings["STATUS_TABLE"] and not _status_loaded(user):
+        enabled_count = await UserStatus.objects.filter(user=user).values_list("enabled_count", flat=True).afirst()
+        if enabled_count is not None:
+            return enabled_count > 0
+    return await UserKey.objects.filter(user=user, enabled=True).aexists()
+
+
+def _unexpired(factors):
+    now = timezone.now().timestamp()
+    return [*filter(lambda f: f.recheck == False or f.recheck > now, factors)]
 
 
 def active_factors(request):
     # automatically expire old factors
-    now = timezone.now().timestamp()
-    factors = request.session["multifactor"] = [
-        *filter(lambda tup: tup[3] == False or tup[3] > now, request.session.get("multifactor", [])),
-    ]
+    stored = get_factors(request.session)
+    factors = _unexpired(stored)
+
+    # only write back when something expired, an untouched session isn't saved
+    if len(factors) != len(stored):
+        set_factors(request.session, factors)
+    return factors
+
+
+async def aactive_factors(request):
+    stored = await aget_factors(request.session)
+    factors = _unexpired(stored)
+
+    if len(factors) != len(stored):
+        await aset_factors(request.session, factors)
     return factors
 
 
@@ -30,6 +81,100 @@ def disabled_fallbacks(request):
     return DisabledFallback.objects.filter(user=request.user).values_list("fallback", flat=True)
 
 
+LOCAL_LOOKUPS = {
+    "exact": lambda a, b: a == b,
+    "iexact": lambda a, b: a is not None and b is not None and str(a).lower() == str(b).lower(),
+    "in": lambda a, b: a in b,
+    "isnull": lambda a, b: (a is None) == bool(b),
+    "gt": lambda a, b: a is not None and a > b,
+    "gte": lambda a, b: a is not None and a >= b,
+    "lt": lambda a, b: a is not None and a < b,
+    "lte": lambda a, b: a is not None and a <= b,
+}
+
+
+def match_user_locally(user, user_filter):
+    """
+    Check ``user_filter`` against the already loaded user, without a query.
+
+    Only plain fields (and foreign key ``_id`` columns) with the lookups in ``LOCAL_LOOKUPS``
+    are understood. Values are converted with the field's ``to_python()``, as the ORM would. Returns
+    None for anything else, or a value that can't be converted or compared, so the caller can fall
+    back to the database.
+    """
+    for lookup, value in user_filter.items():
+        name, _, op = lookup.partition("__")
+        if op not in ("", *LOCAL_LOOKUPS) or hasattr(value, "resolve_expression"):
+            return None
+        try:
+            field = user._meta.pk if name == "pk" else user._meta.get_field(name)
+        except FieldDoesNotExist:
+            return None
+        if field.is_relation and name != field.attname:
+            return None
+        try:
+            if op == "in":
+                value = [field.to_python(item) for item in value]
+            elif op not in ("isnull", "iexact"):
+                value = field.to_python(value)
+            if not LOCAL_LOOKUPS[op or "exact"](getattr(user, field.attname), value):
+                return False
+        except (TypeError, ValueError, ValidationError):
+            return None
+    return True
+
+
+def _user_filter_hash(user_filter):
+    return hashlib.sha1(repr(sorted(user_filter.items())).encode()).hexdigest()[:16]
+
+
+def user_matches(user, user_filter, cache_timeout=0, local=False):
+    """
+    Whether ``user`` is matched by ``user_filter``, as used by ``multifactor_protected``.
+
+    With ``local`` simple filters are checked against ``user`` in memory. With a ``cache_timeout``
+    (and ``MULTIFACTOR["CACHE"]`` set) database decisions are cached per user and filter.
+    """
+    if local:
+        matched = match_user_locally(user, user_filter)
+        if matched is not None:
+            return matched
+
+    cache = get_cache() if cache_timeout else None
+    if cache is not None:
+        cache_key, filter_hash = user_filter_cache_key(user.pk), _user_filter_hash(user_filter)
+        decisions = cache.get(cache_key) or {}
+        if filter_hash in decisions:
+            return decisions[filter_hash]
+
+    matched = get_user_model().objects.filter(pk=user.pk, **user_filter).exists()
+
+    if cache is not None:
+        cache.set(cache_key, {**decisions, filter_hash: matched}, cache_timeout)
+    return matched
+
+
+async def auser_matches(user, user_filter, cache_timeout=0, local=False):
+    """Async version of ``user_matches``."""
+    if local:
+        matched = match_user_locally(user, user_filter)
+        if matched is not None:
+            return matched
+
+    cache = get_cache() if cache_timeout else None
+    if cache is not None:
+        cache_key, filter_hash = user_filter_cache_key(user.pk), _user_filter_hash(user_filter)
+        decisions = await cache.aget(cache_key) or {}
+        if filter_hash in decisions:
+            return decisions[filter_hash]
+
+    matched = await get_user_model().objects.filter(pk=user.pk, **user_filter).aexists()
+
+    if cache is not None:
+        await cache.aset(cache_key, {**decisions, filter_hash: matched}, cache_timeout)
+    return matched
+
+
 def next_check():
     return timezone.now().timestamp() + random.randint(mf_settings["RECHECK_MIN"], mf_settings["RECHECK_MAX"])
 
@@ -44,19 +189,94 @@ def method_url(method):
 
 def write_session(request, key):
     """Write the multifactor session with the verified key"""
-    request.session["multifactor"] = [
-        (
-            key.key_type if key else None,
-            key.id if key else None,
-            timezone.now().timestamp(),
-            next_check() if mf_settings["RECHECK"] else False,
-        ),
-        *filter(lambda tup: not key or tup[1] != key.id, request.session.get("multifactor", [])),
-    ]
+    set_factors(
+        request.session,
+        [
+            Factor(
+                key.key_type if key else None,
+                key.id if key else None,
+                timezone.now().timestamp(),
+                next_check() if mf_settings["RECHECK"] else False,
+            ),
+            *filter(lambda f: not key or f.key_id != key.id, get_factors(request.session)),
+        ],
+    )
 
     if key:
         key.last_used = timezone.now()
-        key.save()
+        # just this, a full save could wind back fields a concurrent request has moved on, like last_step
+        key.save(update_fields=["last_used"])
+
+    if getattr(request, "multifactor", None) is not None:
+        request.multifactor.reset()
+
+
+class MultifactorState:
+    """
+    Multifactor state for a single request, worked out on first use.
+
+    Each attribute is computed once and reused for the rest of the request, so
+    stacking the decorator, the mixins and the views costs one set of lookups.
+    Get hold of it with ``get_state(request)``; it lives on ``request.multifactor``.
+    """
+
+    def __init__(self, request):
+        self.request = request
+
+    async def _amemo(self, name, func):
+        # async access fills the same slots as the cached properties below
+        if name not in self.__dict__:
+            self.__dict__[name] = await func(self.request)
+        return self.__dict__[name]
+
+    async def aactive_factors(self):
+        return await self._amemo("active_factors", aactive_factors)
+
+    async def ahas_multifactor(self):
+        return await self._amemo("has_multifactor", ahas_multifactor)
+
+    async def abypassed(self):
+        return await self._amemo("bypassed", ais_bypassed)
+
+    async def auser(self):
+        return await self._amemo("user", aget_user)
+
+    @cached_property
+    def user(self):
+        return self.request.user
+
+    @cached_property
+    def active_factors(self):
+        return active_factors(self.request)
+
+    @cached_property
+    def has_multifactor(self):
+        return has_multifactor(self.request)
+
+    @cached_property
+    def bypassed(self):
+        return is_bypassed(self.request)
+
+    @cached_property
+    def disabled_fallbacks(self):
+        return list(disabled_fallbacks(self.request))
+
+    @cached_property
+    def factors(self):
+        return UserKey.objects.filter(user=self.user)
+
+    def reset(self):
+        """Forget everything worked out so far, eg after the session or keys change."""
+        for name in ("active_factors", "has_multifactor", "bypassed", "disabled_fallbacks", "factors"):
+            self.__dict__.pop(name, None)
+
+
+def get_state(request):
+    """Return the request's ``MultifactorState``, creating it on first use."""
+    state = getattr(request, "multifactor", None)
+    if state is None:
+        state = request.multifactor = MultifactorState(request)
+    return state
 
 
 def login(request):
@@ -66,17 +286,34 @@ def login(request):
     if "multifactor-next" in request.session:
         return redirect(request.session.pop("multifactor-next", "multifactor:home"))
 
-    callback = mf_settings["LOGIN_CALLBACK"]
+    callback = mf_settings.login_callback
     if callback:
-        return import_string(callback)(request, username=request.session["base_username"])
+        return callback(request, username=request.session["base_username"])
 
     # punch back to the login URL and let it decide what to do with you
     return redirect(settings.LOGIN_URL)
 
 
 def is_bypassed(request):
-    bypass = mf_settings["BYPASS"]
+    bypass = mf_settings.bypass
     if bypass:
-        return import_string(bypass)(request)
+        return bypass(request)
 
     return False
+
+
+async def ais_bypassed(request):
+    bypass = mf_settings.bypass
+    if bypass:
+        if iscoroutinefunction(bypass):
+            return await bypass(request)
+        return await sync_to_async(bypass)(request)
+
+    return False
+
+
+async def aget_user(request):
+    """Return the request's user without blocking, using ``request.auser()`` where available."""
+    if hasattr(request, "auser"):
+        return await request.auser()
+    return request.user
@@ -3,8 +3,8 @@ import inspect
 import time
 
 import django
+from asgiref.sync import iscoroutinefunction
 from django.contrib import messages
-from django.contrib.auth import get_user_model
 from django.core.exceptions import PermissionDenied
 from django.shortcuts import redirect
 from django.urls import reverse
@@ -13,12 +13,137 @@ from django.utils.html import format_html
 from django.utils.translation import gettext as _
 from django.utils.translation import ngettext
 
-from .common import active_factors, has_multifactor, is_bypassed, method_url
+from .common import auser_matches, get_state, user_matches
+
+__all__ = ["acheck_request", "check_request", "multifactor_protected"]
+
+
+def _needs_authentication(request, active, has_multifactor, required_factors, max_age):
+    """Decide whether the user has to (re)authenticate, flashing them the reason."""
+    if has_multifactor:
+        if not active:
+            # has keys but isn't using them, tell them to authenticate
+            return True
+
+        elif max_age and active[0][3] + max_age < timezone.now().timestamp():
+            # has authenticated but not recently enough for this view
+            messages.warning(
+                request,
+                _("This page requires secondary authentication every %(seconds)d seconds. Please re-authenticate.")
+                % {"seconds": max_age},
+            )
+            return True
+
+    if required_factors > len(active):
+        # view needs more active factors than provided
+        messages.warning(
+            request,
+            ngettext(
+                "This page requires %(count)d active security factor.",
+                "This page requires %(count)d active security factors.",
+                required_factors,
+            )
+            % {"count": required_factors},
+        )
+        return True
+
+    return False
+
+
+def _advertise(request):
+    # tell them that they can add keys but it's entirely optional
+    messages.info(
+        request,
+        format_html(
+            _(
+                'Make your account more secure by <a href="{}" class="alert-link">adding a second security factor</a> '
+                "such as a USB Security Token, or an Authenticator App."
+            ),
+            reverse("multifactor:home"),
+        ),
+    )
+
+
+def check_request(
+    request, factors=0, user_filter=None, max_age=0, advertise=False, user_filter_cache=0, user_filter_local=False
+):
+    """
+    Apply a multifactor policy to a request.
+
+    Takes the same policy arguments as ``multifactor_protected``.
+    Returns a response to send instead of the view if the user needs to
+    (re)authenticate, or None if the request may carry on.
+    """
+    if not request.user.is_authenticated:
+        return None
+
+    state = get_state(request)
+
+    if state.bypassed:
+        return None
+
+    if user_filter is not None:
+        # we're filtering for specific users, check that the current user fits that
+        if not user_matches(request.user, user_filter, user_filter_cache, user_filter_local):
+            return None
+
+    active = state.active_factors
+    required_factors = factors(request) if inspect.isfunction(factors) else factors
 
-__all__ = ["multifactor_protected"]
+    if _needs_authentication(request, active, state.has_multifactor, required_factors, max_age):
+        if django.VERSION < (4, 0) and request.is_ajax():
+            raise PermissionDenied(_("Multifactor authentication required"))
+        request.session["multifactor-next"] = request.get_full_path()
+        return redirect("multifactor:authenticate")
 
+    if not active and advertise and "multifactor-advertised" not in request.session:
+        _advertise(request)
+        request.session["multifactor-advertised"] = True
 
-def multifactor_protected(factors=0, user_filter=None, max_age=0, advertise=False):
+    return None
+
+
+async def acheck_request(
+    request, factors=0, user_filter=None, max_age=0, advertise=False, user_filter_cache=0, user_filter_local=False
+):
+    """
+    Async version of ``check_request``, for ASGI.
+
+    Uses async ORM and session calls throughout. ``factors`` and ``MULTIFACTOR["BYPASS"]``
+    may be coroutine functions.
+    """
+    state = get_state(request)
+    user = await state.auser()
+    if not user.is_authenticated:
+        return None
+
+    if await state.abypassed():
+        return None
+
+    if user_filter is not None:
+        if not await auser_matches(user, user_filter, user_filter_cache, user_filter_local):
+            return None
+
+    active = await state.aactive_factors()
+    if iscoroutinefunction(factors):
+        required_factors = await factors(request)
+    else:
+        required_factors = factors(request) if inspect.isfunction(factors) else factors
+
+    if _needs_authentication(request, active, await state.ahas_multifactor(), required_factors, max_age):
+        await request.session.aset("multifactor-next", request.get_full_path())
+        return redirect("multifactor:authenticate")
+
+    if not active and advertise and not await request.session.ahas_key("multifactor-advertised"):
+        _advertise(request)
+        await request.session.aset("multifactor-advertised", True)
+
+    return None
+
+
+def multifactor_protected(
+    factors=0, user_filter=None, max_age=0, advertise=False, user_filter_cache=0, user_filter_local=False
+):
     """
     Protect a view with multifactor authentication.
 
@@ -34,82 +159,38 @@ def multifactor_protected(factors=0, user_filter=None, max_age=0, advertise=Fals
         Zero means infinite (or until it expires)
     advertise : bool
         Advertise to the user that they can optionally add keys for factors=0 views.
+    user_filter_cache : int
+        Seconds to cache each user's user_filter decision (needs MULTIFACTOR["CACHE"]).
+        Zero means check every time. Cached decisions are dropped when the user is saved.
+    user_filter_local : bool
+        Check simple user_filter lookups (plain fields, exact/in/isnull/comparisons)
+        against the already loaded request.user instead of querying.
+
+    Coroutine views get an async wrapper that checks the policy without blocking.
     """
 
     def _func_wrapper(view_func, *args, **kwargs):
-        @functools.wraps(view_func)
-        def _wrapped_view_func(request, *args, **kwargs):
-            def baulk():
-                return view_func(request, *args, **kwargs)
-
-            def force_authenticate():
-                if django.VERSION < (4, 0) and request.is_ajax():
-                    raise PermissionDenied(_("Multifactor authentication required"))
-                request.session["multifactor-next"] = request.get_full_path()
-                return redirect("multifactor:authenticate")
-
-            if not request.user.is_authenticated:
-                return baulk()
-
-            if is_bypassed(request):
-                return baulk()
-
-            if user_filter is not None:
-                # we're filtering for specific users, check that the current user fits that
-                if not get_user_model().objects.filter(pk=request.user.pk, **user_filter).exists():
-                    return baulk()
-
-            active = active_factors(request)
-
-            if has_multifactor(request):
-                if not active:
-                    # has keys but isn't using them, tell them to authenticate
-                    return force_authenticate()
-
-                elif max_age and active[0][3] + max_age < timezone.now().timestamp():
-                    # has authenticated but not recently enough for this view
-                    messages.warning(
-                        request,
-                        _(
-                            "This page requires secondary authentication every %(seconds)d seconds. "
-                            "Please re-authenticate."
-                        )
-                        % {"seconds": max_age},
-                    )
-                    return force_authenticate()
-
-            required_factors = factors
-            if inspect.isfunction(factors):
-                required_factors = factors(request)
-
-            if required_factors > len(active):
-                # view needs more active factors than provided
-                messages.warning(
-                    request,
-                    ngettext(
-                        "This page requires %(count)d active security factor.",
-                        "This page requires %(count)d active security factors.",
-                        required_factors,
-                    )
-                    % {"count": required_factors},
-                )
-                return force_authenticate()
-
-            if not active and advertise and "multifactor-advertised" not in request.session:
-                # tell them that they can add keys but it's entirely optional
-                messages.info(
-                    request,
-                    format_html(
-                        _(
-                            'Make your account more secure by <a href="{}" class="alert-link">adding a second security factor</a> '
-                            "such as a USB Security Token, or an Authenticator App."
-                        ),
-                        reverse("multifactor:home"),
-                    ),
+        if iscoroutinefunction(view_func):
+
+            @functools.wraps(view_func)
+            async def _async_wrapped_view_func(request, *args, **kwargs):
+                response = await acheck_request(
+                    request, factors, user_filter, max_age, advertise, user_filter_cache, user_filter_local
                 )
-                request.session["multifactor-advertised"] = True
+                if response is not None:
+                    return response
+                return await view_func(request, *args, **kwargs)
 
-            return baulk()
+            return _async_wrapped_view_func
+
+        @functools.wraps(view_func)
+        def _wrapped_view_func(request, *args, **kwargs):
+            response = check_request(
+                request, factors, user_filter, max_age, advertise, user_filter_cache, user_filter_local
+            )
+            if response is not None:
+                return response
+            return view_func(request, *args, **kwargs)
 
         return _wrapped_view_func
 
@@ -7,12 +7,12 @@ from django.contrib.auth.mixins import LoginRequiredMixin
 from django.core.mail import EmailMultiAlternatives
 from django.shortcuts import redirect
 from django.template.loader import render_to_string
-from django.utils.module_loading import import_string
 from django.utils.translation import gettext as _
 from django.views.generic import TemplateView
 
+from .. import throttle
 from ..app_settings import mf_settings
-from ..common import disabled_fallbacks, login, write_session
+from ..common import get_state, login, write_session
 
 logger = logging.getLogger(__name__)
 
@@ -25,6 +25,13 @@ class Auth(LoginRequiredMixin, TemplateView):
 
     def get(self, request, generate=True):
         if generate:
+            # every send counts, so the page can't be reloaded to flood someone's inbox
+            wait = throttle.check(request, "FALLBACK")
+            if wait:
+                messages.error(request, throttle.message(wait))
+                return redirect("multifactor:home")
+            throttle.record(request, "FALLBACK")
+
             otp = request.session[SESSION_KEY] = request.session.get(SESSION_KEY, str(randint(0, 100000000)))
             message = _("Your one-time-password is: %(otp)s") % {"otp": otp}
             if request.user.get_full_name():
@@ -33,15 +40,14 @@ class Auth(LoginRequiredMixin, TemplateView):
                     "message": message,
                 }
 
-            disabled = disabled_fallbacks(request)
+            disabled = get_state(request).disabled_fallbacks
             s = []
-            for name, (field, method) in mf_settings["FALLBACKS"].items():
+            for name, (field, method) in mf_settings.fallbacks.items():
                 if name in disabled or not field(request.user):
                     continue
 
                 try:
-                    imported_method = import_string(method)
-                    if imported_method(request.user, message):
+                    if method(request.user, message):
                         s.append(name)
                 except:
                     pass
@@ -67,11 +73,20 @@ class Auth(LoginRequiredMixin, TemplateView):
         )
 
     def post(self, request):
+        wait = throttle.check(request, "FALLBACK")
+        if wait:
+            messages.error(request, throttle.message(wait))
+            response = self.get(request, generate=False)
+            response.status_code = 429
+            return response
+
         if request.session[SESSION_KEY] == request.POST["otp"].strip():
             request.session.pop(SESSION_KEY)
+            throttle.clear(request, "FALLBACK")
             write_session(request, key=None)
             return login(request)
 
+        throttle.record(request, "FALLBACK")
         messages.error(request, _("That key was not correct. Please try again."))
         return self.get(request, generate=False)
 
@@ -1,20 +1,40 @@
+import functools
+import hashlib
 import json
 import logging
+import secrets
+import threading
 from importlib.metadata import version
 
 import fido2.features
+from django.conf import settings
 from django.contrib import messages
+from django.contrib.auth import login as auth_login
 from django.contrib.auth.mixins import LoginRequiredMixin
-from django.http import JsonResponse
+from django.core import signing
+from django.core.signals import setting_changed
+from django.db.models import Q
+from django.http import Http404, JsonResponse
+from django.shortcuts import resolve_url
+from django.urls import reverse
+from django.utils.decorators import method_decorator
+from django.utils.html import format_html
+from django.utils.http import url_has_allowed_host_and_scheme
 from django.utils.translation import gettext as _
-from django.views.decorators.csrf import csrf_exempt
-from django.views.generic import View
+from django.views.decorators.csrf import csrf_exempt, csrf_protect, ensure_csrf_cookie
+from django.views.generic import TemplateView, View
 from fido2.server import Fido2Server
 from fido2.utils import websafe_decode, websafe_encode
-from fido2.webauthn import AttestedCredentialData, PublicKeyCredentialUserEntity
+from fido2.webauthn import (
+    AttestedCredentialData,
+    AuthenticatorData,
+    PublicKeyCredentialUserEntity,
+)
 from packaging.version import Version
 
+from .. import metadata, throttle
 from ..app_settings import mf_settings
+from ..cache import VERSION, decoded_credentials, shared_cache
 from ..common import login, write_session
 from ..mixins import PreferMultiAuthMixin
 from ..models import KeyTypes, UserKey
@@ -25,28 +45,213 @@ if Version(version("fido2")) < Version("2.0.0"):  # 2.0.0+ no longer requies thi
 logger = logging.getLogger(__name__)
 
 
+_servers = {}
+_servers_lock = threading.Lock()
+
+
+def get_server(rp_id, name):
+    """
+    The ``Fido2Server`` for this relying party, built once per process.
+
+    Servers keep no per-ceremony state (that goes in the session), so one can serve every request.
+    """
+    try:
+        return _servers[rp_id, name]
+    except KeyError:
+        pass
+    with _servers_lock:
+        if (rp_id, name) not in _servers:
+            _servers[rp_id, name] = Fido2Server(rp=dict(id=rp_id, name=name))
+        return _servers[rp_id, name]
+
+
+@functools.lru_cache(maxsize=1)
+def _rp_table():
+    """``MULTIFACTOR["FIDO_SERVERS"]`` as exact hosts and wildcard suffixes, longest first."""
+    exact, wildcards = {}, []
+    for pattern, rp in mf_settings["FIDO_SERVERS"].items():
+        rp = (rp["id"], rp.get("name", mf_settings["FIDO_SERVER_NAME"]))
+        if pattern.startswith("*."):
+            wildcards.append((pattern[1:].lower(), rp))
+        else:
+            exact[pattern.lower()] = rp
+    wildcards.sort(key=lambda wildcard: len(wildcard[0]), reverse=True)
+    return exact, wildcards
+
+
+@functools.lru_cache(maxsize=1024)
+def resolve_rp(host):
+    """
+    The ``(id, name)`` of the relying party serving ``host`` (as from ``request.get_host()``).
+
+    An exact host in ``MULTIFACTOR["FIDO_SERVERS"]`` wins, then the longest ``*.parent`` wildcard
+    matching it, then the global ``FIDO_SERVER_ID`` and ``FIDO_SERVER_NAME``.
+    """
+    exact, wildcards = _rp_table()
+    host = host.rsplit(":", 1)[0].lower() if host else ""
+    if host in exact:
+        return exact[host]
+    for suffix, rp in wildcards:
+        if host.endswith(suffix):
+            return rp
+    return mf_settings["FIDO_SERVER_ID"], mf_settings["FIDO_SERVER_NAME"]
+
+
+def reset_servers(*, setting, **kwargs):
+    if setting == "MULTIFACTOR":
+        with _servers_lock:
+            _servers.clear()
+        _rp_table.cache_clear()
+        resolve_rp.cache_clear()
+
+
+setting_changed.connect(reset_servers, dispatch_uid="multifactor.factors.fido2.reset_servers")
+
+
+def encode_credential_id(credential_id):
+    """How ``UserKey.credential_id`` stores a credential ID: websafe base64, or None if it won't fit."""
+    encoded = websafe_encode(credential_id)
+    if len(encoded) <= UserKey._meta.get_field("credential_id").max_length:
+        return encoded
+    return None
+
+
+def _decode(properties):
+    return AttestedCredentialData(websafe_decode(properties["device"]))
+
+
+def load_credentials(keys):
+    """
+    The ``AttestedCredentialData`` of each key.
+
+    Parsed credentials are kept in an in-process LRU of ``MULTIFACTOR["FIDO2_CREDENTIAL_CACHE_SIZE"]``,
+    keyed by ``(id, added_on)``. Given a queryset, ``properties`` are only loaded for keys it's missing.
+    """
+    return decoded_credentials.load(keys, _decode)[1]
+
+
+# where ceremony state waits between the options being sent and the browser's response coming back
+STATE_STORES = ("session", "cache", "signed")
+STATE_SALT = "multifactor.fido2.state"
+
+
+def _state_key(ceremony):
+    return f"multifactor:fido_state:v{VERSION}:{ceremony}"
+
+
+def save_state(request, state):
+    """
+    Keep a ceremony's ``state`` in ``MULTIFACTOR["FIDO_STATE_STORE"]`` until its response is posted.
+
+    Returns what to add to the options sent to the browser. For the ``cache`` and ``signed`` stores that's
+    a ``ceremony`` (a random ID, or the state itself, signed) to post back, so each ceremony has its own
+    state and none of it is written to the session. The ``session`` store keeps one ceremony per session.
+    """
+    store = mf_settings["FIDO_STATE_STORE"]
+    if store == "session":
+        request.session["fido_state"] = state
+        return {}
+
+    entry = {"user": str(request.user.pk), "state": state}
+    if store == "cache":
+        ceremony = secrets.token_urlsafe(16)
+        shared_cache().set(_state_key(ceremony), entry, mf_settings["FIDO_STATE_TIMEOUT"])
+    else:
+        ceremony = signing.dumps(entry, salt=STATE_SALT, compress=True)
+    return {"ceremony": ceremony}
+
+
+def pop_state(request, data):
+    """
+    The ``state`` ``save_state`` kept for the ceremony posted in ``data``, or None.
+
+    Each state is only given out once, and only to the user who started the ceremony. ``data["ceremony"]``
+    is removed, leaving just the browser's response.
+    """
+    store = mf_settings["FIDO_STATE_STORE"]
+    if store == "session":
+        return request.session.pop("fido_state", None)
+
+    ceremony = data.pop("ceremony", None)
+    if not isinstance(ceremony, str):
+        return None
+
+    cache = shared_cache()
+    if store == "cache":
+        key = _state_key(ceremony)
+        entry = cache.get(key)
+        # of two requests posting the same ceremony, only the one that deletes it gets its state
+        if entry is None or not cache.delete(key):
+            return None
+    else:
+        try:
+            entry = signing.loads(ceremony, salt=STATE_SALT, max_age=mf_settings["FIDO_STATE_TIMEOUT"])
+        except signing.BadSignature:
+            return None
+        # signed states can't be deleted, so spent ones are remembered until they'd have expired anyway
+        spent = _state_key(hashlib.sha256(ceremony.encode()).hexdigest())
+        if not cache.add(spent, True, mf_settings["FIDO_STATE_TIMEOUT"]):
+            return None
+
+    if entry["user"] != str(request.user.pk):
+        return None
+    return entry["state"]
+
+
+def sign_count(data):
+    """The signature counter in a posted assertion's authenticator data."""
+    return AuthenticatorData(websafe_decode(data["response"]["authenticatorData"])).counter
+
+
+def update_sign_count(key, counter):
+    """
+    Record ``key``'s new signature counter, or return False if it hasn't gone up.
+
+    Authenticators count every signature, so a counter that doesn't move on may be a cloned one. It's
+    a single conditional ``UPDATE``, so of two requests racing with the same counter only one wins.
+    Authenticators that don't keep a counter always send 0 and are never written.
+    """
+    if counter == 0 and not key.sign_count:
+        return True
+    advanced = Q(sign_count__isnull=True) | Q(sign_count__lt=counter)
+    if not UserKey.objects.filter(advanced, pk=key.pk).update(sign_count=counter):
+        logger.warning("FIDO2 key %s sent signature counter %s, it was already %s.", key.pk, counter, key.sign_count)
+        return False
+    key.sign_count = counter
+    return True
+
+
 class FidoClass(View):
+    # the ceremonies are tied to the logged-in user by their own one-time state
+    exempt_csrf = True
+
     @classmethod
     def as_view(cls, **initkwargs):
         view = super().as_view(**initkwargs)
-        return csrf_exempt(view)
+        return csrf_exempt(view) if cls.exempt_csrf else csrf_protect(view)
+
+    @property
+    def rp(self):
+        """The ``(id, name)`` of the relying party for this request's host, see ``resolve_rp``."""
+        request = getattr(self, "request", None)
+        return resolve_rp(request.get_host() if request else None)
 
     @property
     def server(self):
-        return Fido2Server(rp=dict(id=mf_settings["FIDO_SERVER_ID"], name=mf_settings["FIDO_SERVER_NAME"]))
+        return get_server(*self.rp)
+
+    def get_user_keys(self):
+        return UserKey.objects.filter(
+            user=self.request.user,
+            key_type=str(KeyTypes.FIDO2),
+            domain=self.rp[0],
+            enabled=True,
+        )
 
-    def get_user_credentials(self):
+    def get_user_credentials(self, keys=None):
         if not self.request.user.is_authenticated:
             return []
-        return [
-            AttestedCredentialData(websafe_decode(key.properties["device"]))
-            for key in UserKey.objects.filter(
-                user=self.request.user,
-                key_type=str(KeyTypes.FIDO2),
-                properties__domain=self.request.get_host().split(":")[0],
-                enabled=True,
-            )
-        ]
+        return load_credentials(self.get_user_keys() if keys is None else keys)
 
 
 class Register(PreferMultiAuthMixin, FidoClass):
@@ -58,25 +263,39 @@ class Register(PreferMultiAuthMixin, FidoClass):
                 display_name=request.user.get_username(),
             ),
             credentials=self.get_user_credentials(),
+            # discoverable, so it can be used to log in without a username
+            resident_key_requirement="preferred" if mf_settings["PASSKEY_LOGIN"] else None,
         )
-        request.session["fido_state"] = state
 
-        return JsonResponse({**registration_data}, safe=False)
+        return JsonResponse({**registration_data, **save_state(request, state)}, safe=False)
 
     def post(self, request, *args, **kwargs):
         try:
             data = json.loads(request.body)
-            auth_data = self.server.register_complete(request.session["fido_state"], data)
+            auth_data = self.server.register_complete(pop_state(request, data), data)
+
+            credential_id = encode_credential_id(auth_data.credential_data.credential_id)
+            # a credential ID belongs to one key, passkey login finds the key by it
+            duplicate = UserKey.objects.filter(key_type=str(KeyTypes.FIDO2), credential_id=credential_id)
+            if credential_id and duplicate.exists():
+                return JsonResponse({"status": "ERR", "message": _("This security key is already registered.")})
 
             encoded = websafe_encode(auth_data.credential_data)
+            properties = {
+                "device": encoded,
+                "type": data["type"],
+                "domain": self.server.rp.id,
+            }
+            authenticator = metadata.lookup(auth_data.credential_data.aaguid)
+            if authenticator:
+                properties["model"], properties["certification"] = authenticator
             key = UserKey.objects.create(
                 user=request.user,
-                properties={
-                    "device": encoded,
-                    "type": data["type"],
-                    "domain": self.server.rp.id,
-                },
+                properties=properties,
                 key_type=str(KeyTypes.FIDO2),
+                domain=self.server.rp.id,
+                credential_id=credential_id,
+                sign_count=auth_data.counter,
             )
             write_session(request, key)
             messages.success(request, _("FIDO2 Token added!"))
@@ -98,24 +317,130 @@ class Authenticate(LoginRequiredMixin, FidoClass):
             credentials=self.get_user_credentials(),
             user_verification="discouraged",
         )
-        request.session["fido_state"] = state
-        return JsonResponse({**auth_data})
+        return JsonResponse({**auth_data, **save_state(request, state)})
 
     def post(self, request, *args, **kwargs):
+        wait = throttle.check(request, "FIDO2")
+        if wait:
+            return JsonResponse({"status": "err", "message": throttle.message(wait)}, status=429)
+
         data = json.loads(request.body)
+        state = pop_state(request, data)
+        if state is None:
+            return JsonResponse({"status": "err", "message": _("This request has expired, please try again.")})
 
-        cred = self.server.authenticate_complete(request.session.pop("fido_state"), self.get_user_credentials(), data)
+        # when the browser names its credential, only that one key needs decoding and checking
+        posted = list(self.get_user_keys().filter(credential_id=data["id"])) if isinstance(data.get("id"), str) else []
 
-        keys = UserKey.objects.filter(
-            user=request.user,
-            key_type=str(KeyTypes.FIDO2),
-            enabled=True,
+        try:
+            cred = self.server.authenticate_complete(state, self.get_user_credentials(posted or None), data)
+        except Exception:
+            throttle.record(request, "FIDO2")
+            logger.info("FIDO2 authentication failed.", exc_info=True)
+            return JsonResponse({"status": "err", "message": _("That security key couldn't be verified.")})
+
+        key = posted[0] if posted else self.find_key(cred.credential_id)
+        if key is None:
+            throttle.record(request, "FIDO2")
+            return JsonResponse({"status": "err"})
+        if not update_sign_count(key, sign_count(data)):
+            throttle.record(request, "FIDO2")
+            return JsonResponse(
+                {"status": "err", "message": _("This security key can't be used, it may have been copied.")}
+            )
+
+        throttle.clear(request, "FIDO2")
+        write_session(request, key)
+        res = login(request)
+        return JsonResponse({"status": "OK", "redirect": res["location"]})
+
+    def find_key(self, credential_id):
+        keys = UserKey.objects.filter(user=self.request.user, key_type=str(KeyTypes.FIDO2), enabled=True)
+        key = keys.filter(credential_id=encode_credential_id(credential_id)).first()
+        if key is not None:
+            return key
+
+        # keys from before the column was backfilled, or with IDs too long for it
+        for key in keys.filter(credential_id__isnull=True):
+            if load_credentials([key])[0].credential_id == credential_id:
+                return key
+
+
+class PasskeyMixin:
+    """Only there with ``MULTIFACTOR["PASSKEY_LOGIN"]`` on."""
+
+    def dispatch(self, request, *args, **kwargs):
+        if not mf_settings["PASSKEY_LOGIN"]:
+            raise Http404()
+        return super().dispatch(request, *args, **kwargs)
+
+
+@method_decorator(ensure_csrf_cookie, name="dispatch")
+class LoginPage(PasskeyMixin, TemplateView):
+    template_name = "multifactor/FIDO2/login.html"
+
+
+class Login(PasskeyMixin, FidoClass):
+    """
+    Log in with a discoverable credential (a passkey), no username or password needed.
+
+    The ceremony starts with an empty allow-list, the browser offers whichever of the user's passkeys
+    they pick, and the credential ID it returns is looked up across every user's keys. User
+    verification is required, so the one assertion stands in for both the password and a second factor.
+
+    Anyone can start a ceremony here, so unlike the other FIDO2 views this one checks the CSRF token: a
+    forged post could otherwise log the victim in as the attacker.
+    """
+
+    exempt_csrf = False
+
+    def get(self, request, *args, **kwargs):
+        auth_data, state = self.server.authenticate_begin(user_verification="required")
+        return JsonResponse({**auth_data, **save_state(request, state)})
+
+    def post(self, request, *args, **kwargs):
+        wait = throttle.check(request, "FIDO2")
+        if wait:
+            return JsonResponse({"status": "err", "message": throttle.message(wait)}, status=429)
+
+        try:
+            data = json.loads(request.body)
+        except ValueError:
+            data = None
+        if not isinstance(data, dict):
+            # fails below like any other bad assertion
+            data = {}
+        state = pop_state(request, data)
+        key = (
+            UserKey.objects.select_related("user")
+            .filter(
+                credential_id=data.get("id"),
+                key_type=str(KeyTypes.FIDO2),
+                domain=self.rp[0],
+                enabled=True,
+            )
+            .first()
+            if isinstance(data.get("id"), str) and state
+            else None
         )
 
-        for key in keys:
-            if AttestedCredentialData(websafe_decode(key.properties["device"])).credential_id == cred.credential_id:
-                write_session(request, key)
-                res = login(request)
-                return JsonResponse({"status": "OK", "redirect": res["location"]})
+        try:
+            if key is None or not key.user.is_active:
+                raise ValueError("Unknown credential.")
+            self.server.authenticate_complete(state, load_credentials([key]), data)
+            if not update_sign_count(key, sign_count(data)):
+                raise ValueError("Signature counter didn't go up.")
+        except Exception:
+            throttle.record(request, "FIDO2")
+            logger.info("Passkey login failed.", exc_info=True)
+            return JsonResponse({"status": "err", "message": _("That passkey can't be used to log in here.")})
+
+        auth_login(request, key.user, backend=mf_settings["PASSKEY_BACKEND"])
+        write_session(request, key)
+        if mf_settings["SHOW_LOGIN_MESSAGE"]:
+            messages.info(request, format_html(mf_settings["LOGIN_MESSAGE"], reverse("multifactor:home")))
 
-        return JsonResponse({"status": "err"})
+        redirect_to = request.GET.get("next", "")
+        if not url_has_allowed_host_and_scheme(redirect_to, {request.get_host()}, request.is_secure()):
+            redirect_to = resolve_url(settings.LOGIN_REDIRECT_URL)
+        return JsonResponse({"status": "OK", "redirect": redirect_to})
@@ -1,16 +1,138 @@
+import base64
+import hashlib
+import hmac
+import struct
+import time
+from collections import namedtuple
+
 import pyotp
 from django.contrib import messages
 from django.contrib.auth.mixins import LoginRequiredMixin
+from django.db.models import Q
 from django.shortcuts import redirect
+from django.utils.html import format_html
+from django.utils.safestring import mark_safe
 from django.utils.translation import gettext as _
 from django.views.generic import TemplateView
 
+from .. import throttle
 from ..app_settings import mf_settings
+from ..cache import decoded_secrets, get_cache, qr_cache_key
 from ..common import login, write_session
 from ..mixins import PreferMultiAuthMixin
 from ..models import KeyTypes, UserKey
 
-WINDOW = 60
+# what pyotp.TOTP defaults to, and so what every stored key uses
+DIGITS = 6
+INTERVAL = 30
+# steps either side of a key's last known drift tried before widening to MULTIFACTOR["TOTP_WINDOW"]
+DRIFT_WINDOW = 1
+# how long a rendered enrolment QR code is cached, long enough to retry a mistyped code
+QR_TIMEOUT = 60 * 15
+QR_FORMATS = ("svg", "png")
+
+
+def _decode(secret):
+    return base64.b32decode(secret + "=" * (-len(secret) % 8), casefold=True)
+
+
+def _code(mac, counter):
+    """The HOTP code for ``counter`` from a keyed HMAC-SHA1 (RFC 4226 dynamic truncation)."""
+    mac = mac.copy()
+    mac.update(struct.pack(">Q", counter))
+    digest = mac.digest()
+    offset = digest[-1] & 0xF
+    code = struct.unpack_from(">I", digest, offset)[0] & 0x7FFFFFFF
+    return b"%0*d" % (DIGITS, code % 10**DIGITS)
+
+
+Match = namedtuple("Match", ["index", "drift", "step"])
+
+
+def match_token(secrets, token, drifts=None, window=None, for_time=None, last_steps=None):
+    """
+    Find which secret ``token`` is a valid code for.
+
+    Returns a ``Match`` of the secret's index, the drift (how many time steps from now the code
+    was for) and the time step itself, or None if it isn't valid for any of them.
+
+    ``drifts`` are the secrets' drifts at their last success. Steps within ``DRIFT_WINDOW`` of
+    those are tried first, then the rest of the steps up to ``window``
+    (``MULTIFACTOR["TOTP_WINDOW"]``) either side of now, nearest first. Steps at or before a
+    secret's entry in ``last_steps`` have been used already and are never tried.
+
+    ``secrets`` are base32 strings, or bytes already decoded. Each is decoded once and every
+    candidate is compared in constant time. Otherwise the codes accepted are the same as
+    ``pyotp.TOTP(secret).verify(token, valid_window=window)``.
+    """
+    token = str(token)
+    if len(token) != DIGITS or not token.isdigit():
+        # could never match, don't spend any HMACs on it
+        return None
+    token = token.encode()
+
+    window = mf_settings["TOTP_WINDOW"] if window is None else window
+    drifts = drifts or [0] * len(secrets)
+    floors = [-1 if step is None else step for step in last_steps or [None] * len(secrets)]
+    macs = [
+        hmac.new(_decode(secret) if isinstance(secret, str) else secret, digestmod=hashlib.sha1) for secret in secrets
+    ]
+    current = int((time.time() if for_time is None else for_time) // INTERVAL)
+    tried = [set() for _ in secrets]
+
+    def matches(index, offset):
+        if abs(offset) > window or current + offset <= floors[index] or offset in tried[index]:
+            return False
+        tried[index].add(offset)
+        return hmac.compare_digest(_code(macs[index], current + offset), token)
+
+    # usually the clock is where it was last time, then widen around now
+    for centers, width in [(drifts, DRIFT_WINDOW), ([0] * len(secrets), window)]:
+        for distance in range(width + 1):
+            for index, center in enumerate(centers):
+                for offset in (center - distance, center + distance) if distance else (center,):
+                    if matches(index, offset):
+                        return Match(index, offset, current + offset)
+    return None
+
+
+def user_secrets(user):
+    """
+    The user's enabled TOTP keys and their decoded secrets.
+
+    With ``MULTIFACTOR["TOTP_SECRET_CACHE_SIZE"]`` set, secrets come from an in-process LRU keyed
+    by ``(id, added_on)`` and the JSON ``properties`` are only read for keys it's missing, so in
+    steady state this is one indexed query returning a few narrow rows.
+    """
+    keys = UserKey.objects.filter(user=user, key_type=str(KeyTypes.TOTP), enabled=True)
+    return decoded_secrets.load(keys, lambda properties: _decode(properties["secret_key"]))
+
+
+def render_qr(uri, fmt):
+    """
+    The provisioning URI as an inline SVG or PNG ``<img>``, for ``MULTIFACTOR["TOTP_QR"]``.
+
+    Needs segno (``pip install django-multifactor[qr]``). Output is kept in ``MULTIFACTOR["CACHE"]``,
+    when set, for ``QR_TIMEOUT`` seconds so re-showing the page after a failed code doesn't redraw it.
+    """
+    cache = get_cache()
+    cache_key = qr_cache_key(fmt, uri)
+    if cache is not None:
+        html = cache.get(cache_key)
+        if html is not None:
+            return mark_safe(html)
+
+    import segno
+
+    qr = segno.make(uri, error="m")
+    if fmt == "svg":
+        html = qr.svg_inline(scale=4, title=_("Authenticator QR code"))
+    else:
+        html = format_html('<img src="{}" alt="{}">', qr.png_data_uri(scale=4), _("Authenticator QR code"))
+
+    if cache is not None:
+        cache.set(cache_key, str(html), QR_TIMEOUT)
+    return mark_safe(html)
 
 
 class Create(PreferMultiAuthMixin, TemplateView):
@@ -22,18 +144,23 @@ class Create(PreferMultiAuthMixin, TemplateView):
         return super().dispatch(request, *args, **kwargs)
 
     def get_context_data(self, **kwargs):
+        uri = self.totp.provisioning_uri(self.request.user.get_username(), issuer_name=mf_settings["TOKEN_ISSUER_NAME"])
         return {
             **super().get_context_data(**kwargs),
-            "qr": self.totp.provisioning_uri(
-                self.request.user.get_username(), issuer_name=mf_settings["TOKEN_ISSUER_NAME"]
-            ),
+            "qr": uri,
+            "qr_image": render_qr(uri, mf_settings["TOTP_QR"]) if mf_settings["TOTP_QR"] else None,
             "secret_key": self.secret_key,
         }
 
     def post(self, request, *args, **kwargs):
-        if self.totp.verify(request.POST["answer"], valid_window=WINDOW):
+        match = match_token([self.secret_key], request.POST["answer"])
+        if match is not None:
             key = UserKey.objects.create(
-                user=request.user, properties={"secret_key": self.secret_key}, key_type=str(KeyTypes.TOTP)
+                user=request.user,
+                properties={"secret_key": self.secret_key},
+                key_type=str(KeyTypes.TOTP),
+                drift=match.drift,
+                last_step=match.step,
             )
             write_session(request, key)
             messages.success(request, _("TOTP Authenticator added."))
@@ -47,15 +174,38 @@ class Auth(LoginRequiredMixin, TemplateView):
     template_name = "multifactor/TOTP/check.html"
 
     def post(self, request, *args, **kwargs):
+        wait = throttle.check(request, "TOTP")
+        if wait:
+            messages.error(request, throttle.message(wait))
+            response = super().get(request, *args, **kwargs)
+            response.status_code = 429
+            return response
+
         key = self.verify_login(token=request.POST["answer"])
         if key:
+            throttle.clear(request, "TOTP")
             write_session(request, key)
             return login(request)
 
+        throttle.record(request, "TOTP")
         messages.error(request, _("Could not validate key, please try again."))
         return super().get(request, *args, **kwargs)
 
     def verify_login(self, token):
-        for key in UserKey.objects.filter(user=self.request.user, key_type=str(KeyTypes.TOTP), enabled=True):
-            if pyotp.TOTP(key.properties["secret_key"]).verify(token, valid_window=WINDOW):
-                return key
+        keys, secrets = user_secrets(self.request.user)
+        match = match_token(
+            secrets,
+            token,
+            drifts=[key.drift for key in keys],
+            last_steps=[key.last_step for key in keys],
+        )
+        if match is None:
+            return None
+
+        key = keys[match.index]
+        # only one request gets to use each step, whatever else is submitting the same code
+        unused = Q(last_step__isnull=True) | Q(last_step__lt=match.step)
+        if not UserKey.objects.filter(unused, pk=key.pk).update(last_step=match.step, drift=match.drift):
+            return None
+        key.last_step, key.drift = match.step, match.drift
+        return key
@@ -0,0 +1,44 @@
+from cryptography import x509
+from cryptography.hazmat.primitives.serialization import Encoding
+from django.core.management.base import BaseCommand, CommandError
+
+from ...app_settings import mf_settings
+from ...metadata import build_index, load_index, write_index
+
+
+class Command(BaseCommand):
+    help = "Index a downloaded FIDO Metadata Service (MDS3) blob by AAGUID, for naming FIDO2 keys at registration."
+
+    def add_arguments(self, parser):
+        parser.add_argument("blob", help="The MDS3 blob, as downloaded from https://mds3.fidoalliance.org/.")
+        parser.add_argument("--trust-root", help="The FIDO root certificate (PEM or DER) to verify the blob with.")
+        parser.add_argument("--output", help='Where to write the index, MULTIFACTOR["FIDO_METADATA_INDEX"] by default.')
+
+    def handle(self, *args, blob, trust_root, output, **options):
+        output = output or mf_settings["FIDO_METADATA_INDEX"]
+        if not output:
+            raise CommandError('Set MULTIFACTOR["FIDO_METADATA_INDEX"] or pass --output.')
+
+        with open(blob, "rb") as f:
+            data = f.read().strip()
+
+        if trust_root:
+            with open(trust_root, "rb") as f:
+                certificate = f.read()
+            if certificate.lstrip().startswith(b"-----BEGIN"):
+                certificate = x509.load_pem_x509_certificate(certificate).public_bytes(Encoding.DER)
+        else:
+            certificate = None
+            self.stderr.write("No --trust-root given, the blob's signature is not being checked.")
+
+        try:
+            index = build_index(data, certificate)
+        except Exception as e:
+            raise CommandError(f"Could not read {blob}: {e}")
+
+        write_index(index, output)
+        load_index.cache_clear()
+        self.stdout.write(
+            f"{len(index['authenticators'])} authenticators from blob {index['no']} written to {output}. "
+            f"Its next update is due {index['next_update']}."
+        )
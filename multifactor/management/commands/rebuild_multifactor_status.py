@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from ...models import UserStatus
+
+
+class Command(BaseCommand):
+    help = "Rebuild the per-user multifactor status table from the users' keys, adding a row for every user."
+
+    def add_arguments(self, parser):
+        parser.add_argument("user_ids", nargs="*", type=int, help="Only rebuild these users.")
+
+    def handle(self, *args, user_ids, **options):
+        UserStatus.objects.rebuild(user_ids or None)
+        with_keys = UserStatus.objects.filter(enabled_count__gt=0).count()
+        self.stdout.write(f"{with_keys} of {UserStatus.objects.count()} users with multifactor keys.")
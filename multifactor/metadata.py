@@ -0,0 +1,95 @@
+"""
+Authenticator models and their certification status, from an offline copy of the FIDO Metadata Service.
+
+The ``load_fido_metadata`` command parses an MDS3 blob (several megabytes of JWT) into a small pickled
+index at ``MULTIFACTOR["FIDO_METADATA_INDEX"]``, keyed by AAGUID. Each process unpickles it once, on
+first use, and looks authenticators up with a dict ``get``. Nothing here touches the network.
+"""
+
+import datetime
+import functools
+import logging
+import os
+import pickle
+import tempfile
+
+from django.core.signals import setting_changed
+from fido2.mds3 import parse_blob
+
+from .app_settings import mf_settings
+
+logger = logging.getLogger(__name__)
+
+# bump if the pickled layout changes, older indexes are then ignored until rebuilt
+INDEX_VERSION = 1
+
+
+def build_index(blob, trust_root=None):
+    """
+    Parse an MDS3 ``blob`` into ``{aaguid bytes: (description, status)}``.
+
+    ``status`` is the latest status report's, eg ``"FIDO_CERTIFIED_L1"`` or ``"REVOKED"``. The blob's
+    signature is checked against ``trust_root`` (the FIDO root certificate, DER) if one is given.
+    Entries without an AAGUID are U2F authenticators, which FIDO2 registration never sees.
+    """
+    payload = parse_blob(blob, trust_root)
+    authenticators = {}
+    for entry in payload.entries:
+        if entry.aaguid is None:
+            continue
+        latest = max(entry.status_reports, key=lambda r: r.effective_date or datetime.date.min, default=None)
+        authenticators[bytes(entry.aaguid)] = (
+            entry.metadata_statement.description if entry.metadata_statement else None,
+            latest.status.value if latest else None,
+        )
+    return {
+        "version": INDEX_VERSION,
+        "no": payload.no,
+        "next_update": payload.next_update,
+        "authenticators": authenticators,
+    }
+
+
+def write_index(index, path):
+    """Pickle ``index`` to ``path``, replacing it in one step so readers never see half a file."""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=directory, prefix=".multifactor-metadata-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+@functools.lru_cache(maxsize=1)
+def load_index():
+    """The index at ``MULTIFACTOR["FIDO_METADATA_INDEX"]``, read once per process. Empty if there isn't one."""
+    path = mf_settings["FIDO_METADATA_INDEX"]
+    if not path:
+        return {}
+    try:
+        with open(path, "rb") as f:
+            index = pickle.load(f)
+    except FileNotFoundError:
+        logger.warning("No FIDO metadata index at %s, run the load_fido_metadata command.", path)
+        return {}
+    if index.get("version") != INDEX_VERSION:
+        logger.warning("The FIDO metadata index at %s is out of date, run the load_fido_metadata command.", path)
+        return {}
+    return index["authenticators"]
+
+
+def lookup(aaguid):
+    """The ``(description, status)`` of the authenticator model with this AAGUID, or None if it isn't known."""
+    index = load_index()
+    return index.get(bytes(aaguid)) if index else None
+
+
+def reset_index(*, setting, **kwargs):
+    if setting == "MULTIFACTOR":
+        load_index.cache_clear()
+
+
+setting_changed.connect(reset_index, dispatch_uid="multifactor.metadata.reset_index")
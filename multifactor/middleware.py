@@ -0,0 +1,104 @@
+import re
+
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.deprecation import MiddlewareMixin
+
+from .app_settings import mf_settings
+from .decorators import check_request
+
+POLICY_KEYS = {"factors", "user_filter", "max_age", "advertise", "user_filter_cache", "user_filter_local"}
+MATCH_KEYS = {"prefix", "regex", "view"}
+
+
+class RuleMatcher:
+    """
+    Compiled form of ``MULTIFACTOR["RULES"]``.
+
+    Prefix rules are folded into a single alternation so one regex match finds
+    the first matching prefix, however many there are. Regex rules are compiled
+    on their own, so their groups, backreferences and flags mean what they
+    would alone, and only those listed before that match are tried. View-name
+    rules are a dictionary lookup.
+    """
+
+    def __init__(self, rules):
+        self.policies = []
+        self.views = {}
+        self.regexes = []
+        patterns = []
+
+        for index, rule in enumerate(rules):
+            matchers = MATCH_KEYS & rule.keys()
+            if len(matchers) != 1:
+                raise ImproperlyConfigured(
+                    f'MULTIFACTOR["RULES"][{index}] needs exactly one of "prefix", "regex" or "view".'
+                )
+            unknown = rule.keys() - MATCH_KEYS - POLICY_KEYS
+            if unknown:
+                raise ImproperlyConfigured(f'MULTIFACTOR["RULES"][{index}] has unknown keys: {", ".join(unknown)}.')
+
+            self.policies.append({k: v for k, v in rule.items() if k in POLICY_KEYS})
+
+            if "view" in rule:
+                self.views.setdefault(rule["view"], index)
+            elif "prefix" in rule:
+                patterns.append(f"(?P<r{index}>{re.escape(rule['prefix'])})")
+            else:
+                try:
+                    self.regexes.append((index, re.compile(rule["regex"])))
+                except re.error as e:
+                    raise ImproperlyConfigured(f'MULTIFACTOR["RULES"][{index}] has an invalid regex: {e}')
+
+        self.paths = re.compile("|".join(patterns)) if patterns else None
+
+    def __bool__(self):
+        return bool(self.policies)
+
+    def match(self, path, view_name=None):
+        """Return the policy of the first rule matching this path or view name, or None."""
+        matches = []
+        if self.paths is not None:
+            m = self.paths.match(path)
+            if m:
+                matches.append(int(m.lastgroup[1:]))
+        if view_name in self.views:
+            matches.append(self.views[view_name])
+
+        first = min(matches, default=len(self.policies))
+        for index, regex in self.regexes:
+            if index >= first:
+                break
+            if regex.match(path):
+                first = index
+                break
+
+        if first == len(self.policies):
+            return None
+        return self.policies[first]
+
+
+class MultifactorMiddleware(MiddlewareMixin):
+    """
+    Enforce multifactor policies on URL prefixes, regexes and view names from ``MULTIFACTOR["RULES"]``.
+
+    Requests that don't match a rule pass straight through without touching the session or the database.
+    """
+
+    def __init__(self, get_response):
+        super().__init__(get_response)
+        self.rules = RuleMatcher(mf_settings["RULES"])
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if not self.rules:
+            return None
+
+        match = request.resolver_match
+        if match is not None and "multifactor" in match.namespaces:
+            # never gate our own views, that's a redirect loop
+            return None
+
+        policy = self.rules.match(request.path_info, match.view_name if match else None)
+        if policy is None:
+            return None
+
+        return check_request(request, **policy)
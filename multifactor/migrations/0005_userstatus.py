@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:15
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ("multifactor", "0004_alter_userkey_key_type"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UserStatus",
+            fields=[
+                (
+                    "user",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="multifactor_status",
+                        serialize=False,
+                        to=settings.AUTH_USER_MODEL,
+                    ),
+                ),
+                ("enabled_count", models.PositiveIntegerField(default=0)),
+                ("key_types", models.PositiveSmallIntegerField(default=0, help_text="Bitmask of enabled key types.")),
+                ("last_used", models.DateTimeField(blank=True, default=None, null=True)),
+            ],
+            options={
+                "verbose_name_plural": "user statuses",
+            },
+        ),
+    ]
@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("multifactor", "0005_userstatus"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="userkey",
+            name="drift",
+            field=models.SmallIntegerField(
+                default=0, help_text="TOTP: how many time steps off the authenticator's clock was when last used."
+            ),
+        ),
+    ]
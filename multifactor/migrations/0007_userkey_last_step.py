@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("multifactor", "0006_userkey_drift"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="userkey",
+            name="last_step",
+            field=models.BigIntegerField(
+                blank=True, default=None, help_text="TOTP: the time step of the last code accepted.", null=True
+            ),
+        ),
+    ]
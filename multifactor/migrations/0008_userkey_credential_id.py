@@ -0,0 +1,51 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:40
+
+from django.db import migrations, models
+from fido2.utils import websafe_decode, websafe_encode
+from fido2.webauthn import AttestedCredentialData
+
+
+def backfill_credential_ids(apps, schema_editor):
+    UserKey = apps.get_model("multifactor", "UserKey")
+
+    batch = []
+    for key in UserKey.objects.filter(key_type="FIDO2", credential_id__isnull=True).only("pk", "properties").iterator():
+        try:
+            credential_id = websafe_encode(
+                AttestedCredentialData(websafe_decode(key.properties["device"])).credential_id
+            )
+        except (KeyError, TypeError, ValueError):
+            continue
+        # longer IDs are left empty and still found the slow way
+        if len(credential_id) <= 255:
+            key.credential_id = credential_id
+            batch.append(key)
+
+        if len(batch) >= 500:
+            UserKey.objects.bulk_update(batch, ["credential_id"])
+            batch = []
+
+    UserKey.objects.bulk_update(batch, ["credential_id"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("multifactor", "0007_userkey_last_step"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="userkey",
+            name="credential_id",
+            field=models.CharField(
+                blank=True,
+                db_index=True,
+                default=None,
+                help_text="FIDO2: the websafe-base64 credential ID, if it fits.",
+                max_length=255,
+                null=True,
+            ),
+        ),
+        migrations.RunPython(backfill_credential_ids, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:43
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models.fields.json import KT
+
+
+def backfill_domains(apps, schema_editor):
+    UserKey = apps.get_model("multifactor", "UserKey")
+    UserKey.objects.filter(key_type="FIDO2", domain__isnull=True).update(domain=KT("properties__domain"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("multifactor", "0008_userkey_credential_id"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="userkey",
+            name="domain",
+            field=models.CharField(
+                blank=True,
+                default=None,
+                help_text="FIDO2: the relying party ID the key was registered for, it only works there.",
+                max_length=255,
+                null=True,
+            ),
+        ),
+        migrations.RunPython(backfill_domains, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name="userkey",
+            index=models.Index(fields=["user", "key_type", "domain", "enabled"], name="multifactor_key_domain_idx"),
+        ),
+    ]
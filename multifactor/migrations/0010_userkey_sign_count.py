@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-18 15:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("multifactor", "0009_userkey_domain"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="userkey",
+            name="sign_count",
+            field=models.BigIntegerField(
+                blank=True,
+                default=None,
+                help_text="FIDO2: the authenticator's signature counter when last used, 0 if it doesn't keep one.",
+                null=True,
+            ),
+        ),
+    ]
@@ -1,7 +1,6 @@
 from django.shortcuts import redirect
 
-from .common import active_factors, is_bypassed
-from .models import UserKey
+from .common import get_state
 
 
 class MultiFactorMixin:
@@ -13,10 +12,11 @@ class MultiFactorMixin:
         if not request.user.is_authenticated:
             return
 
-        self.active_factors = active_factors(request)
-        self.factors = UserKey.objects.filter(user=request.user)
-        self.has_multifactor = self.factors.filter(enabled=True).exists()
-        self.bypass = is_bypassed(request)
+        state = get_state(request)
+        self.active_factors = state.active_factors
+        self.factors = state.factors
+        self.has_multifactor = state.has_multifactor
+        self.bypass = state.bypassed
 
 
 class RequireMultiAuthMixin(MultiFactorMixin):
@@ -42,3 +42,54 @@ class PreferMultiAuthMixin(MultiFactorMixin):
             return redirect("multifactor:authenticate")
 
         return super().dispatch(request, *args, **kwargs)
+
+
+class AsyncMultiFactorMixin:
+    """
+    Async version of MultiFactorMixin, for views with ``async def`` handlers.
+
+    The state is loaded at the start of ``dispatch`` with async ORM and session calls
+    and exposed with the same attributes as MultiFactorMixin.
+    """
+
+    async def load_multifactor(self, request):
+        state = get_state(request)
+        user = await state.auser()
+        if not user.is_authenticated:
+            return False
+
+        self.active_factors = await state.aactive_factors()
+        self.factors = state.factors
+        self.has_multifactor = await state.ahas_multifactor()
+        self.bypass = await state.abypassed()
+        return True
+
+    async def dispatch(self, request, *args, **kwargs):
+        await self.load_multifactor(request)
+        return await super().dispatch(request, *args, **kwargs)
+
+
+class AsyncRequireMultiAuthMixin(AsyncMultiFactorMixin):
+    """Async version of RequireMultiAuthMixin."""
+
+    async def dispatch(self, request, *args, **kwargs):
+        if await self.load_multifactor(request) and not self.active_factors and not self.bypass:
+            await request.session.aset("multifactor-next", request.get_full_path())
+            if self.has_multifactor:
+                return redirect("multifactor:authenticate")
+
+            return redirect("multifactor:add")
+
+        return await super(AsyncMultiFactorMixin, self).dispatch(request, *args, **kwargs)
+
+
+class AsyncPreferMultiAuthMixin(AsyncMultiFactorMixin):
+    """Async version of PreferMultiAuthMixin."""
+
+    async def dispatch(self, request, *args, **kwargs):
+        loaded = await self.load_multifactor(request)
+        if loaded and not self.active_factors and not self.bypass and self.has_multifactor:
+            await request.session.aset("multifactor-next", request.get_full_path())
+            return redirect("multifactor:authenticate")
+
+        return await super(AsyncMultiFactorMixin, self).dispatch(request, *args, **kwargs)
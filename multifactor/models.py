@@ -1,5 +1,7 @@
 from django.conf import settings
-from django.db import models
+from django.contrib.auth import get_user_model
+from django.db import connections, models, transaction
+from django.db.models import Case, Count, Max, Q, Value, When
 from django.utils.translation import gettext_lazy as _
 
 try:
@@ -16,6 +18,30 @@ class KeyTypes(models.TextChoices):
 # keys that can only be used on one domain
 DOMAIN_KEYS = KeyTypes.FIDO2
 
+# what the key cache and UserStatus are built from, updates to anything else don't invalidate them
+TRACKED_FIELDS = {"user", "user_id", "key_type", "enabled", "last_used"}
+
+# UserStatus.key_types bits, never renumber these
+KEY_TYPE_BITS = {KeyTypes.FIDO2: 1, KeyTypes.TOTP: 2}
+
+
+class UserKeyQuerySet(models.QuerySet):
+    def update(self, **kwargs):
+        from .app_settings import mf_settings
+        from .cache import forget_keys, get_cache, holding_keys, invalidate_user_keys
+
+        # update() skips signals, so invalidate cached key data explicitly
+        tracked = (get_cache() is not None or mf_settings["STATUS_TABLE"]) and TRACKED_FIELDS & kwargs.keys()
+        user_ids = set(self.values_list("user_id", flat=True)) if tracked else ()
+        forgetting = holding_keys() and {"properties", "enabled"} & kwargs.keys()
+        key_ids = set(self.values_list("pk", flat=True)) if forgetting else ()
+        rows = super().update(**kwargs)
+        invalidate_user_keys(*user_ids)
+        forget_keys(*key_ids)
+        if user_ids and mf_settings["STATUS_TABLE"]:
+            UserStatus.objects.rebuild(user_ids)
+        return rows
+
 
 class UserKey(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, models.CASCADE, related_name="multifactor_keys")
@@ -32,6 +58,41 @@ class UserKey(models.Model):
     added_on = models.DateTimeField(auto_now_add=True)
     expires = models.DateTimeField(null=True, default=None, blank=True)
     last_used = models.DateTimeField(null=True, default=None, blank=True)
+    drift = models.SmallIntegerField(
+        default=0, help_text=_("TOTP: how many time steps off the authenticator's clock was when last used.")
+    )
+    last_step = models.BigIntegerField(
+        null=True, default=None, blank=True, help_text=_("TOTP: the time step of the last code accepted.")
+    )
+    domain = models.CharField(
+        max_length=255,
+        null=True,
+        default=None,
+        blank=True,
+        help_text=_("FIDO2: the relying party ID the key was registered for, it only works there."),
+    )
+    credential_id = models.CharField(
+        max_length=255,
+        null=True,
+        default=None,
+        blank=True,
+        db_index=True,
+        help_text=_("FIDO2: the websafe-base64 credential ID, if it fits."),
+    )
+    sign_count = models.BigIntegerField(
+        null=True,
+        default=None,
+        blank=True,
+        help_text=_("FIDO2: the authenticator's signature counter when last used, 0 if it doesn't keep one."),
+    )
+
+    objects = UserKeyQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # a user's usable keys on one host
+            models.Index(fields=["user", "key_type", "domain", "enabled"], name="multifactor_key_domain_idx"),
+        ]
 
     def __str__(self):
         if self.name:
@@ -53,9 +114,17 @@ class UserKey(models.Model):
     @property
     def device(self):
         if self.key_type == KeyTypes.FIDO2:
-            return self.properties.get("type", "----")
+            # the authenticator model, when the FIDO metadata index knew it at registration
+            return self.properties.get("model") or self.properties.get("type", "----")
         return ""
 
+    @property
+    def certification(self):
+        """FIDO2: the model's FIDO certification status at registration, eg ``"FIDO_CERTIFIED_L1"``."""
+        if self.key_type == KeyTypes.FIDO2:
+            return self.properties.get("certification")
+        return None
+
     @property
     def auth_url(self):
         from .common import method_url
@@ -66,3 +135,76 @@ class UserKey(models.Model):
 class DisabledFallback(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, models.CASCADE, related_name="+")
     fallback = models.CharField(max_length=50)
+
+
+class UserStatusManager(models.Manager):
+    def rebuild(self, user_ids=None, *, create=True):
+        """
+        Recalculate rows from ``UserKey`` for these users, or everyone if ``user_ids`` is None.
+
+        Users without keys get a row with ``enabled_count=0``, so a missing row only means it hasn't been
+        built yet. With ``create=False`` only users with keys are added, as the key signals do: a key can
+        be deleted along with its user. Rows are upserted rather than replaced, so two requests rebuilding
+        the same user at once (two logins, say) can't both insert it.
+        """
+        keys = UserKey.objects.all() if user_ids is None else UserKey.objects.filter(user_id__in=user_ids)
+        # one bit per enabled key type, summed in the database
+        key_types = Value(0)
+        for key_type, bit in KEY_TYPE_BITS.items():
+            key_types += Max(Case(When(enabled=True, key_type=key_type, then=Value(bit)), default=Value(0)))
+
+        rows = keys.values("user_id").annotate(
+            enabled_count=Count("pk", filter=Q(enabled=True)),
+            key_types=key_types,
+            last_used=Max("last_used"),
+        )
+
+        with transaction.atomic(using=self.db):
+            stale = self.all() if user_ids is None else self.filter(user_id__in=user_ids)
+            stale.exclude(user_id__in=keys.values("user_id")).update(enabled_count=0, key_types=0, last_used=None)
+            self.bulk_create(
+                [self.model(**row) for row in rows.order_by()],
+                update_conflicts=True,
+                # MySQL finds the conflict itself and won't be told
+                unique_fields=["user"] if connections[self.db].features.supports_update_conflicts_with_target else None,
+                update_fields=["enabled_count", "key_types", "last_used"],
+            )
+            if create:
+                users = get_user_model().objects.all()
+                if user_ids is not None:
+                    users = users.filter(pk__in=user_ids)
+                missing = users.filter(multifactor_status__isnull=True).values_list("pk", flat=True)
+                self.bulk_create([self.model(user_id=pk) for pk in missing], batch_size=1000, ignore_conflicts=True)
+
+
+class UserStatus(models.Model):
+    """
+    One row per user summarising their keys, so MFA status doesn't need a ``UserKey`` query.
+
+    Only maintained when ``MULTIFACTOR["STATUS_TABLE"]`` is on. Users without keys have a row with
+    ``enabled_count=0``. A missing row means "not built yet", not "no keys", and readers fall back to
+    ``UserKey``.
+    """
+
+    user = models.OneToOneField(
+        settings.AUTH_USER_MODEL, models.CASCADE, primary_key=True, related_name="multifactor_status"
+    )
+    enabled_count = models.PositiveIntegerField(default=0)
+    key_types = models.PositiveSmallIntegerField(default=0, help_text=_("Bitmask of enabled key types."))
+    last_used = models.DateTimeField(null=True, default=None, blank=True)
+
+    objects = UserStatusManager()
+
+    class Meta:
+        verbose_name_plural = _("user statuses")
+
+    def __str__(self):
+        return str(self.user)
+
+    @property
+    def has_multifactor(self):
+        return self.enabled_count > 0
+
+    @property
+    def enabled_types(self):
+        return [key_type for key_type, bit in KEY_TYPE_BITS.items() if self.key_types & bit]
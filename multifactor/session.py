@@ -0,0 +1,98 @@
+"""
+Reading and writing the verified factors kept in ``request.session["multifactor"]``.
+
+Two encodings are read:
+
+* the original list of ``(key_type, key_id, verified_at, recheck)`` tuples, and
+* a compact string, written when ``MULTIFACTOR["COMPACT_SESSION"]`` is on: a
+  version prefix and the factors packed as fixed-width binary records, with
+  integer key type codes and whole epoch seconds, base64 encoded.
+
+Everything else should go through ``load``/``dump`` (or the session helpers)
+rather than reading the raw value.
+"""
+
+import base64
+import binascii
+import struct
+from collections import namedtuple
+
+from .app_settings import mf_settings
+
+SESSION_KEY = "multifactor"
+
+Factor = namedtuple("Factor", ["key_type", "key_id", "verified_at", "recheck"])
+
+# never renumber these, they're stored in sessions
+KEY_TYPE_CODES = {None: 0, "FIDO2": 1, "TOTP": 2}
+KEY_TYPES = {code: key_type for key_type, code in KEY_TYPE_CODES.items()}
+
+VERSION = "1"
+# key type code, key id, verified at, recheck (0 for none)
+RECORD = struct.Struct(">BIII")
+
+
+def _pack(factors):
+    data = b"".join(
+        RECORD.pack(
+            KEY_TYPE_CODES[f.key_type],
+            f.key_id or 0,
+            int(f.verified_at),
+            int(f.recheck) if f.recheck else 0,
+        )
+        for f in factors
+    )
+    return f"{VERSION}:{base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')}"
+
+
+def _unpack(value):
+    version, _, payload = value.partition(":")
+    if version != VERSION:
+        return []
+
+    try:
+        data = base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4))
+    except (binascii.Error, ValueError):
+        return []
+    if len(data) % RECORD.size:
+        return []
+
+    factors = []
+    for code, key_id, verified_at, recheck in RECORD.iter_unpack(data):
+        if code not in KEY_TYPES:
+            return []
+        factors.append(Factor(KEY_TYPES[code], key_id or None, verified_at, recheck or False))
+    return factors
+
+
+def load(value):
+    """Decode a stored session value, in either encoding, into a list of ``Factor``."""
+    if not value:
+        return []
+    if isinstance(value, str):
+        # an unknown version or a damaged value just means nothing is verified
+        return _unpack(value)
+    return [Factor(*factor) for factor in value]
+
+
+def dump(factors):
+    """Encode factors for the session, compactly if ``MULTIFACTOR["COMPACT_SESSION"]`` is on."""
+    if mf_settings["COMPACT_SESSION"]:
+        return _pack(factors)
+    return [tuple(factor) for factor in factors]
+
+
+def get_factors(session):
+    return load(session.get(SESSION_KEY))
+
+
+def set_factors(session, factors):
+    session[SESSION_KEY] = dump(factors)
+
+
+async def aget_factors(session):
+    return load(await session.aget(SESSION_KEY))
+
+
+async def aset_factors(session, factors):
+    await session.aset(SESSION_KEY, dump(factors))
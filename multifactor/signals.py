@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+
+from .app_settings import mf_settings
+from .cache import forget_keys, invalidate_user_filters, invalidate_user_keys
+from .models import UserKey, UserStatus
+
+
+@receiver(post_save, sender=UserKey)
+@receiver(post_delete, sender=UserKey)
+def userkey_changed(sender, instance, update_fields=None, **kwargs):
+    invalidate_user_keys(instance.user_id)
+    # write_session saves last_used on every login, that doesn't change the key material
+    if not update_fields or {"properties", "enabled"} & update_fields:
+        forget_keys(instance.pk)
+    if mf_settings["STATUS_TABLE"]:
+        UserStatus.objects.rebuild([instance.user_id], create=False)
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def user_changed(sender, instance, created=False, **kwargs):
+    invalidate_user_filters(instance.pk)
+    if created and mf_settings["STATUS_TABLE"]:
+        # so users without keys are answered from the table too
+        UserStatus.objects.bulk_create([UserStatus(user_id=instance.pk)], ignore_conflicts=True)
+
+
+@receiver(m2m_changed)
+def user_relations_changed(sender, instance, action, reverse, model, pk_set, **kwargs):
+    if not action.startswith("post_"):
+        return
+
+    user_model = get_user_model()
+    if isinstance(instance, user_model):
+        invalidate_user_filters(instance.pk)
+    elif model is user_model and pk_set:
+        # eg group.user_set.add(...)
+        invalidate_user_filters(*pk_set)
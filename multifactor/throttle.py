@@ -0,0 +1,90 @@
+"""
+Limits on failed verification attempts, kept in the Django cache so every worker shares them.
+
+``MULTIFACTOR["THROTTLE"]`` maps a factor (``"TOTP"``, ``"FIDO2"``, ``"FALLBACK"``) to
+``(attempts, seconds)``. Failures are counted per user and per client IP in a sliding window
+(two fixed buckets, the older one weighted by how much of it is still in the window). Reaching the
+limit locks that user or IP out of the factor for ``seconds``, doubling with each lockout since the
+last success, up to ``MULTIFACTOR["THROTTLE_MAX_LOCKOUT"]``.
+
+Views call ``check()`` before doing any work, ``record()`` when an attempt fails and ``clear()``
+when one succeeds.
+"""
+
+import math
+import time
+
+from django.utils.translation import gettext as _
+
+from .app_settings import mf_settings
+from .cache import VERSION, shared_cache
+
+FACTORS = ("FIDO2", "TOTP", "FALLBACK")
+
+
+def _scopes(request):
+    scopes = [f"ip:{request.META.get('REMOTE_ADDR', '')}"]
+    # passkey logins are anonymous until they succeed
+    if request.user.is_authenticated:
+        scopes.insert(0, f"user:{request.user.pk}")
+    return scopes
+
+
+def _key(factor, scope, part):
+    return f"multifactor:throttle:v{VERSION}:{factor}:{scope}:{part}"
+
+
+def check(request, factor):
+    """Seconds until ``factor`` can be tried again by this user and IP, or 0 if it can be now."""
+    if factor not in mf_settings["THROTTLE"]:
+        return 0
+
+    locks = shared_cache().get_many([_key(factor, scope, "lock") for scope in _scopes(request)])
+    # locks hold the time they expire, the cache may keep them a moment longer
+    return max([math.ceil(until - time.time()) for until in locks.values()] + [0])
+
+
+def record(request, factor):
+    """
+    Count a failed attempt at ``factor``, locking it out if that reaches the limit.
+
+    Returns the seconds until it can be tried again, like ``check()``.
+    """
+    if factor not in mf_settings["THROTTLE"]:
+        return 0
+    attempts, window = mf_settings["THROTTLE"][factor]
+
+    cache = shared_cache()
+    bucket, elapsed = divmod(time.time(), window)
+    wait = 0
+
+    for scope in _scopes(request):
+        current, previous = _key(factor, scope, int(bucket)), _key(factor, scope, int(bucket) - 1)
+        cache.add(current, 0, window * 2)
+        count = cache.incr(current) + (cache.get(previous) or 0) * (1 - elapsed / window)
+        if count < attempts:
+            continue
+
+        strikes = _key(factor, scope, "strikes")
+        cache.add(strikes, 0, mf_settings["THROTTLE_MAX_LOCKOUT"] * 2)
+        lockout = min(window * 2 ** (cache.incr(strikes) - 1), mf_settings["THROTTLE_MAX_LOCKOUT"])
+        cache.set(_key(factor, scope, "lock"), time.time() + lockout, lockout)
+        # start counting afresh once the lockout ends
+        cache.delete_many([current, previous])
+        wait = max(wait, lockout)
+
+    return wait
+
+
+def clear(request, factor):
+    """Forget this user's failures at ``factor`` after a success. The IP's are kept."""
+    if factor not in mf_settings["THROTTLE"]:
+        return
+    window = mf_settings["THROTTLE"][factor][1]
+    bucket = int(time.time() // window)
+    scope = f"user:{request.user.pk}"
+    shared_cache().delete_many([_key(factor, scope, part) for part in (bucket, bucket - 1, "strikes")])
+
+
+def message(wait):
+    return _("Too many attempts. Please try again in %(seconds)s seconds.") % {"seconds": wait}
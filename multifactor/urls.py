@@ -17,6 +17,8 @@ urlpatterns = [
     path("fido2/auth/", TemplateView.as_view(template_name="multifactor/FIDO2/check.html"), name="fido2_auth"),
     path("fido2/register/", fido2.Register.as_view(), name="fido2_register"),
     path("fido2/authenticate/", fido2.Authenticate.as_view(), name="fido2_authenticate"),
+    path("fido2/login/", fido2.LoginPage.as_view(), name="fido2_login"),
+    path("fido2/passkey/", fido2.Login.as_view(), name="fido2_passkey"),
     path("totp/new/", totp.Create.as_view(), name="totp_start"),
     path("totp/auth/", totp.Auth.as_view(), name="totp_auth"),
     path("fallback/auth/", fallback.Auth.as_view(), name="fallback_auth"),
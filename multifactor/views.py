@@ -11,7 +11,8 @@ from django.utils.translation import ngettext
 from django.views.generic import TemplateView, UpdateView
 
 from .app_settings import mf_settings
-from .common import disabled_fallbacks, method_url
+from .common import get_state, method_url
+from .factors.fido2 import resolve_rp
 from .mixins import MultiFactorMixin, PreferMultiAuthMixin, RequireMultiAuthMixin
 from .models import DOMAIN_KEYS, DisabledFallback, KeyTypes, UserKey
 
@@ -35,7 +36,7 @@ class List(LoginRequiredMixin, RequireMultiAuthMixin, TemplateView):
                 ),
             )
 
-        disabled = disabled_fallbacks(self.request)
+        disabled = get_state(self.request).disabled_fallbacks
         available_fallbacks = [
             (k, k not in disabled, v[0](self.request.user))
             for k, v in mf_settings["FALLBACKS"].items()
@@ -136,21 +137,21 @@ class Authenticate(LoginRequiredMixin, MultiFactorMixin, TemplateView):
     def get(self, request, *args, **kwargs):
         self.available_methods = defaultdict(list)
         other_domains = set()
+        rp_id = resolve_rp(request.get_host())[0]
 
         for factor in self.factors:
             if factor.key_type in DOMAIN_KEYS:
-                domain = factor.properties.get("domain", "")
-                if not domain:
+                if not factor.domain:
                     continue
-                if domain != self.request.get_host().split(":")[0]:
-                    other_domains.add(domain)
+                if factor.domain != rp_id:
+                    other_domains.add(factor.domain)
                     continue
             self.available_methods[factor.key_type].append(factor)
 
         if not other_domains and not self.available_methods:
             return redirect("multifactor:add")
 
-        disabled_fbs = disabled_fallbacks(self.request)
+        disabled_fbs = get_state(self.request).disabled_fallbacks
         self.available_fallbacks = [
             k for k, v in mf_settings["FALLBACKS"].items() if k not in disabled_fbs and v[0](self.request.user)
         ]
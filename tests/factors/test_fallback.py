@@ -1,6 +1,7 @@
-from unittest.mock import patch
+from unittest.mock import MagicMock, patch
 
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.http import HttpResponse
 from django.test import TestCase, override_settings
 
@@ -23,18 +24,34 @@ class FallbackTests(TestCase):
         )
         self.client.force_login(self.user)
 
-    @patch("multifactor.factors.fallback.import_string")
-    @patch("multifactor.factors.fallback.disabled_fallbacks", return_value=[])
-    def test_get_generates_otp_and_calls_transports(self, disabled_fallbacks, import_string):
-        transport = lambda user, message: "email"
-        import_string.return_value = transport
-
+    @override_settings(MULTIFACTOR={"FALLBACKS": {"email": (lambda user: user.email, lambda user, message: "email")}})
+    @patch("multifactor.common.disabled_fallbacks", return_value=[])
+    def test_get_generates_otp_and_calls_transports(self, disabled_fallbacks):
         response = self.client.get("/admin/multifactor/fallback/auth/")
 
         self.assertEqual(response.status_code, 200)
         self.assertIn(SESSION_KEY, self.client.session)
         self.assertIn(SESSION_KEY_SUCCEEDED, self.client.session)
 
+    @patch("multifactor.common.disabled_fallbacks", return_value=[])
+    def test_sending_is_throttled(self, disabled_fallbacks):
+        transport = MagicMock(return_value="email")
+        cache.clear()
+
+        with override_settings(
+            CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+            MULTIFACTOR={
+                "FALLBACKS": {"email": (lambda user: user.email, transport)},
+                "THROTTLE": {"FALLBACK": (2, 60)},
+            },
+        ):
+            self.client.get("/admin/multifactor/fallback/auth/")
+            self.client.get("/admin/multifactor/fallback/auth/")
+            response = self.client.get("/admin/multifactor/fallback/auth/")
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(transport.call_count, 2)
+
     def test_post_with_matching_otp_logs_in(self):
         session = self.client.session
         session[SESSION_KEY] = "123456"
@@ -68,7 +85,6 @@ class FallbackTests(TestCase):
         self.assertEqual(DisabledFallback.objects.filter(user=self.user).count(), 1)
 
     @override_settings(SERVER_EMAIL="noreply@example.com", MULTIFACTOR={"HTML_EMAIL": False})
-    @patch("multifactor.factors.fallback.mf_settings", {"HTML_EMAIL": False})
     @patch("multifactor.factors.fallback.EmailMultiAlternatives")
     def test_send_email_plain_text_only(self, email_cls):
         email = email_cls.return_value
@@ -96,8 +112,11 @@ class FallbackTests(TestCase):
         view = Auth()
         view.setup(request)
 
-        with patch("multifactor.factors.fallback.disabled_fallbacks", return_value=[]), patch(
-            "multifactor.factors.fallback.import_string", side_effect=Exception("bad transport")
+        def transport(user, message):
+            raise Exception("bad transport")
+
+        with patch("multifactor.common.disabled_fallbacks", return_value=[]), override_settings(
+            MULTIFACTOR={"FALLBACKS": {"email": (lambda user: user.email, transport)}}
         ), patch("multifactor.factors.fallback.messages.error") as msg_error:
             response = view.get(request)
 
@@ -113,8 +132,8 @@ class FallbackTests(TestCase):
         view = Auth()
         view.setup(request)
 
-        with patch("multifactor.factors.fallback.disabled_fallbacks", return_value=[]), patch(
-            "multifactor.factors.fallback.mf_settings", {"FALLBACKS": {}}
+        with patch("multifactor.common.disabled_fallbacks", return_value=[]), override_settings(
+            MULTIFACTOR={"FALLBACKS": {}}
         ), patch("multifactor.factors.fallback.messages.error") as msg_error:
             response = view.get(request)
 
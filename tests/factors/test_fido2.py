@@ -1,13 +1,46 @@
 import json
+from importlib import import_module
 from types import SimpleNamespace
-from unittest.mock import MagicMock, patch
+from unittest.mock import MagicMock, call, patch
 
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
 from django.http import HttpResponse
-from django.test import TestCase, override_settings
+from django.test import (
+    Client,
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
+from fido2.cose import ES256
+from fido2.utils import sha256, websafe_decode, websafe_encode
+from fido2.webauthn import (
+    AttestedCredentialData,
+    AuthenticatorData,
+    CollectedClientData,
+)
 
+from multifactor.cache import decoded_credentials
+from multifactor.factors import fido2 as fido2_module
+from multifactor.factors.fido2 import (
+    Authenticate,
+    FidoClass,
+    _servers,
+    get_server,
+    pop_state,
+    resolve_rp,
+    save_state,
+)
 from multifactor.models import KeyTypes, UserKey
+from multifactor.session import get_factors
 
 
 @override_settings(
@@ -25,16 +58,15 @@ class Fido2Tests(TestCase):
             password="password123",
         )
         self.client.force_login(self.user)
+        # so patched Fido2Server and AttestedCredentialData classes are used
+        _servers.clear()
+        decoded_credentials.clear()
 
     @patch("multifactor.factors.fido2.Fido2Server")
     def test_server_property_uses_settings(self, server_cls):
         import multifactor.factors.fido2 as fido2_module
 
-        with patch.dict(
-            fido2_module.mf_settings,
-            {"FIDO_SERVER_ID": "example.com", "FIDO_SERVER_NAME": "Django App"},
-            clear=False,
-        ):
+        with override_settings(MULTIFACTOR={"FIDO_SERVER_ID": "example.com", "FIDO_SERVER_NAME": "Django App"}):
             view = fido2_module.FidoClass()
             _ = view.server
 
@@ -43,6 +75,20 @@ class Fido2Tests(TestCase):
         self.assertEqual(kwargs["rp"]["id"], "example.com")
         self.assertEqual(kwargs["rp"]["name"], "Django App")
 
+    def test_servers_are_reused_per_relying_party(self):
+        server = FidoClass().server
+
+        self.assertIs(FidoClass().server, server)
+        self.assertIs(get_server("example.com", "Django App"), server)
+        self.assertIsNot(get_server("example.org", "Django App"), server)
+
+    def test_servers_are_reset_when_settings_change(self):
+        server = FidoClass().server
+
+        with override_settings(MULTIFACTOR={"FIDO_SERVER_ID": "example.com", "FIDO_SERVER_NAME": "Django App"}):
+            self.assertEqual(_servers, {})
+            self.assertIsNot(FidoClass().server, server)
+
     def test_get_user_credentials_returns_empty_for_anonymous(self):
         from multifactor.factors.fido2 import FidoClass
 
@@ -61,6 +107,7 @@ class Fido2Tests(TestCase):
             key_type=KeyTypes.FIDO2,
             enabled=True,
             properties={"device": "abc", "domain": "example.com"},
+            domain="example.com",
         )
 
         view = FidoClass()
@@ -93,7 +140,8 @@ class Fido2Tests(TestCase):
     def test_register_post_success(self, server_cls, websafe_encode):
         server = MagicMock()
         auth_data = MagicMock()
-        auth_data.credential_data = b"cred-data"
+        auth_data.credential_data = MagicMock(credential_id=b"cred-id")
+        auth_data.counter = 3
         server.register_complete.return_value = auth_data
         server.rp = SimpleNamespace(id="example.com")
         server_cls.return_value = server
@@ -121,7 +169,49 @@ class Fido2Tests(TestCase):
         self.assertTrue(UserKey.objects.filter(user=self.user, key_type=KeyTypes.FIDO2).exists())
         write_session.assert_called_once()
         msg_success.assert_called_once()
-        websafe_encode.assert_called_once_with(b"cred-data")
+        self.assertEqual(websafe_encode.call_args_list, [call(b"cred-id"), call(auth_data.credential_data)])
+        self.assertEqual(UserKey.objects.get(user=self.user).credential_id, "encoded-device")
+        self.assertEqual(UserKey.objects.get(user=self.user).domain, "example.com")
+        self.assertEqual(UserKey.objects.get(user=self.user).sign_count, 3)
+
+    @patch("multifactor.factors.fido2.metadata.lookup", return_value=("YubiKey 5", "FIDO_CERTIFIED_L1"))
+    @patch("multifactor.factors.fido2.websafe_encode", return_value="encoded-device")
+    @patch("multifactor.factors.fido2.Fido2Server")
+    def test_register_post_names_the_model(self, server_cls, websafe_encode, lookup):
+        server_cls.return_value.register_complete.return_value = MagicMock(counter=0)
+        server_cls.return_value.rp = SimpleNamespace(id="example.com")
+        session = self.client.session
+        session["fido_state"] = {"state": "xyz"}
+        session.save()
+
+        self.client.post(
+            reverse("multifactor:fido2_register"),
+            data=json.dumps({"type": "public-key"}),
+            content_type="application/json",
+        )
+
+        key = UserKey.objects.get(user=self.user)
+        lookup.assert_called_once_with(server_cls.return_value.register_complete.return_value.credential_data.aaguid)
+        self.assertEqual((key.device, key.certification), ("YubiKey 5", "FIDO_CERTIFIED_L1"))
+
+    @patch("multifactor.factors.fido2.websafe_encode", return_value="encoded-device")
+    @patch("multifactor.factors.fido2.Fido2Server")
+    def test_register_post_rejects_a_registered_credential(self, server_cls, websafe_encode):
+        server_cls.return_value.rp = SimpleNamespace(id="example.com")
+        other = get_user_model().objects.create_user(username="bob")
+        UserKey.objects.create(user=other, key_type=KeyTypes.FIDO2, properties={}, credential_id="encoded-device")
+        session = self.client.session
+        session["fido_state"] = {"state": "xyz"}
+        session.save()
+
+        response = self.client.post(
+            reverse("multifactor:fido2_register"),
+            data=json.dumps({"type": "public-key"}),
+            content_type="application/json",
+        )
+
+        self.assertEqual(response.json()["status"], "ERR")
+        self.assertFalse(UserKey.objects.filter(user=self.user).exists())
 
     @patch("multifactor.factors.fido2.Fido2Server")
     def test_register_post_failure(self, server_cls):
@@ -142,8 +232,10 @@ class Fido2Tests(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json()["status"], "ERR")
 
+    @patch("multifactor.factors.fido2.websafe_decode", return_value=b"decoded")
+    @patch("multifactor.factors.fido2.AttestedCredentialData")
     @patch("multifactor.factors.fido2.Fido2Server")
-    def test_authenticate_get_returns_json(self, server_cls):
+    def test_authenticate_get_returns_json(self, server_cls, attested_cls, websafe_decode):
         server = MagicMock()
         server.authenticate_begin.return_value = ({"challenge": "abc"}, {"state": "xyz"})
         server_cls.return_value = server
@@ -153,6 +245,7 @@ class Fido2Tests(TestCase):
             key_type=KeyTypes.FIDO2,
             enabled=True,
             properties={"device": "abc", "domain": "example.com"},
+            domain="example.com",
         )
 
         response = self.client.get(reverse("multifactor:fido2_authenticate"))
@@ -162,10 +255,11 @@ class Fido2Tests(TestCase):
         self.assertEqual(payload["challenge"], "abc")
         self.assertIn("fido_state", self.client.session)
 
+    @patch("multifactor.factors.fido2.sign_count", return_value=0)
     @patch("multifactor.factors.fido2.websafe_decode", return_value=b"decoded")
     @patch("multifactor.factors.fido2.AttestedCredentialData")
     @patch("multifactor.factors.fido2.Fido2Server")
-    def test_authenticate_post_success(self, server_cls, attested_cls, websafe_decode):
+    def test_authenticate_post_success(self, server_cls, attested_cls, websafe_decode, sign_count):
         server = MagicMock()
         cred = MagicMock()
         cred.credential_id = b"cred-id"
@@ -181,6 +275,7 @@ class Fido2Tests(TestCase):
             key_type=KeyTypes.FIDO2,
             enabled=True,
             properties={"device": "abc", "domain": "example.com"},
+            domain="example.com",
         )
 
         session = self.client.session
@@ -229,6 +324,7 @@ class Fido2Tests(TestCase):
             key_type=KeyTypes.FIDO2,
             enabled=True,
             properties={"device": "abc", "domain": "example.com"},
+            domain="example.com",
         )
 
         response = self.client.post(
@@ -239,3 +335,476 @@ class Fido2Tests(TestCase):
 
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json()["status"], "err")
+
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+        MULTIFACTOR={"THROTTLE": {"FIDO2": (1, 60)}},
+    )
+    @patch("multifactor.factors.fido2.Fido2Server")
+    def test_authenticate_post_throttled(self, server_cls):
+        server_cls.return_value.authenticate_complete.side_effect = ValueError("bad signature")
+        cache.clear()
+        session = self.client.session
+        session["fido_state"] = {"state": "xyz"}
+        session.save()
+
+        with self.assertLogs("multifactor.factors.fido2", "INFO"):
+            response = self.client.post(
+                reverse("multifactor:fido2_authenticate"), data="{}", content_type="application/json"
+            )
+        self.assertEqual(response.json()["status"], "err")
+        response = self.client.post(
+            reverse("multifactor:fido2_authenticate"), data="{}", content_type="application/json"
+        )
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.json()["status"], "err")
+        self.assertIn("Too many attempts", response.json()["message"])
+        server_cls.return_value.authenticate_complete.assert_called_once()
+
+    def test_find_key_uses_the_credential_id_column(self):
+        key = UserKey.objects.create(
+            user=self.user,
+            key_type=KeyTypes.FIDO2,
+            properties={"device": "not decodable", "domain": "example.com"},
+            domain="example.com",
+            credential_id="Y3JlZC1pZA",
+        )
+        view = Authenticate()
+        view.request = SimpleNamespace(user=self.user)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(view.find_key(b"cred-id"), key)
+
+    @patch("multifactor.factors.fido2.sign_count", return_value=0)
+    @patch("multifactor.factors.fido2.websafe_decode", return_value=b"decoded")
+    @patch("multifactor.factors.fido2.AttestedCredentialData")
+    @patch("multifactor.factors.fido2.Fido2Server")
+    def test_authenticate_post_only_checks_the_named_credential(
+        self, server_cls, attested_cls, websafe_decode, sign_count
+    ):
+        server_cls.return_value.authenticate_complete.return_value = MagicMock(credential_id=b"cred-id")
+        for credential_id in ["b3RoZXI", "Y3JlZC1pZA"]:
+            UserKey.objects.create(
+                user=self.user,
+                key_type=KeyTypes.FIDO2,
+                properties={"device": credential_id, "domain": "example.com"},
+                domain="example.com",
+                credential_id=credential_id,
+            )
+        session = self.client.session
+        session["fido_state"] = {"state": "xyz"}
+        session.save()
+
+        with patch("multifactor.factors.fido2.login", return_value=HttpResponse(headers={"Location": "/"})):
+            response = self.client.post(
+                reverse("multifactor:fido2_authenticate"),
+                data=json.dumps({"id": "Y3JlZC1pZA", "type": "public-key"}),
+                content_type="application/json",
+            )
+
+        self.assertEqual(response.json()["status"], "OK")
+        websafe_decode.assert_called_once_with("Y3JlZC1pZA")
+
+
+@override_settings(CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}})
+class StateStoreTests(SimpleTestCase):
+    def setUp(self):
+        cache.clear()
+
+    def _request(self, pk=1):
+        request = RequestFactory().get("/")
+        request.user = SimpleNamespace(pk=pk)
+        request.session = {}
+        return request
+
+    def test_stores(self):
+        state = {"challenge": "abc", "user_verification": None}
+        for store in ["session", "cache", "signed"]:
+            with self.subTest(store), override_settings(MULTIFACTOR={"FIDO_STATE_STORE": store}):
+                request = self._request()
+                data = {"id": "x", **save_state(request, state)}
+
+                self.assertEqual(pop_state(request, dict(data)), state)
+                self.assertIsNone(pop_state(request, dict(data)))
+
+    def test_ceremonies_are_kept_apart(self):
+        for store in ["cache", "signed"]:
+            with self.subTest(store), override_settings(MULTIFACTOR={"FIDO_STATE_STORE": store}):
+                request = self._request()
+                first, second = save_state(request, {"challenge": "1"}), save_state(request, {"challenge": "2"})
+
+                self.assertNotIn("fido_state", request.session)
+                self.assertEqual(pop_state(request, second), {"challenge": "2"})
+                self.assertEqual(pop_state(request, first), {"challenge": "1"})
+
+    def test_only_for_whoever_started_it(self):
+        for store in ["cache", "signed"]:
+            with self.subTest(store), override_settings(MULTIFACTOR={"FIDO_STATE_STORE": store}):
+                data = save_state(self._request(pk=1), {"challenge": "abc"})
+
+                self.assertIsNone(pop_state(self._request(pk=2), data))
+
+    @override_settings(MULTIFACTOR={"FIDO_STATE_STORE": "signed"})
+    def test_signed_states_expire_and_cannot_be_forged(self):
+        ceremony = save_state(self._request(), {"challenge": "abc"})["ceremony"]
+
+        self.assertIsNone(pop_state(self._request(), {"ceremony": ceremony[:-2] + "xx"}))
+        with override_settings(MULTIFACTOR={"FIDO_STATE_STORE": "signed", "FIDO_STATE_TIMEOUT": -1}):
+            self.assertIsNone(pop_state(self._request(), {"ceremony": ceremony}))
+
+    @override_settings(MULTIFACTOR={"FIDO_STATE_STORE": "cache"})
+    def test_the_ceremony_is_taken_out_of_the_response(self):
+        data = {"id": "x", **save_state(self._request(), {"challenge": "abc"})}
+
+        pop_state(self._request(), data)
+
+        self.assertEqual(data, {"id": "x"})
+
+
+class SignCountTests(TestCase):
+    def setUp(self):
+        user = get_user_model().objects.create_user(username="alice", password="password123")
+        self.key = UserKey.objects.create(user=user, key_type=KeyTypes.FIDO2, properties={})
+
+    def test_only_goes_up(self):
+        self.assertTrue(fido2_module.update_sign_count(self.key, 3))
+        self.assertTrue(fido2_module.update_sign_count(self.key, 4))
+
+        with self.assertLogs("multifactor.factors.fido2", "WARNING"):
+            self.assertFalse(fido2_module.update_sign_count(self.key, 4))
+            self.assertFalse(fido2_module.update_sign_count(self.key, 0))
+        self.assertEqual(UserKey.objects.get().sign_count, 4)
+
+    def test_one_of_two_racing_requests_wins(self):
+        first, second = UserKey.objects.get(), UserKey.objects.get()
+
+        self.assertTrue(fido2_module.update_sign_count(first, 7))
+        with self.assertLogs("multifactor.factors.fido2", "WARNING"):
+            self.assertFalse(fido2_module.update_sign_count(second, 7))
+
+    def test_authenticators_without_a_counter_are_never_written(self):
+        with self.assertNumQueries(0):
+            self.assertTrue(fido2_module.update_sign_count(self.key, 0))
+
+        self.key.sign_count = 0
+        with self.assertNumQueries(0):
+            self.assertTrue(fido2_module.update_sign_count(self.key, 0))
+
+    def test_only_the_counter_is_written(self):
+        with CaptureQueriesContext(connection) as queries:
+            fido2_module.update_sign_count(self.key, 1)
+
+        self.assertEqual(len(queries), 1)
+        self.assertRegex(queries[0]["sql"], r'^UPDATE "multifactor_userkey" SET "sign_count" = \S+ WHERE')
+
+
+class BackfillTests(TestCase):
+    def test_credential_ids(self):
+        from django.apps import apps
+
+        backfill = import_module("multifactor.migrations.0008_userkey_credential_id").backfill_credential_ids
+        user = get_user_model().objects.create_user(username="alice")
+        credential = AttestedCredentialData.create(
+            b"\0" * 16, b"cred-id", ES256.from_cryptography_key(ec.generate_private_key(ec.SECP256R1()).public_key())
+        )
+        key = UserKey.objects.create(
+            user=user, key_type=KeyTypes.FIDO2, properties={"device": websafe_encode(credential), "domain": "x"}
+        )
+        long_key = UserKey.objects.create(
+            user=user,
+            key_type=KeyTypes.FIDO2,
+            properties={
+                "device": websafe_encode(AttestedCredentialData.create(b"\0" * 16, b"x" * 200, credential.public_key))
+            },
+        )
+        UserKey.objects.create(user=user, key_type=KeyTypes.FIDO2, properties={"device": "broken"})
+
+        backfill(apps, None)
+
+        key.refresh_from_db()
+        long_key.refresh_from_db()
+        self.assertEqual(key.credential_id, "Y3JlZC1pZA")
+        self.assertIsNone(long_key.credential_id)
+
+    def test_domains(self):
+        from django.apps import apps
+
+        backfill = import_module("multifactor.migrations.0009_userkey_domain").backfill_domains
+        user = get_user_model().objects.create_user(username="alice")
+        key = UserKey.objects.create(user=user, key_type=KeyTypes.FIDO2, properties={"domain": "example.com"})
+        no_domain = UserKey.objects.create(user=user, key_type=KeyTypes.FIDO2, properties={})
+
+        backfill(apps, None)
+
+        key.refresh_from_db()
+        no_domain.refresh_from_db()
+        self.assertEqual(key.domain, "example.com")
+        self.assertIsNone(no_domain.domain)
+
+
+@override_settings(MULTIFACTOR={"FIDO_SERVER_ID": "testserver"})
+class CredentialCacheTests(TestCase):
+    def setUp(self):
+        decoded_credentials.clear()
+        self.user = get_user_model().objects.create_user(username="alice")
+        self.credential = AttestedCredentialData.create(
+            b"\0" * 16, b"cred-id", ES256.from_cryptography_key(ec.generate_private_key(ec.SECP256R1()).public_key())
+        )
+        self.key = UserKey.objects.create(
+            user=self.user,
+            key_type=KeyTypes.FIDO2,
+            properties={"device": websafe_encode(self.credential)},
+            domain="testserver",
+        )
+        self.view = FidoClass()
+        self.view.request = RequestFactory().get("/")
+        self.view.request.user = self.user
+
+    def test_parsed_once(self):
+        with patch("multifactor.factors.fido2._decode", wraps=fido2_module._decode) as decode:
+            self.assertEqual(self.view.get_user_credentials(), [self.credential])
+            with self.assertNumQueries(1):
+                self.assertEqual(self.view.get_user_credentials(), [self.credential])
+
+        decode.assert_called_once()
+        self.assertEqual(decoded_credentials.stats()["hits"], 1)
+
+    def test_forgotten_when_the_key_changes(self):
+        self.view.get_user_credentials()
+        self.key.last_used = timezone.now()
+        self.key.save(update_fields=["last_used"])
+        self.assertEqual(len(decoded_credentials), 1)
+
+        UserKey.objects.filter(pk=self.key.pk).update(enabled=False)
+
+        self.assertEqual(len(decoded_credentials), 0)
+
+    @override_settings(MULTIFACTOR={"FIDO_SERVER_ID": "testserver", "FIDO2_CREDENTIAL_CACHE_SIZE": 0})
+    def test_off(self):
+        self.assertEqual(self.view.get_user_credentials(), [self.credential])
+
+        self.assertEqual(len(decoded_credentials), 0)
+
+
+@override_settings(
+    ROOT_URLCONF="testsite.testsite.urls",
+    MULTIFACTOR={"FIDO_SERVER_ID": "testserver", "PASSKEY_LOGIN": True},
+)
+class PasskeyLoginTests(TestCase):
+    url = "/admin/multifactor/fido2/passkey/"
+
+    def setUp(self):
+        _servers.clear()
+        decoded_credentials.clear()
+        self.user = get_user_model().objects.create_user(username="alice", password="password123")
+        self.private_key = ec.generate_private_key(ec.SECP256R1())
+        self.credential = AttestedCredentialData.create(
+            b"\0" * 16, b"passkey-id", ES256.from_cryptography_key(self.private_key.public_key())
+        )
+        self.key = UserKey.objects.create(
+            user=self.user,
+            key_type=KeyTypes.FIDO2,
+            properties={"device": websafe_encode(self.credential), "type": "public-key", "domain": "testserver"},
+            domain="testserver",
+            credential_id=websafe_encode(self.credential.credential_id),
+        )
+
+    def _assertion(self, flags=AuthenticatorData.FLAG.UP | AuthenticatorData.FLAG.UV, counter=1):
+        options = self.client.get(self.url).json()
+        challenge = options["publicKey"]["challenge"]
+        client_data = CollectedClientData.create(
+            type="webauthn.get", challenge=websafe_decode(challenge), origin="https://testserver"
+        )
+        auth_data = AuthenticatorData.create(sha256(b"testserver"), flags, counter)
+        signature = self.private_key.sign(auth_data + client_data.hash, ec.ECDSA(hashes.SHA256()))
+        credential_id = websafe_encode(self.credential.credential_id)
+        return {
+            **({"ceremony": options["ceremony"]} if "ceremony" in options else {}),
+            "id": credential_id,
+            "rawId": credential_id,
+            "type": "public-key",
+            "response": {
+                "clientDataJSON": websafe_encode(client_data),
+                "authenticatorData": websafe_encode(auth_data),
+                "signature": websafe_encode(signature),
+            },
+        }
+
+    def _post(self, assertion, query=""):
+        return self.client.post(self.url + query, data=json.dumps(assertion), content_type="application/json")
+
+    def test_begins_with_an_empty_allow_list(self):
+        options = self.client.get(self.url).json()["publicKey"]
+
+        self.assertFalse(options.get("allowCredentials"))
+        self.assertEqual(options["userVerification"], "required")
+
+    def test_logs_in(self):
+        response = self._post(self._assertion(), "?next=/admin/")
+
+        self.assertEqual(response.json(), {"status": "OK", "redirect": "/admin/"})
+        self.assertEqual(self.client.session["_auth_user_id"], str(self.user.pk))
+        self.assertEqual([f.key_id for f in get_factors(self.client.session)], [self.key.pk])
+
+    def test_state_outside_the_session(self):
+        for store in ["cache", "signed"]:
+            with self.subTest(store), override_settings(
+                CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+                MULTIFACTOR={"FIDO_SERVER_ID": "testserver", "PASSKEY_LOGIN": True, "FIDO_STATE_STORE": store},
+            ):
+                # two tabs
+                first, second = self._assertion(), self._assertion(counter=2)
+                self.assertNotIn("fido_state", self.client.session)
+
+                self.assertEqual(self._post(first).json()["status"], "OK")
+                self.client.logout()
+                self.assertEqual(self._post(second).json()["status"], "OK")
+                self.client.logout()
+
+                # and each only once
+                UserKey.objects.filter(pk=self.key.pk).update(sign_count=None)
+                self.assertEqual(self._post(second).json()["status"], "err")
+
+    @override_settings(
+        MIDDLEWARE=[m for m in settings.MIDDLEWARE if not m.endswith("DisableCSRFMiddleware")],
+    )
+    def test_checks_the_csrf_token(self):
+        self.client = Client(enforce_csrf_checks=True)
+        self.client.get("/admin/multifactor/fido2/login/")
+        token = self.client.cookies["csrftoken"].value
+
+        response = self.client.post(self.url, data=json.dumps(self._assertion()), content_type="text/plain")
+        self.assertEqual(response.status_code, 403)
+        self.assertNotIn("_auth_user_id", self.client.session)
+
+        response = self.client.post(
+            self.url, data=json.dumps(self._assertion()), content_type="application/json", HTTP_X_CSRFTOKEN=token
+        )
+        self.assertEqual(response.json()["status"], "OK")
+
+    @override_settings(
+        AUTHENTICATION_BACKENDS=["testsite.testsite.missing.Backend", "django.contrib.auth.backends.ModelBackend"],
+        MULTIFACTOR={
+            "FIDO_SERVER_ID": "testserver",
+            "PASSKEY_LOGIN": True,
+            "PASSKEY_BACKEND": "django.contrib.auth.backends.ModelBackend",
+        },
+    )
+    def test_logs_in_with_the_passkey_backend(self):
+        self._post(self._assertion())
+
+        self.assertEqual(self.client.session["_auth_user_backend"], "django.contrib.auth.backends.ModelBackend")
+
+    def test_bodies_that_are_not_an_object(self):
+        for body in ["[]", '"x"', "1", "null", "{"]:
+            with self.subTest(body), self.assertLogs("multifactor.factors.fido2", "INFO"):
+                response = self.client.post(self.url, data=body, content_type="application/json")
+
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(response.json()["status"], "err")
+
+    def test_unsafe_next_is_ignored(self):
+        response = self._post(self._assertion(), "?next=https://evil.example.com/")
+
+        self.assertEqual(response.json()["redirect"], "/accounts/profile/")
+
+    def test_user_verification_is_required(self):
+        response = self._post(self._assertion(flags=AuthenticatorData.FLAG.UP))
+
+        self.assertEqual(response.json()["status"], "err")
+        self.assertNotIn("_auth_user_id", self.client.session)
+
+    def test_unusable_keys(self):
+        for change in [{"enabled": False}, {"domain": "example.com"}]:
+            with self.subTest(change):
+                UserKey.objects.filter(pk=self.key.pk).update(**change)
+                response = self._post(self._assertion())
+                UserKey.objects.filter(pk=self.key.pk).update(enabled=True, domain="testserver")
+
+                self.assertEqual(response.json()["status"], "err")
+                self.assertNotIn("_auth_user_id", self.client.session)
+
+    def test_inactive_users_cannot_log_in(self):
+        self.user.is_active = False
+        self.user.save()
+
+        self.assertEqual(self._post(self._assertion()).json()["status"], "err")
+        self.assertNotIn("_auth_user_id", self.client.session)
+
+    def test_records_the_sign_count(self):
+        self._post(self._assertion(counter=5))
+
+        self.key.refresh_from_db()
+        self.assertEqual(self.key.sign_count, 5)
+
+    def test_sign_count_must_go_up(self):
+        UserKey.objects.filter(pk=self.key.pk).update(sign_count=5)
+
+        with self.assertLogs("multifactor.factors.fido2", "WARNING"):
+            response = self._post(self._assertion(counter=5))
+
+        self.assertEqual(response.json()["status"], "err")
+        self.assertNotIn("_auth_user_id", self.client.session)
+
+    def test_off_by_default(self):
+        with override_settings(MULTIFACTOR={}):
+            self.assertEqual(self.client.get(self.url).status_code, 404)
+            self.assertEqual(self.client.get("/admin/multifactor/fido2/login/").status_code, 404)
+
+        self.assertContains(self.client.get("/admin/multifactor/fido2/login/?next=/admin/"), "next=%2Fadmin%2F")
+
+    @patch("multifactor.factors.fido2.Fido2Server")
+    def test_registration_asks_for_a_discoverable_credential(self, server_cls):
+        server_cls.return_value.register_begin.return_value = ({}, {})
+        self.key.delete()
+        self.client.force_login(self.user)
+
+        self.client.get(reverse("multifactor:fido2_register"))
+
+        self.assertEqual(
+            server_cls.return_value.register_begin.call_args.kwargs["resident_key_requirement"], "preferred"
+        )
+
+
+@override_settings(
+    MULTIFACTOR={
+        "FIDO_SERVER_ID": "example.com",
+        "FIDO_SERVER_NAME": "Default",
+        "FIDO_SERVERS": {
+            "app.example.org": {"id": "app.example.org", "name": "App"},
+            "*.example.org": {"id": "example.org"},
+            "*.eu.example.org": {"id": "eu.example.org", "name": "EU"},
+        },
+    }
+)
+class ResolveRPTests(SimpleTestCase):
+    def test_resolution(self):
+        for host, rp in [
+            ("app.example.org", ("app.example.org", "App")),
+            ("APP.example.org:8000", ("app.example.org", "App")),
+            ("shop.example.org", ("example.org", "Default")),
+            ("shop.eu.example.org", ("eu.example.org", "EU")),
+            ("example.org", ("example.com", "Default")),
+            ("elsewhere.net", ("example.com", "Default")),
+            (None, ("example.com", "Default")),
+        ]:
+            with self.subTest(host):
+                self.assertEqual(resolve_rp(host), rp)
+
+    def test_one_server_per_relying_party(self):
+        def server(host):
+            view = FidoClass()
+            view.request = RequestFactory().get("/", HTTP_HOST=host)
+            return view.server
+
+        with override_settings(ALLOWED_HOSTS=["*"]):
+            self.assertIs(server("a.example.org"), server("b.example.org"))
+            self.assertEqual(server("a.example.org").rp.id, "example.org")
+            self.assertIsNot(server("a.example.org"), server("app.example.org"))
+
+    def test_reset_when_settings_change(self):
+        resolve_rp("shop.example.org")
+
+        with override_settings(MULTIFACTOR={"FIDO_SERVERS": {"*.example.org": {"id": "shop.example.org"}}}):
+            self.assertEqual(resolve_rp("shop.example.org")[0], "shop.example.org")
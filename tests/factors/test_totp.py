@@ -1,12 +1,29 @@
-from unittest.mock import MagicMock, patch
+import time
+from unittest.mock import patch
 
+import pyotp
+import segno
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from django.http import HttpResponse
-from django.test import TestCase, override_settings
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
 from django.urls import reverse
 
+from multifactor.cache import decoded_secrets
+from multifactor.common import write_session
+from multifactor.factors import totp
+from multifactor.factors.totp import (
+    INTERVAL,
+    Auth,
+    Match,
+    match_token,
+    render_qr,
+    user_secrets,
+)
 from multifactor.models import KeyTypes, UserKey
 
+SECRET = "JBSWY3DPEHPK3PXP"
+
 
 @override_settings(
     ROOT_URLCONF="testsite.testsite.urls",
@@ -21,17 +38,12 @@ class TOTPTests(TestCase):
         )
         self.client.force_login(self.user)
 
-    @patch("multifactor.factors.totp.pyotp.random_base32", return_value="SECRET123")
-    @patch("multifactor.factors.totp.pyotp.TOTP")
-    def test_create_post_success(self, totp_cls, random_base32):
-        totp = MagicMock()
-        totp.verify.return_value = True
-        totp_cls.return_value = totp
-
+    @patch("multifactor.factors.totp.pyotp.random_base32", return_value=SECRET)
+    def test_create_post_success(self, random_base32):
         with patch("multifactor.factors.totp.write_session") as write_session, patch(
             "multifactor.factors.totp.messages.success"
         ) as msg_success:
-            response = self.client.post(reverse("multifactor:totp_start"), {"answer": "123456"})
+            response = self.client.post(reverse("multifactor:totp_start"), {"answer": pyotp.TOTP(SECRET).now()})
 
         self.assertEqual(response.status_code, 302)
         self.assertEqual(response["Location"], reverse("multifactor:home"))
@@ -39,43 +51,281 @@ class TOTPTests(TestCase):
         write_session.assert_called_once()
         msg_success.assert_called_once()
 
-    @patch("multifactor.factors.totp.pyotp.random_base32", return_value="SECRET123")
-    @patch("multifactor.factors.totp.pyotp.TOTP")
-    def test_create_post_failure(self, totp_cls, random_base32):
-        totp = MagicMock()
-        totp.verify.return_value = False
-        totp_cls.return_value = totp
-
+    @patch("multifactor.factors.totp.pyotp.random_base32", return_value=SECRET)
+    def test_create_post_failure(self, random_base32):
         with patch("multifactor.factors.totp.messages.error") as msg_error:
-            response = self.client.post(reverse("multifactor:totp_start"), {"answer": "000000"})
+            response = self.client.post(reverse("multifactor:totp_start"), {"answer": "not a code"})
 
         self.assertEqual(response.status_code, 200)
         msg_error.assert_called_once()
 
+    def test_create_renders_qr_in_the_browser_by_default(self):
+        response = self.client.get(reverse("multifactor:totp_start"))
+
+        self.assertContains(response, "qrcode.min.js")
+        self.assertNotContains(response, "<svg")
+
+    def test_create_renders_qr_on_the_server(self):
+        for fmt, expected in [("svg", "<svg"), ("png", 'src="data:image/png;base64,')]:
+            with self.subTest(fmt), override_settings(MULTIFACTOR={"TOTP_QR": fmt}):
+                response = self.client.get(reverse("multifactor:totp_start"))
+
+                self.assertContains(response, expected)
+                self.assertNotContains(response, "qrcode.min.js")
+
     def test_auth_post_success(self):
         UserKey.objects.create(
             user=self.user,
             key_type=KeyTypes.TOTP,
-            properties={"secret_key": "SECRET123"},
+            properties={"secret_key": pyotp.random_base32()},
+        )
+        key = UserKey.objects.create(
+            user=self.user,
+            key_type=KeyTypes.TOTP,
+            properties={"secret_key": SECRET},
         )
 
-        with patch("multifactor.factors.totp.pyotp.TOTP") as totp_cls, patch(
-            "multifactor.factors.totp.write_session"
-        ) as write_session, patch("multifactor.factors.totp.login") as login:
+        with patch("multifactor.factors.totp.write_session") as write_session, patch(
+            "multifactor.factors.totp.login"
+        ) as login:
             login.return_value = HttpResponse()
-            totp = MagicMock()
-            totp.verify.return_value = True
-            totp_cls.return_value = totp
 
-            response = self.client.post(reverse("multifactor:totp_auth"), {"answer": "123456"})
+            response = self.client.post(reverse("multifactor:totp_auth"), {"answer": pyotp.TOTP(SECRET).now()})
 
         self.assertEqual(response.status_code, 200)
         write_session.assert_called_once()
+        self.assertEqual(write_session.call_args.args[1], key)
         login.assert_called_once()
 
+    def test_auth_codes_cannot_be_replayed(self):
+        UserKey.objects.create(user=self.user, key_type=KeyTypes.TOTP, properties={"secret_key": SECRET})
+        code = pyotp.TOTP(SECRET).now()
+
+        with patch("multifactor.factors.totp.login", return_value=HttpResponse()) as login, patch(
+            "multifactor.factors.totp.messages.error"
+        ) as msg_error:
+            self.client.post(reverse("multifactor:totp_auth"), {"answer": code})
+            self.client.post(reverse("multifactor:totp_auth"), {"answer": code})
+
+        login.assert_called_once()
+        msg_error.assert_called_once()
+
+    def test_enrolment_code_cannot_be_reused(self):
+        with patch("multifactor.factors.totp.pyotp.random_base32", return_value=SECRET):
+            code = pyotp.TOTP(SECRET).now()
+            self.client.post(reverse("multifactor:totp_start"), {"answer": code})
+
+        view = Auth()
+        view.setup(RequestFactory().post("/"))
+        view.request.user = self.user
+        self.assertIsNone(view.verify_login(code))
+
+    def test_concurrent_use_of_a_code_only_succeeds_once(self):
+        key = UserKey.objects.create(user=self.user, key_type=KeyTypes.TOTP, properties={"secret_key": SECRET})
+        view = Auth()
+        view.setup(RequestFactory().post("/"))
+        view.request.user = self.user
+
+        def other_request_wins(*args, **kwargs):
+            match = match_token(*args, **kwargs)
+            UserKey.objects.filter(pk=key.pk).update(last_step=match.step)
+            return match
+
+        with patch("multifactor.factors.totp.match_token", side_effect=other_request_wins):
+            self.assertIsNone(view.verify_login(pyotp.TOTP(SECRET).now()))
+
+    def test_auth_post_records_drift(self):
+        key = UserKey.objects.create(user=self.user, key_type=KeyTypes.TOTP, properties={"secret_key": SECRET})
+        code = pyotp.TOTP(SECRET).at(time.time() - 4 * INTERVAL)
+
+        with patch("multifactor.factors.totp.login", return_value=HttpResponse()):
+            self.client.post(reverse("multifactor:totp_auth"), {"answer": code})
+
+        key.refresh_from_db()
+        self.assertIn(key.drift, (-4, -3))  # allow for crossing a step boundary
+
+    @override_settings(
+        CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+        MULTIFACTOR={"THROTTLE": {"TOTP": (2, 60)}},
+    )
+    def test_auth_post_throttled(self):
+        UserKey.objects.create(user=self.user, key_type=KeyTypes.TOTP, properties={"secret_key": SECRET})
+        cache.clear()
+        self.client.post(reverse("multifactor:totp_auth"), {"answer": "000000"})
+        self.client.post(reverse("multifactor:totp_auth"), {"answer": "000000"})
+
+        with patch.object(Auth, "verify_login") as verify_login:
+            response = self.client.post(reverse("multifactor:totp_auth"), {"answer": pyotp.TOTP(SECRET).now()})
+
+        self.assertEqual(response.status_code, 429)
+        self.assertContains(response, "Too many attempts", status_code=429)
+        verify_login.assert_not_called()
+
     def test_auth_post_failure(self):
         with patch("multifactor.factors.totp.messages.error") as msg_error:
             response = self.client.post(reverse("multifactor:totp_auth"), {"answer": "000000"})
 
         self.assertEqual(response.status_code, 200)
         msg_error.assert_called_once()
+
+
+class MatchTokenTests(SimpleTestCase):
+    now = 1_700_000_000
+
+    step = now // INTERVAL
+
+    def _code(self, secret, steps=0):
+        return pyotp.TOTP(secret).at(self.now + steps * INTERVAL)
+
+    def _match(self, *args, **kwargs):
+        match = match_token(*args, **kwargs)
+        return match and match[:2]
+
+    def test_finds_the_matching_secret_and_drift(self):
+        secrets = [pyotp.random_base32() for _ in range(3)]
+
+        self.assertEqual(self._match(secrets, self._code(secrets[2], -3), for_time=self.now), (2, -3))
+
+    def test_returns_the_step(self):
+        self.assertEqual(match_token([SECRET], self._code(SECRET, 2), for_time=self.now), Match(0, 2, self.step + 2))
+
+    def test_used_steps_are_skipped(self):
+        token = self._code(SECRET, -1)
+
+        self.assertIsNone(self._match([SECRET], token, last_steps=[self.step - 1], for_time=self.now))
+        self.assertIsNone(self._match([SECRET], token, last_steps=[self.step + 5], for_time=self.now))
+        self.assertEqual(self._match([SECRET], token, last_steps=[self.step - 2], for_time=self.now), (0, -1))
+
+    def test_used_steps_cost_nothing(self):
+        with patch("multifactor.factors.totp._code", wraps=totp._code) as code:
+            self._match([SECRET], self._code(SECRET), last_steps=[self.step + 60], for_time=self.now)
+
+        code.assert_not_called()
+
+    def test_window_edges(self):
+        for steps, window, expected in [
+            (60, 60, (0, 60)),
+            (-60, 60, (0, -60)),
+            (61, 60, None),
+            (1, 0, None),
+        ]:
+            with self.subTest(steps=steps, window=window):
+                token = self._code(SECRET, steps)
+                self.assertEqual(self._match([SECRET], token, window=window, for_time=self.now), expected)
+                self.assertEqual(
+                    pyotp.TOTP(SECRET).verify(token, for_time=self.now, valid_window=window), expected is not None
+                )
+
+    @override_settings(MULTIFACTOR={"TOTP_WINDOW": 5})
+    def test_window_setting(self):
+        self.assertEqual(self._match([SECRET], self._code(SECRET, 5), for_time=self.now), (0, 5))
+        self.assertIsNone(self._match([SECRET], self._code(SECRET, 6), for_time=self.now))
+
+    def test_stops_at_the_nearest_step(self):
+        with patch("multifactor.factors.totp._code", wraps=totp._code) as code:
+            self._match([pyotp.random_base32(), SECRET], self._code(SECRET), for_time=self.now)
+
+        self.assertEqual(code.call_count, 2)
+
+    def test_known_drift_is_tried_first(self):
+        with patch("multifactor.factors.totp._code", wraps=totp._code) as code:
+            match = self._match([SECRET], self._code(SECRET, -41), drifts=[-40], for_time=self.now)
+
+        self.assertEqual(match, (0, -41))
+        # -40, then -41
+        self.assertEqual(code.call_count, 2)
+
+    def test_widens_when_drift_has_changed(self):
+        with patch("multifactor.factors.totp._code", wraps=totp._code) as code:
+            match = self._match([SECRET], self._code(SECRET, 2), drifts=[-40], for_time=self.now)
+
+        self.assertEqual(match, (0, 2))
+        # -40, -41, -39 then 0, -1, 1, -2, 2
+        self.assertEqual(code.call_count, 8)
+
+    def test_drift_beyond_window_is_ignored(self):
+        with self.settings(MULTIFACTOR={"TOTP_WINDOW": 1}):
+            self.assertIsNone(self._match([SECRET], self._code(SECRET, -40), drifts=[-40], for_time=self.now))
+
+    def test_malformed_tokens_cost_nothing(self):
+        with patch("multifactor.factors.totp._code") as code:
+            for token in ["", "12345", "1234567", "12345a", " 123456"]:
+                self.assertIsNone(self._match([SECRET], token, for_time=self.now))
+
+        code.assert_not_called()
+
+    def test_no_secrets(self):
+        self.assertIsNone(self._match([], "123456"))
+
+
+@override_settings(MULTIFACTOR={"TOTP_SECRET_CACHE_SIZE": 10})
+class SecretCacheTests(TestCase):
+    def setUp(self):
+        decoded_secrets.clear()
+        self.user = get_user_model().objects.create_user(username="alice")
+        self.key = UserKey.objects.create(user=self.user, key_type=KeyTypes.TOTP, properties={"secret_key": SECRET})
+
+    def test_steady_state_is_one_query(self):
+        user_secrets(self.user)
+
+        with self.assertNumQueries(1):
+            keys, secrets = user_secrets(self.user)
+
+        self.assertEqual(keys, [self.key])
+        self.assertEqual(secrets, [pyotp.TOTP(SECRET).byte_secret()])
+        self.assertEqual(decoded_secrets.stats()["hits"], 1)
+
+    def test_logging_in_keeps_the_entry(self):
+        user_secrets(self.user)
+        request = RequestFactory().get("/")
+        request.session = {}
+
+        write_session(request, self.key)
+
+        self.assertEqual(len(decoded_secrets), 1)
+
+    def test_disabling_forgets_the_secret(self):
+        for disable in [
+            lambda: UserKey.objects.filter(pk=self.key.pk).update(enabled=False),
+            lambda: UserKey.objects.filter(pk=self.key.pk).delete(),
+        ]:
+            user_secrets(self.user)
+            disable()
+            self.assertEqual(len(decoded_secrets), 0)
+
+    def test_verify_login_uses_the_cache(self):
+        user_secrets(self.user)
+        view = Auth()
+        view.setup(RequestFactory().post("/"))
+        view.request.user = self.user
+
+        self.assertEqual(view.verify_login(pyotp.TOTP(SECRET).now()), self.key)
+        self.assertEqual(decoded_secrets.stats()["hits"], 1)
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    MULTIFACTOR={"CACHE": "default"},
+)
+class RenderQRTests(SimpleTestCase):
+    uri = pyotp.TOTP(SECRET).provisioning_uri("alice", issuer_name="Django App")
+
+    def test_cached_per_uri(self):
+        with patch("segno.make", wraps=segno.make) as make:
+            first = render_qr(self.uri, "svg")
+            self.assertEqual(render_qr(self.uri, "svg"), first)
+            render_qr(self.uri + "x", "svg")
+
+        self.assertEqual(make.call_count, 2)
+
+    def test_secret_not_in_cache_key(self):
+        from multifactor.cache import qr_cache_key
+
+        self.assertNotIn(SECRET, qr_cache_key("svg", self.uri))
+
+    def test_without_cache(self):
+        with override_settings(MULTIFACTOR={}), patch("segno.make", wraps=segno.make) as make:
+            render_qr(self.uri, "png")
+            render_qr(self.uri, "png")
+
+        self.assertEqual(make.call_count, 2)
@@ -1,6 +1,6 @@
 from django.contrib import admin
 from django.contrib.auth import get_user_model
-from django.test import RequestFactory, TestCase
+from django.test import RequestFactory, TestCase, override_settings
 
 from multifactor.admin import (
     HasMultifactorFilter,
@@ -72,6 +72,24 @@ class AdminTests(TestCase):
 
         self.assertTrue(hasattr(qs.query, "annotations"))
 
+    @override_settings(MULTIFACTOR={"STATUS_TABLE": True})
+    def test_multifactor_user_admin_annotation_from_status_table(self):
+        UserKey.objects.create(user=self.user, key_type=KeyTypes.TOTP, properties={})
+        ma = MultifactorUserAdmin(get_user_model(), admin.site)
+
+        qs = ma.get_queryset(self.factory.get("/"))
+
+        self.assertEqual(dict(qs.values_list("username", "has_multifactors")), {"alice": True, "admin": False})
+
+    def test_multifactor_user_admin_annotation_without_status_rows(self):
+        UserKey.objects.create(user=self.user, key_type=KeyTypes.TOTP, properties={})
+        ma = MultifactorUserAdmin(get_user_model(), admin.site)
+
+        with override_settings(MULTIFACTOR={"STATUS_TABLE": True}):
+            qs = ma.get_queryset(self.factory.get("/"))
+
+            self.assertEqual(dict(qs.values_list("username", "has_multifactors")), {"alice": True, "admin": False})
+
     def test_multifactor_user_admin_list_display_includes_flag(self):
         request = self.factory.get("/")
         ma = MultifactorUserAdmin(get_user_model(), admin.site)
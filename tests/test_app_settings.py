@@ -1,45 +1,49 @@
-from importlib import reload
-
+from django.core.exceptions import ImproperlyConfigured
 from django.test import SimpleTestCase, override_settings
 
+from multifactor.app_settings import MultifactorSettings, mf_settings
+from multifactor.factors.fallback import send_email
+
+
+def bypass(request):
+    return True
 
-class AppSettingsTests(SimpleTestCase):
-    def _reload_module(self):
-        import multifactor.app_settings as app_settings
 
-        return reload(app_settings)
+class AppSettingsTests(SimpleTestCase):
 
     @override_settings(MULTIFACTOR={})
     def test_defaults_are_applied(self):
-        app_settings = self._reload_module()
+        settings = MultifactorSettings()
 
         self.assertEqual(
-            app_settings.mf_settings["LOGIN_MESSAGE"],
+            settings["LOGIN_MESSAGE"],
             'You are now multifactor-authenticated. <a href="{}">Multifactor settings</a>.',
         )
-        self.assertTrue(app_settings.mf_settings["SHOW_LOGIN_MESSAGE"])
-        self.assertFalse(app_settings.mf_settings["LOGIN_CALLBACK"])
-        self.assertTrue(app_settings.mf_settings["RECHECK"])
-        self.assertEqual(app_settings.mf_settings["RECHECK_MIN"], 60 * 60 * 3)
-        self.assertEqual(app_settings.mf_settings["RECHECK_MAX"], 60 * 60 * 6)
-        self.assertEqual(app_settings.mf_settings["FIDO_SERVER_ID"], "example.com")
-        self.assertEqual(app_settings.mf_settings["FIDO_SERVER_NAME"], "Django App")
-        self.assertIsNone(app_settings.mf_settings["FIDO_SERVER_ICON"])
-        self.assertEqual(app_settings.mf_settings["TOKEN_ISSUER_NAME"], "Django App")
-        self.assertEqual(app_settings.mf_settings["FACTORS"], ["FIDO2", "TOTP"])
-        self.assertIn("email", app_settings.mf_settings["FALLBACKS"])
+        self.assertTrue(settings["SHOW_LOGIN_MESSAGE"])
+        self.assertFalse(settings["LOGIN_CALLBACK"])
+        self.assertTrue(settings["RECHECK"])
+        self.assertEqual(settings["RECHECK_MIN"], 60 * 60 * 3)
+        self.assertEqual(settings["RECHECK_MAX"], 60 * 60 * 6)
+        self.assertEqual(settings["FIDO_SERVER_ID"], "example.com")
+        self.assertEqual(settings["FIDO_SERVER_NAME"], "Django App")
+        self.assertIsNone(settings["FIDO_SERVER_ICON"])
+        self.assertEqual(settings["TOKEN_ISSUER_NAME"], "Django App")
+        self.assertEqual(settings["FACTORS"], ["FIDO2", "TOTP"])
+        self.assertIn("email", settings["FALLBACKS"])
         self.assertEqual(
-            app_settings.mf_settings["FALLBACKS"]["email"][1],
+            settings["FALLBACKS"]["email"][1],
             "multifactor.factors.fallback.send_email",
         )
-        self.assertTrue(app_settings.mf_settings["HTML_EMAIL"])
-        self.assertIsNone(app_settings.mf_settings["BYPASS"])
+        self.assertTrue(settings["HTML_EMAIL"])
+        self.assertIsNone(settings["BYPASS"])
+        self.assertIsNone(settings["CACHE"])
+        self.assertEqual(settings["CACHE_TIMEOUT"], 60 * 60)
 
     @override_settings(MULTIFACTOR={})
     def test_default_email_fallback_uses_user_email(self):
-        app_settings = self._reload_module()
+        settings = MultifactorSettings()
 
-        email_getter, sender_path = app_settings.mf_settings["FALLBACKS"]["email"]
+        email_getter, sender_path = settings["FALLBACKS"]["email"]
 
         user = type("User", (), {"email": "alice@example.com"})()
         self.assertEqual(email_getter(user), "alice@example.com")
@@ -64,19 +68,55 @@ class AppSettingsTests(SimpleTestCase):
         }
     )
     def test_custom_values_are_preserved(self):
-        app_settings = self._reload_module()
-
-        self.assertEqual(app_settings.mf_settings["LOGIN_MESSAGE"], "custom")
-        self.assertFalse(app_settings.mf_settings["SHOW_LOGIN_MESSAGE"])
-        self.assertEqual(app_settings.mf_settings["LOGIN_CALLBACK"], "path.to.callback")
-        self.assertFalse(app_settings.mf_settings["RECHECK"])
-        self.assertEqual(app_settings.mf_settings["RECHECK_MIN"], 10)
-        self.assertEqual(app_settings.mf_settings["RECHECK_MAX"], 20)
-        self.assertEqual(app_settings.mf_settings["FIDO_SERVER_ID"], "example.org")
-        self.assertEqual(app_settings.mf_settings["FIDO_SERVER_NAME"], "Custom App")
-        self.assertEqual(app_settings.mf_settings["FIDO_SERVER_ICON"], "icon.png")
-        self.assertEqual(app_settings.mf_settings["TOKEN_ISSUER_NAME"], "Issuer")
-        self.assertEqual(app_settings.mf_settings["FACTORS"], ["TOTP"])
-        self.assertEqual(app_settings.mf_settings["FALLBACKS"], {"sms": ("user.phone", "path.to.sms")})
-        self.assertFalse(app_settings.mf_settings["HTML_EMAIL"])
-        self.assertEqual(app_settings.mf_settings["BYPASS"], "path.to.bypass")
+        settings = MultifactorSettings()
+
+        self.assertEqual(settings["LOGIN_MESSAGE"], "custom")
+        self.assertFalse(settings["SHOW_LOGIN_MESSAGE"])
+        self.assertEqual(settings["LOGIN_CALLBACK"], "path.to.callback")
+        self.assertFalse(settings["RECHECK"])
+        self.assertEqual(settings["RECHECK_MIN"], 10)
+        self.assertEqual(settings["RECHECK_MAX"], 20)
+        self.assertEqual(settings["FIDO_SERVER_ID"], "example.org")
+        self.assertEqual(settings["FIDO_SERVER_NAME"], "Custom App")
+        self.assertEqual(settings["FIDO_SERVER_ICON"], "icon.png")
+        self.assertEqual(settings["TOKEN_ISSUER_NAME"], "Issuer")
+        self.assertEqual(settings["FACTORS"], ["TOTP"])
+        self.assertEqual(settings["FALLBACKS"], {"sms": ("user.phone", "path.to.sms")})
+        self.assertFalse(settings["HTML_EMAIL"])
+        self.assertEqual(settings["BYPASS"], "path.to.bypass")
+
+    @override_settings(MULTIFACTOR={})
+    def test_dotted_paths_are_resolved(self):
+        settings = MultifactorSettings()
+
+        self.assertIsNone(settings.bypass)
+        self.assertIsNone(settings.login_callback)
+        self.assertIs(settings.fallbacks["email"][1], send_email)
+        self.assertEqual(settings.errors, [])
+
+    @override_settings(MULTIFACTOR={"BYPASS": bypass, "LOGIN_CALLBACK": "multifactor.factors.fallback.send_email"})
+    def test_callables_and_paths_are_both_accepted(self):
+        settings = MultifactorSettings()
+
+        self.assertIs(settings.bypass, bypass)
+        self.assertIs(settings.login_callback, send_email)
+
+    @override_settings(MULTIFACTOR={"BYPASS": "path.to.bypass"})
+    def test_unimportable_path_is_recorded_and_raises_when_called(self):
+        settings = MultifactorSettings()
+
+        self.assertEqual([(s, p) for s, p, e in settings.errors], [("BYPASS", "path.to.bypass")])
+        with self.assertRaises(ImproperlyConfigured):
+            settings.bypass(None)
+
+    def test_settings_are_read_only(self):
+        with self.assertRaises(TypeError):
+            mf_settings["RECHECK"] = False
+
+    def test_reloaded_when_setting_changes(self):
+        with override_settings(MULTIFACTOR={"BYPASS": bypass, "RECHECK_MIN": 5}):
+            self.assertIs(mf_settings.bypass, bypass)
+            self.assertEqual(mf_settings["RECHECK_MIN"], 5)
+
+        self.assertIsNone(mf_settings.bypass)
+        self.assertEqual(mf_settings["RECHECK_MIN"], 60 * 60 * 3)
@@ -0,0 +1,112 @@
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from multifactor.cache import (
+    LRU,
+    enabled_keys,
+    get_cache,
+    invalidate_user_keys,
+    user_keys_cache_key,
+)
+from multifactor.common import has_multifactor
+from multifactor.models import KeyTypes, UserKey
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    MULTIFACTOR={"CACHE": "default"},
+)
+class KeyCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(
+            username="alice",
+            email="alice@example.com",
+            password="password123",
+        )
+        self.key = UserKey.objects.create(user=self.user, key_type=KeyTypes.TOTP, properties={})
+
+    def _request(self):
+        request = RequestFactory().get("/")
+        request.user = self.user
+        return request
+
+    def test_get_cache_disabled_without_alias(self):
+        with override_settings(MULTIFACTOR={}):
+            self.assertIsNone(get_cache())
+
+    def test_enabled_keys_hit_costs_no_queries(self):
+        self.assertEqual(enabled_keys(self.user), [(self.key.pk, "TOTP")])
+
+        with self.assertNumQueries(0):
+            self.assertEqual(enabled_keys(self.user), [(self.key.pk, "TOTP")])
+            self.assertTrue(has_multifactor(self._request()))
+
+    def test_save_invalidates(self):
+        enabled_keys(self.user)
+        self.key.enabled = False
+        self.key.save()
+
+        self.assertIsNone(cache.get(user_keys_cache_key(self.user.pk)))
+        self.assertFalse(has_multifactor(self._request()))
+
+    def test_delete_invalidates(self):
+        enabled_keys(self.user)
+        UserKey.objects.filter(pk=self.key.pk).delete()
+
+        self.assertEqual(enabled_keys(self.user), [])
+
+    def test_queryset_update_invalidates(self):
+        enabled_keys(self.user)
+        UserKey.objects.filter(user=self.user).update(enabled=False)
+
+        self.assertEqual(enabled_keys(self.user), [])
+
+    def test_explicit_invalidation(self):
+        enabled_keys(self.user)
+        UserKey.objects.bulk_create([UserKey(user=self.user, key_type=KeyTypes.FIDO2, properties={})])
+        self.assertEqual(len(enabled_keys(self.user)), 1)
+
+        invalidate_user_keys(self.user.pk)
+
+        self.assertEqual(len(enabled_keys(self.user)), 2)
+
+
+@override_settings(MULTIFACTOR={"TOTP_SECRET_CACHE_SIZE": 2})
+class LRUTests(SimpleTestCase):
+    def setUp(self):
+        self.lru = LRU("TOTP_SECRET_CACHE_SIZE")
+
+    def test_evicts_least_recently_used(self):
+        self.lru.set("a", 1)
+        self.lru.set("b", 2)
+        self.assertEqual(self.lru.get("a"), 1)
+        self.lru.set("c", 3)
+
+        self.assertIsNone(self.lru.get("b"))
+        self.assertEqual(self.lru.get("a"), 1)
+        self.assertEqual(self.lru.get("c"), 3)
+
+    def test_stats(self):
+        self.lru.set("a", 1)
+        self.lru.get("a")
+        self.lru.get("b")
+
+        self.assertEqual(self.lru.stats(), {"size": 1, "maxsize": 2, "hits": 1, "misses": 1, "hit_rate": 0.5})
+
+    def test_discard(self):
+        self.lru.set((1, "x"), 1)
+        self.lru.set((2, "x"), 2)
+
+        self.lru.discard(lambda key: key[0] == 1)
+
+        self.assertIsNone(self.lru.get((1, "x")))
+        self.assertEqual(len(self.lru), 1)
+
+    def test_off_when_size_is_zero(self):
+        with override_settings(MULTIFACTOR={"TOTP_SECRET_CACHE_SIZE": 0}):
+            self.lru.set("a", 1)
+            self.assertIsNone(self.lru.get("a"))
+
+        self.assertEqual(len(self.lru), 0)
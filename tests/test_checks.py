@@ -0,0 +1,75 @@
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, override_settings
+
+from multifactor.checks import check_settings
+
+
+class CheckSettingsTests(SimpleTestCase):
+    def _ids(self):
+        return [e.id for e in check_settings(None)]
+
+    def test_defaults_pass(self):
+        self.assertEqual(self._ids(), [])
+
+    @override_settings(MULTIFACTOR={"BYPASS": "path.to.bypass"})
+    def test_unimportable_path(self):
+        self.assertEqual(self._ids(), ["multifactor.E001"])
+
+    @override_settings(MULTIFACTOR={"LOGIN_CALLBACK": "multifactor.app_settings.DEFAULTS"})
+    def test_not_callable(self):
+        self.assertEqual(self._ids(), ["multifactor.E002"])
+
+    @override_settings(MULTIFACTOR={"FALLBACKS": {"sms": ("phone", "multifactor.factors.fallback.send_email")}})
+    def test_fallback_field_not_callable(self):
+        self.assertEqual(self._ids(), ["multifactor.E002"])
+
+    @override_settings(MULTIFACTOR={"RECHECK_MIN": 20, "RECHECK_MAX": 10})
+    def test_recheck_window(self):
+        self.assertEqual(self._ids(), ["multifactor.E003"])
+
+    @override_settings(MULTIFACTOR={"RULES": [{"factors": 1}]})
+    def test_bad_rules(self):
+        self.assertEqual(self._ids(), ["multifactor.E004"])
+
+    @override_settings(MULTIFACTOR={"TOTP_QR": "gif"})
+    def test_bad_qr_format(self):
+        self.assertEqual(self._ids(), ["multifactor.E005"])
+
+    @override_settings(MULTIFACTOR={"TOTP_QR": "svg"})
+    def test_qr_needs_segno(self):
+        self.assertEqual(self._ids(), [])
+        with patch("importlib.util.find_spec", return_value=None):
+            self.assertEqual(self._ids(), ["multifactor.E005"])
+
+    @override_settings(MULTIFACTOR={"THROTTLE": {"TOTP": (5, 60), "SMS": (5, 60), "FIDO2": 5}})
+    def test_bad_throttle(self):
+        self.assertEqual(self._ids(), ["multifactor.E006", "multifactor.E006"])
+
+    @override_settings(
+        MULTIFACTOR={
+            "FIDO_SERVERS": {
+                "ok.example.com": {"id": "ok.example.com"},
+                "*.example.com": {"name": "No id"},
+                "*example.org": {"id": "example.org"},
+                "a.*.example.net": {"id": "example.net"},
+            }
+        }
+    )
+    def test_bad_fido_servers(self):
+        self.assertEqual(self._ids(), ["multifactor.E007"] * 3)
+
+    @override_settings(MULTIFACTOR={"FIDO_STATE_STORE": "cookie"})
+    def test_bad_fido_state_store(self):
+        self.assertEqual(self._ids(), ["multifactor.E008"])
+
+    @override_settings(
+        MULTIFACTOR={"PASSKEY_LOGIN": True},
+        AUTHENTICATION_BACKENDS=["django.contrib.auth.backends.ModelBackend", "path.to.SSOBackend"],
+    )
+    def test_passkey_backend(self):
+        self.assertEqual(self._ids(), ["multifactor.E009"])
+        with override_settings(MULTIFACTOR={"PASSKEY_LOGIN": True, "PASSKEY_BACKEND": "path.to.Other"}):
+            self.assertEqual(self._ids(), ["multifactor.E009"])
+        with override_settings(MULTIFACTOR={"PASSKEY_LOGIN": True, "PASSKEY_BACKEND": "path.to.SSOBackend"}):
+            self.assertEqual(self._ids(), [])
@@ -1,13 +1,18 @@
-from unittest.mock import MagicMock, patch
+from unittest.mock import MagicMock, call, patch
 
+from asgiref.sync import async_to_sync
 from django.contrib.auth import get_user_model
 from django.contrib.messages.storage.fallback import FallbackStorage
+from django.contrib.sessions.backends.db import SessionStore
 from django.http import HttpResponse
-from django.test import RequestFactory, TestCase
+from django.test import RequestFactory, TestCase, override_settings
 from django.utils import timezone
 
 from multifactor.common import (
+    MultifactorState,
     active_factors,
+    ahas_multifactor,
+    get_state,
     has_multifactor,
     is_bypassed,
     login,
@@ -82,6 +87,30 @@ class CommonTests(TestCase):
 
         self.assertFalse(has_multifactor(request))
 
+    @override_settings(MULTIFACTOR={"STATUS_TABLE": True})
+    def test_has_multifactor_from_status_table(self):
+        UserKey.objects.create(user=self.user, key_type=KeyTypes.TOTP, properties={})
+        other = get_user_model().objects.create_user(username="bob")
+        UserKey.objects.create(user=other, key_type=KeyTypes.TOTP, properties={}, enabled=False)
+        keyless = get_user_model().objects.create_user(username="carol")
+        request = self._request()
+
+        for user, expected in [(self.user, True), (other, False), (keyless, False)]:
+            request.user = get_user_model().objects.select_related("multifactor_status").get(pk=user.pk)
+            with self.subTest(user=user), self.assertNumQueries(0):
+                self.assertEqual(has_multifactor(request), expected)
+
+    def test_has_multifactor_without_a_status_row_checks_the_keys(self):
+        # added while the table was off, so it has no row
+        UserKey.objects.create(user=self.user, key_type=KeyTypes.TOTP, properties={})
+        request = self._request()
+
+        with override_settings(MULTIFACTOR={"STATUS_TABLE": True}):
+            request.user = get_user_model().objects.select_related("multifactor_status").get(pk=self.user.pk)
+            self.assertTrue(has_multifactor(request))
+            request.user = get_user_model().objects.get(pk=self.user.pk)
+            self.assertTrue(async_to_sync(ahas_multifactor)(request))
+
     def test_active_factors_filters_expired_entries(self):
         request = self._request()
         request.session["multifactor"] = [
@@ -103,7 +132,26 @@ class CommonTests(TestCase):
         )
         self.assertEqual(request.session["multifactor"], factors)
 
-    @patch("multifactor.common.mf_settings", {"SHOW_LOGIN_MESSAGE": True, "LOGIN_MESSAGE": "Logged in via {}"})
+    def test_active_factors_leaves_unexpired_session_unmodified(self):
+        request = self._request()
+        request.session = SessionStore()
+        request.session["multifactor"] = [("TOTP", 1, 50, False), ("TOTP", 2, 50, 999)]
+        request.session.modified = False
+
+        with patch("multifactor.common.timezone.now") as now:
+            now.return_value.timestamp.return_value = 100
+            factors = active_factors(request)
+
+        self.assertEqual(len(factors), 2)
+        self.assertFalse(request.session.modified)
+
+    def test_active_factors_does_not_create_empty_entry(self):
+        request = self._request()
+
+        self.assertEqual(active_factors(request), [])
+        self.assertNotIn("multifactor", request.session)
+
+    @override_settings(MULTIFACTOR={"SHOW_LOGIN_MESSAGE": True, "LOGIN_MESSAGE": "Logged in via {}"})
     def test_login_with_next_redirects_and_pops_session(self):
         request = self._request()
         request.session["multifactor-next"] = "/target/"
@@ -117,7 +165,7 @@ class CommonTests(TestCase):
         self.assertNotIn("multifactor-next", request.session)
         msg_info.assert_called_once()
 
-    @patch("multifactor.common.mf_settings", {"SHOW_LOGIN_MESSAGE": False, "LOGIN_CALLBACK": False})
+    @override_settings(MULTIFACTOR={"SHOW_LOGIN_MESSAGE": False, "LOGIN_CALLBACK": False})
     def test_login_without_next_redirects_to_login_url(self):
         request = self._request()
 
@@ -127,28 +175,33 @@ class CommonTests(TestCase):
         self.assertEqual(response.status_code, 302)
         self.assertEqual(response["Location"], "/login/")
 
-    @patch("multifactor.common.mf_settings", {"LOGIN_CALLBACK": "path.to.callback", "SHOW_LOGIN_MESSAGE": False})
     def test_login_uses_callback_when_configured(self):
         request = self._request()
         request.session["base_username"] = "alice"
 
         callback = MagicMock(return_value=HttpResponse("callback"))
-        with patch("multifactor.common.import_string", return_value=callback):
+        with patch("multifactor.app_settings.import_string", return_value=callback) as imp, override_settings(
+            MULTIFACTOR={"LOGIN_CALLBACK": "path.to.callback", "SHOW_LOGIN_MESSAGE": False}
+        ):
             response = login(request)
 
+            imp.assert_any_call("path.to.callback")
         callback.assert_called_once_with(request, username="alice")
         self.assertEqual(response.status_code, 200)
 
-    @patch("multifactor.common.mf_settings", {"BYPASS": "path.to.bypass"})
     def test_is_bypassed_uses_callback(self):
         request = self._request()
 
-        with patch("multifactor.common.import_string", return_value=lambda req: True) as imp:
+        with patch("multifactor.app_settings.import_string", return_value=lambda req: True) as imp, override_settings(
+            MULTIFACTOR={"BYPASS": "path.to.bypass"}
+        ):
+            self.assertTrue(is_bypassed(request))
             self.assertTrue(is_bypassed(request))
 
-        imp.assert_called_once_with("path.to.bypass")
+            # resolved once when the settings loaded, not per call
+            self.assertEqual([c for c in imp.call_args_list if c.args == ("path.to.bypass",)], [call("path.to.bypass")])
 
-    @patch("multifactor.common.mf_settings", {"BYPASS": None})
+    @override_settings(MULTIFACTOR={"BYPASS": None})
     def test_is_bypassed_returns_false_when_unconfigured(self):
         request = self._request()
         self.assertFalse(is_bypassed(request))
@@ -190,3 +243,45 @@ class CommonTests(TestCase):
             write_session(request, None)
 
         self.assertEqual(request.session["multifactor"][0], (None, None, 123, False))
+
+    def test_get_state_is_created_once_per_request(self):
+        request = self._request()
+
+        state = get_state(request)
+
+        self.assertIsInstance(state, MultifactorState)
+        self.assertIs(request.multifactor, state)
+        self.assertIs(get_state(request), state)
+
+    def test_state_memoizes_lookups(self):
+        UserKey.objects.create(user=self.user, key_type=KeyTypes.TOTP, properties={})
+        request = self._request()
+        state = get_state(request)
+
+        with self.assertNumQueries(2):
+            for _ in range(3):
+                self.assertTrue(state.has_multifactor)
+                self.assertEqual(state.disabled_fallbacks, [])
+                self.assertEqual(state.active_factors, [])
+                self.assertFalse(state.bypassed)
+
+    @override_settings(MULTIFACTOR={"COMPACT_SESSION": True, "RECHECK": False})
+    def test_write_session_compact(self):
+        key = UserKey.objects.create(user=self.user, key_type=KeyTypes.TOTP, properties={})
+        request = self._request()
+        request.session["multifactor"] = [("FIDO2", 99, 50.5, False)]
+
+        write_session(request, key)
+
+        self.assertIsInstance(request.session["multifactor"], str)
+        self.assertEqual([(f.key_type, f.key_id) for f in active_factors(request)], [("TOTP", key.id), ("FIDO2", 99)])
+
+    def test_write_session_resets_state(self):
+        request = self._request()
+        state = get_state(request)
+        self.assertEqual(state.active_factors, [])
+
+        with patch("multifactor.common.mf_settings", {"RECHECK": False}):
+            write_session(request, None)
+
+        self.assertEqual(len(state.active_factors), 1)
@@ -1,11 +1,17 @@
 from unittest.mock import patch
 
+from asgiref.sync import iscoroutinefunction
 from django.contrib.auth import get_user_model
 from django.contrib.messages.storage.fallback import FallbackStorage
+from django.contrib.sessions.backends.db import SessionStore
+from django.db import connection
 from django.http import HttpResponse
-from django.test import RequestFactory, TestCase
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 
+from multifactor.common import next_check
 from multifactor.decorators import multifactor_protected
+from multifactor.models import KeyTypes, UserKey
 
 
 class DecoratorTests(TestCase):
@@ -42,7 +48,7 @@ class DecoratorTests(TestCase):
         def view(request):
             return HttpResponse("ok")
 
-        with patch("multifactor.decorators.is_bypassed", return_value=True):
+        with patch("multifactor.common.is_bypassed", return_value=True):
             response = view(request)
 
         self.assertEqual(response.status_code, 200)
@@ -54,7 +60,7 @@ class DecoratorTests(TestCase):
         def view(request):
             return HttpResponse("ok")
 
-        with patch("multifactor.decorators.get_user_model") as gum:
+        with patch("multifactor.common.get_user_model") as gum:
             gum.return_value.objects.filter.return_value.exists.return_value = False
             response = view(request)
 
@@ -67,8 +73,8 @@ class DecoratorTests(TestCase):
         def view(request):
             return HttpResponse("ok")
 
-        with patch("multifactor.decorators.active_factors", return_value=[("k1", "TOTP")]), patch(
-            "multifactor.decorators.has_multifactor", return_value=True
+        with patch("multifactor.common.active_factors", return_value=[("k1", "TOTP")]), patch(
+            "multifactor.common.has_multifactor", return_value=True
         ):
             response = view(request)
 
@@ -83,8 +89,8 @@ class DecoratorTests(TestCase):
         def view(request):
             return HttpResponse("ok")
 
-        with patch("multifactor.decorators.active_factors", return_value=[]), patch(
-            "multifactor.decorators.has_multifactor", return_value=True
+        with patch("multifactor.common.active_factors", return_value=[]), patch(
+            "multifactor.common.has_multifactor", return_value=True
         ):
             response = view(request)
 
@@ -98,9 +104,9 @@ class DecoratorTests(TestCase):
         def view(request):
             return HttpResponse("ok")
 
-        with patch("multifactor.decorators.active_factors", return_value=[]), patch(
-            "multifactor.decorators.has_multifactor", return_value=False
-        ), patch("multifactor.decorators.is_bypassed", return_value=False), patch(
+        with patch("multifactor.common.active_factors", return_value=[]), patch(
+            "multifactor.common.has_multifactor", return_value=False
+        ), patch("multifactor.common.is_bypassed", return_value=False), patch(
             "multifactor.decorators.messages.info"
         ) as msg_info:
             response = view(request)
@@ -115,8 +121,8 @@ class DecoratorTests(TestCase):
         def view(request):
             return HttpResponse("ok")
 
-        with patch("multifactor.decorators.active_factors", return_value=[("key", "TOTP", "name", 0)]), patch(
-            "multifactor.decorators.has_multifactor", return_value=True
+        with patch("multifactor.common.active_factors", return_value=[("key", "TOTP", "name", 0)]), patch(
+            "multifactor.common.has_multifactor", return_value=True
         ), patch("multifactor.decorators.timezone.now") as now:
             now.return_value.timestamp.return_value = 999999
             response = view(request)
@@ -131,8 +137,8 @@ class DecoratorTests(TestCase):
         def view(request):
             return HttpResponse("ok")
 
-        with patch("multifactor.decorators.active_factors", return_value=[("k1", "TOTP")]), patch(
-            "multifactor.decorators.has_multifactor", return_value=True
+        with patch("multifactor.common.active_factors", return_value=[("k1", "TOTP")]), patch(
+            "multifactor.common.has_multifactor", return_value=True
         ):
             response = view(request)
 
@@ -145,9 +151,156 @@ class DecoratorTests(TestCase):
         def view(request):
             return HttpResponse("ok")
 
-        with patch("multifactor.decorators.active_factors", return_value=[("k1", "TOTP")]), patch(
-            "multifactor.decorators.has_multifactor", return_value=True
+        with patch("multifactor.common.active_factors", return_value=[("k1", "TOTP")]), patch(
+            "multifactor.common.has_multifactor", return_value=True
         ):
             response = view(request)
 
         self.assertEqual(response.status_code, 200)
+
+    def test_stacked_checks_share_one_query(self):
+        request = self._request()
+
+        @multifactor_protected()
+        @multifactor_protected(advertise=True)
+        def view(request):
+            return HttpResponse("ok")
+
+        with self.assertNumQueries(1):
+            response = view(request)
+
+        self.assertEqual(response.status_code, 200)
+
+    def test_steady_state_get_does_not_write_session(self):
+        admin = get_user_model().objects.create_superuser(
+            username="admin",
+            email="admin@example.com",
+            password="password123",
+        )
+        key = UserKey.objects.create(user=admin, key_type=KeyTypes.TOTP, properties={})
+        self.client.force_login(admin)
+        session = self.client.session
+        session["multifactor"] = [(key.key_type, key.id, 0, next_check())]
+        session.save()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get("/admin/")
+
+        self.assertEqual(response.status_code, 200)
+        writes = [q["sql"] for q in queries if "django_session" in q["sql"] and not q["sql"].startswith("SELECT")]
+        self.assertEqual(writes, [])
+
+
+class AsyncDecoratorTests(TestCase):
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        self.user = get_user_model().objects.create_user(
+            username="alice",
+            email="alice@example.com",
+            password="password123",
+        )
+
+    def _request(self, path="/protected/"):
+        request = self.factory.get(path)
+        user = self.user
+
+        async def auser():
+            return user
+
+        request.auser = auser
+        request.session = SessionStore()
+        request._messages = FallbackStorage(request)
+        return request
+
+    def test_coroutine_views_get_async_wrapper(self):
+        @multifactor_protected()
+        async def view(request):
+            return HttpResponse("ok")
+
+        self.assertTrue(iscoroutinefunction(view))
+
+    async def test_allows_user_without_keys(self):
+        @multifactor_protected()
+        async def view(request):
+            return HttpResponse("ok")
+
+        response = await view(self._request())
+        self.assertEqual(response.status_code, 200)
+
+    async def test_redirects_when_required_factors_not_met(self):
+        await UserKey.objects.acreate(user=self.user, key_type=KeyTypes.TOTP, properties={})
+
+        @multifactor_protected(factors=1)
+        async def view(request):
+            return HttpResponse("ok")
+
+        request = self._request()
+        response = await view(request)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response["Location"], "/admin/multifactor/authenticate/")
+        self.assertEqual(await request.session.aget("multifactor-next"), "/protected/")
+
+    async def test_allows_when_active_and_async_factors_callable(self):
+        await UserKey.objects.acreate(user=self.user, key_type=KeyTypes.TOTP, properties={})
+
+        async def two(request):
+            return 2
+
+        @multifactor_protected(factors=two)
+        async def view(request):
+            return HttpResponse("ok")
+
+        request = self._request()
+        await request.session.aset("multifactor", [("TOTP", 1, 0, False), (None, None, 0, False)])
+
+        response = await view(request)
+        self.assertEqual(response.status_code, 200)
+
+    async def test_user_filter_mismatch_allows_access(self):
+        await UserKey.objects.acreate(user=self.user, key_type=KeyTypes.TOTP, properties={})
+
+        @multifactor_protected(factors=1, user_filter={"is_staff": True})
+        async def view(request):
+            return HttpResponse("ok")
+
+        response = await view(self._request())
+        self.assertEqual(response.status_code, 200)
+
+    async def test_async_bypass_hook(self):
+        await UserKey.objects.acreate(user=self.user, key_type=KeyTypes.TOTP, properties={})
+
+        async def bypass(request):
+            return True
+
+        @multifactor_protected(factors=1)
+        async def view(request):
+            return HttpResponse("ok")
+
+        with override_settings(MULTIFACTOR={"BYPASS": bypass}):
+            response = await view(self._request())
+
+        self.assertEqual(response.status_code, 200)
+
+    async def test_advertise_marks_session(self):
+        @multifactor_protected(advertise=True)
+        async def view(request):
+            return HttpResponse("ok")
+
+        request = self._request()
+        response = await view(request)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(await request.session.aget("multifactor-advertised"))
+
+    async def test_user_filter_local_needs_no_query(self):
+        @multifactor_protected(factors=1, user_filter={"is_staff": True}, user_filter_local=True)
+        async def view(request):
+            return HttpResponse("ok")
+
+        request = self._request()
+        with patch("multifactor.common.get_user_model") as gum:
+            response = await view(request)
+
+        self.assertEqual(response.status_code, 200)
+        gum.assert_not_called()
@@ -0,0 +1,153 @@
+import datetime
+import json
+import os
+import tempfile
+from io import StringIO
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.x509.oid import NameOID
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, override_settings
+from fido2.utils import websafe_encode
+from fido2.webauthn import Aaguid
+
+from multifactor import metadata
+
+AAGUID = Aaguid.parse("01020304-0506-0708-0102-030405060708")
+
+STATEMENT = {
+    "description": "Test Key 5",
+    "authenticatorVersion": 1,
+    "schema": 3,
+    "upv": [{"major": 1, "minor": 0}],
+    "attestationTypes": ["basic_full"],
+    "userVerificationDetails": [[{"userVerificationMethod": "presence_internal"}]],
+    "keyProtection": ["hardware"],
+    "matcherProtection": ["on_chip"],
+    "attachmentHint": ["external"],
+    "tcDisplay": [],
+    "attestationRootCertificates": [],
+}
+
+PAYLOAD = {
+    "legalHeader": "",
+    "no": 42,
+    "nextUpdate": "2030-01-01",
+    "entries": [
+        {
+            "aaguid": str(AAGUID),
+            "metadataStatement": STATEMENT,
+            "statusReports": [
+                {"status": "FIDO_CERTIFIED_L2", "effectiveDate": "2022-01-01"},
+                {"status": "FIDO_CERTIFIED", "effectiveDate": "2020-01-01"},
+            ],
+            "timeOfLastStatusChange": "2022-01-01",
+        },
+        # U2F, no AAGUID
+        {"attestationCertificateKeyIdentifiers": ["abcd"], "statusReports": [], "timeOfLastStatusChange": "2022-01-01"},
+    ],
+}
+
+
+def make_blob(private_key=None):
+    message = ".".join(websafe_encode(json.dumps(part).encode()) for part in ({"alg": "ES256"}, PAYLOAD)).encode()
+    signature = private_key.sign(message, ec.ECDSA(hashes.SHA256())) if private_key else b"\0"
+    return message + b"." + websafe_encode(signature).encode()
+
+
+def make_root(private_key):
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "Test Root")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(private_key.public_key())
+        .serial_number(1)
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(private_key, hashes.SHA256())
+    )
+
+
+class IndexTests(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, "metadata.pickle")
+        metadata.load_index.cache_clear()
+        self.addCleanup(metadata.load_index.cache_clear)
+
+    def test_build_index(self):
+        with self.assertLogs("fido2.mds3", "WARNING"):
+            index = metadata.build_index(make_blob())
+
+        self.assertEqual(index["authenticators"], {bytes(AAGUID): ("Test Key 5", "FIDO_CERTIFIED_L2")})
+        self.assertEqual(index["no"], 42)
+
+    def test_lookup(self):
+        with self.assertLogs("fido2.mds3", "WARNING"):
+            metadata.write_index(metadata.build_index(make_blob()), self.path)
+
+        with override_settings(MULTIFACTOR={"FIDO_METADATA_INDEX": self.path}):
+            self.assertEqual(metadata.lookup(AAGUID), ("Test Key 5", "FIDO_CERTIFIED_L2"))
+            self.assertIsNone(metadata.lookup(Aaguid.NONE))
+            # read once per process
+            os.unlink(self.path)
+            self.assertEqual(metadata.lookup(AAGUID), ("Test Key 5", "FIDO_CERTIFIED_L2"))
+
+    def test_off_or_missing(self):
+        self.assertIsNone(metadata.lookup(AAGUID))
+
+        with override_settings(MULTIFACTOR={"FIDO_METADATA_INDEX": self.path}):
+            with self.assertLogs("multifactor.metadata", "WARNING"):
+                self.assertIsNone(metadata.lookup(AAGUID))
+
+    def test_old_indexes_are_ignored(self):
+        metadata.write_index({"version": 0, "authenticators": {bytes(AAGUID): ("Old", None)}}, self.path)
+
+        with override_settings(MULTIFACTOR={"FIDO_METADATA_INDEX": self.path}):
+            with self.assertLogs("multifactor.metadata", "WARNING"):
+                self.assertIsNone(metadata.lookup(AAGUID))
+
+
+class CommandTests(SimpleTestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.path = os.path.join(self.dir.name, "metadata.pickle")
+        self.private_key = ec.generate_private_key(ec.SECP256R1())
+        self.addCleanup(metadata.load_index.cache_clear)
+
+    def _file(self, name, content):
+        path = os.path.join(self.dir.name, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def test_verifies_with_the_trust_root(self):
+        blob = self._file("blob.jwt", make_blob(self.private_key))
+        root = self._file("root.pem", make_root(self.private_key).public_bytes(Encoding.PEM))
+        out = StringIO()
+
+        with override_settings(MULTIFACTOR={"FIDO_METADATA_INDEX": self.path}):
+            call_command("load_fido_metadata", blob, trust_root=root, stdout=out)
+            self.assertEqual(metadata.lookup(AAGUID), ("Test Key 5", "FIDO_CERTIFIED_L2"))
+
+        self.assertIn("1 authenticators from blob 42", out.getvalue())
+
+    def test_rejects_a_bad_signature(self):
+        blob = self._file("blob.jwt", make_blob(ec.generate_private_key(ec.SECP256R1())))
+        root = self._file("root.der", make_root(self.private_key).public_bytes(Encoding.DER))
+
+        with self.assertRaises(CommandError):
+            call_command("load_fido_metadata", blob, trust_root=root, output=self.path)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_needs_somewhere_to_write(self):
+        with self.assertRaisesMessage(CommandError, "FIDO_METADATA_INDEX"):
+            call_command("load_fido_metadata", self._file("blob.jwt", make_blob()))
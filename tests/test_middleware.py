@@ -0,0 +1,128 @@
+from django.contrib.auth import get_user_model
+from django.contrib.messages.storage.fallback import FallbackStorage
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+from django.urls import resolve
+
+from multifactor.middleware import MultifactorMiddleware, RuleMatcher
+
+
+class RuleMatcherTests(SimpleTestCase):
+    def test_prefix_regex_and_view_rules(self):
+        rules = RuleMatcher(
+            [
+                {"prefix": "/billing/", "factors": 1},
+                {"regex": r"/accounts/\d+/delete/$", "max_age": 60},
+                {"view": "admin:index", "factors": 2},
+            ]
+        )
+
+        self.assertEqual(rules.match("/billing/invoices/"), {"factors": 1})
+        self.assertEqual(rules.match("/accounts/12/delete/"), {"max_age": 60})
+        self.assertIsNone(rules.match("/accounts/12/"))
+        self.assertEqual(rules.match("/admin/", "admin:index"), {"factors": 2})
+        self.assertIsNone(rules.match("/static/app.css"))
+
+    def test_first_listed_rule_wins(self):
+        rules = RuleMatcher(
+            [
+                {"view": "admin:index", "factors": 2},
+                {"prefix": "/", "factors": 1},
+            ]
+        )
+
+        self.assertEqual(rules.match("/admin/", "admin:index"), {"factors": 2})
+        self.assertEqual(rules.match("/other/"), {"factors": 1})
+
+    def test_regex_named_groups_do_not_confuse_matching(self):
+        rules = RuleMatcher([{"prefix": "/a/"}, {"regex": r"/b/(?P<pk>\d+)/", "factors": 1}])
+
+        self.assertEqual(rules.match("/b/1/"), {"factors": 1})
+
+    def test_regexes_mean_what_they_do_alone(self):
+        rules = RuleMatcher(
+            [
+                {"prefix": "/x/"},
+                {"regex": r"/(a|b)/\1/", "factors": 1},
+                {"regex": r"(?i)/admin/", "factors": 2},
+                {"regex": r"/users/(?P<pk>\d+)/", "factors": 3},
+                {"regex": r"/groups/(?P<pk>\d+)/", "factors": 4},
+            ]
+        )
+
+        self.assertEqual(rules.match("/a/a/"), {"factors": 1})
+        self.assertIsNone(rules.match("/a/b/"))
+        self.assertEqual(rules.match("/ADMIN/"), {"factors": 2})
+        self.assertEqual(rules.match("/users/1/"), {"factors": 3})
+        self.assertEqual(rules.match("/groups/1/"), {"factors": 4})
+
+    def test_regex_listed_before_a_prefix_wins(self):
+        rules = RuleMatcher([{"regex": r"/a/\d+/", "factors": 2}, {"prefix": "/", "factors": 1}])
+
+        self.assertEqual(rules.match("/a/1/"), {"factors": 2})
+        self.assertEqual(rules.match("/a/b/"), {"factors": 1})
+
+    def test_invalid_rules_raise(self):
+        for rule in ({"factors": 1}, {"prefix": "/", "view": "x"}, {"prefix": "/", "colour": "red"}, {"regex": "("}):
+            with self.assertRaises(ImproperlyConfigured):
+                RuleMatcher([rule])
+
+
+class MultifactorMiddlewareTests(TestCase):
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.user = get_user_model().objects.create_user(
+            username="alice",
+            email="alice@example.com",
+            password="password123",
+        )
+
+    def _middleware(self, rules):
+        with override_settings(MULTIFACTOR={"RULES": rules}):
+            return MultifactorMiddleware(lambda request: HttpResponse("ok"))
+
+    def _process(self, middleware, request):
+        request.resolver_match = resolve(request.path_info)
+        return middleware.process_view(request, request.resolver_match.func, (), {})
+
+    def test_unmatched_path_touches_nothing(self):
+        middleware = self._middleware([{"prefix": "/admin/", "factors": 1}])
+        request = self.factory.get("/admin/multifactor/help/")
+        request.path_info = "/elsewhere/"
+        request.resolver_match = None
+
+        with self.assertNumQueries(0):
+            self.assertIsNone(middleware.process_view(request, None, (), {}))
+
+        self.assertFalse(hasattr(request, "user"))
+        self.assertFalse(hasattr(request, "session"))
+
+    def test_matched_path_applies_policy(self):
+        middleware = self._middleware([{"prefix": "/admin/", "factors": 1}])
+        request = self.factory.get("/admin/")
+        request.user = self.user
+        request.session = {}
+        request._messages = FallbackStorage(request)
+
+        response = self._process(middleware, request)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response["Location"], "/admin/multifactor/authenticate/")
+        self.assertEqual(request.session["multifactor-next"], "/admin/")
+
+    def test_own_views_are_never_gated(self):
+        middleware = self._middleware([{"prefix": "/", "factors": 1}])
+        request = self.factory.get("/admin/multifactor/authenticate/")
+        request.user = self.user
+        request.session = {}
+
+        self.assertIsNone(self._process(middleware, request))
+
+    def test_satisfied_policy_passes(self):
+        middleware = self._middleware([{"view": "admin:index", "factors": 1}])
+        request = self.factory.get("/admin/")
+        request.user = self.user
+        request.session = {"multifactor": [("TOTP", 1, 0, False)]}
+
+        self.assertIsNone(self._process(middleware, request))
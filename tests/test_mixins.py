@@ -1,15 +1,19 @@
 from unittest.mock import patch
 
 from django.contrib.auth import get_user_model
+from django.contrib.sessions.backends.db import SessionStore
 from django.http import HttpResponse
-from django.test import RequestFactory, TestCase
+from django.test import AsyncRequestFactory, RequestFactory, TestCase
 from django.views import View
 
 from multifactor.mixins import (
+    AsyncPreferMultiAuthMixin,
+    AsyncRequireMultiAuthMixin,
     MultiFactorMixin,
     PreferMultiAuthMixin,
     RequireMultiAuthMixin,
 )
+from multifactor.models import KeyTypes, UserKey
 
 
 class MultiFactorMixinTests(TestCase):
@@ -21,8 +25,8 @@ class MultiFactorMixinTests(TestCase):
             password="password123",
         )
 
-    @patch("multifactor.mixins.active_factors", return_value=[])
-    @patch("multifactor.mixins.is_bypassed", return_value=False)
+    @patch("multifactor.common.active_factors", return_value=[])
+    @patch("multifactor.common.is_bypassed", return_value=False)
     def test_setup_populates_state_for_authenticated_user(self, is_bypassed, active_factors):
         request = self.factory.get("/")
         request.user = self.user
@@ -39,8 +43,8 @@ class MultiFactorMixinTests(TestCase):
         self.assertFalse(view.has_multifactor)
         self.assertFalse(view.bypass)
 
-    @patch("multifactor.mixins.active_factors")
-    @patch("multifactor.mixins.is_bypassed")
+    @patch("multifactor.common.active_factors")
+    @patch("multifactor.common.is_bypassed")
     def test_setup_skips_unauthenticated_user(self, is_bypassed, active_factors):
         request = self.factory.get("/")
         request.user = type("Anon", (), {"is_authenticated": False})()
@@ -55,8 +59,8 @@ class MultiFactorMixinTests(TestCase):
         self.assertFalse(hasattr(view, "active_factors"))
         self.assertFalse(hasattr(view, "has_multifactor"))
 
-    @patch("multifactor.mixins.active_factors", return_value=[])
-    @patch("multifactor.mixins.is_bypassed", return_value=False)
+    @patch("multifactor.common.active_factors", return_value=[])
+    @patch("multifactor.common.is_bypassed", return_value=False)
     def test_require_multi_auth_redirects_to_add_when_no_keys(self, is_bypassed, active_factors):
         request = self.factory.get("/protected/")
         request.user = self.user
@@ -70,8 +74,8 @@ class MultiFactorMixinTests(TestCase):
         self.assertEqual(response.status_code, 302)
         self.assertEqual(response["Location"], "/admin/multifactor/add/")
 
-    @patch("multifactor.mixins.active_factors", return_value=[])
-    @patch("multifactor.mixins.is_bypassed", return_value=False)
+    @patch("multifactor.common.active_factors", return_value=[])
+    @patch("multifactor.common.is_bypassed", return_value=False)
     def test_prefer_multi_auth_redirects_to_authenticate_when_has_keys(self, is_bypassed, active_factors):
         request = self.factory.get("/protected/")
         request.user = self.user
@@ -81,15 +85,14 @@ class MultiFactorMixinTests(TestCase):
             def get(self, request, *args, **kwargs):
                 return HttpResponse("ok")
 
-        with patch("multifactor.mixins.UserKey.objects.filter") as filter_mock:
-            filter_mock.return_value.filter.return_value.exists.return_value = True
+        with patch("multifactor.common.has_multifactor", return_value=True):
             response = DummyView.as_view()(request)
 
         self.assertEqual(response.status_code, 302)
         self.assertEqual(response["Location"], "/admin/multifactor/authenticate/")
 
-    @patch("multifactor.mixins.active_factors", return_value=[("k1", "TOTP")])
-    @patch("multifactor.mixins.is_bypassed", return_value=False)
+    @patch("multifactor.common.active_factors", return_value=[("k1", "TOTP")])
+    @patch("multifactor.common.is_bypassed", return_value=False)
     def test_require_multi_auth_allows_when_active(self, is_bypassed, active_factors):
         request = self.factory.get("/protected/")
         request.user = self.user
@@ -99,8 +102,69 @@ class MultiFactorMixinTests(TestCase):
             def get(self, request, *args, **kwargs):
                 return HttpResponse("ok")
 
-        with patch("multifactor.mixins.UserKey.objects.filter") as filter_mock:
-            filter_mock.return_value.filter.return_value.exists.return_value = True
+        with patch("multifactor.common.has_multifactor", return_value=True):
             response = DummyView.as_view()(request)
 
         self.assertEqual(response.status_code, 200)
+
+
+class AsyncMixinTests(TestCase):
+    def setUp(self):
+        self.factory = AsyncRequestFactory()
+        self.user = get_user_model().objects.create_user(
+            username="alice",
+            email="alice@example.com",
+            password="password123",
+        )
+
+    def _request(self, path="/protected/"):
+        request = self.factory.get(path)
+        request.user = self.user
+        request.session = SessionStore()
+        return request
+
+    async def test_require_multi_auth_redirects_to_add_when_no_keys(self):
+        class DummyView(AsyncRequireMultiAuthMixin, View):
+            async def get(self, request, *args, **kwargs):
+                return HttpResponse("ok")
+
+        request = self._request()
+        response = await DummyView.as_view()(request)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response["Location"], "/admin/multifactor/add/")
+        self.assertEqual(await request.session.aget("multifactor-next"), "/protected/")
+
+    async def test_prefer_multi_auth_redirects_to_authenticate_when_has_keys(self):
+        await UserKey.objects.acreate(user=self.user, key_type=KeyTypes.TOTP, properties={})
+
+        class DummyView(AsyncPreferMultiAuthMixin, View):
+            async def get(self, request, *args, **kwargs):
+                return HttpResponse("ok")
+
+        response = await DummyView.as_view()(self._request())
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response["Location"], "/admin/multifactor/authenticate/")
+
+    async def test_prefer_multi_auth_allows_user_without_keys(self):
+        class DummyView(AsyncPreferMultiAuthMixin, View):
+            async def get(self, request, *args, **kwargs):
+                return HttpResponse("ok")
+
+        response = await DummyView.as_view()(self._request())
+
+        self.assertEqual(response.status_code, 200)
+
+    async def test_require_multi_auth_allows_when_active(self):
+        class DummyView(AsyncRequireMultiAuthMixin, View):
+            async def get(self, request, *args, **kwargs):
+                self.seen = (self.active_factors, self.has_multifactor, self.bypass)
+                return HttpResponse("ok")
+
+        request = self._request()
+        await request.session.aset("multifactor", [("TOTP", 1, 0, False)])
+
+        response = await DummyView.as_view()(request)
+
+        self.assertEqual(response.status_code, 200)
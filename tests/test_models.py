@@ -1,9 +1,14 @@
+from io import StringIO
 from unittest.mock import patch
 
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
 
-from multifactor.models import DisabledFallback, KeyTypes, UserKey
+from multifactor.models import DisabledFallback, KeyTypes, UserKey, UserStatus
 
 
 class UserKeyModelTests(TestCase):
@@ -70,6 +75,16 @@ class UserKeyModelTests(TestCase):
 
         self.assertEqual(key.device, "YubiKey")
 
+    def test_device_prefers_the_model(self):
+        key = UserKey(
+            user=self.user,
+            key_type=KeyTypes.FIDO2,
+            properties={"type": "public-key", "model": "YubiKey 5", "certification": "FIDO_CERTIFIED_L1"},
+        )
+
+        self.assertEqual(key.device, "YubiKey 5")
+        self.assertEqual(key.certification, "FIDO_CERTIFIED_L1")
+
     def test_device_returns_default_for_fido2_when_type_missing(self):
         key = UserKey(
             user=self.user,
@@ -109,3 +124,95 @@ class UserKeyModelTests(TestCase):
 
         self.assertEqual(fallback.user, self.user)
         self.assertEqual(fallback.fallback, "email")
+
+
+@override_settings(MULTIFACTOR={"STATUS_TABLE": True})
+class UserStatusTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username="alice",
+            email="alice@example.com",
+            password="password123",
+        )
+
+    def _status(self):
+        return UserStatus.objects.get(user=self.user)
+
+    def test_kept_in_sync_with_keys(self):
+        totp = UserKey.objects.create(user=self.user, key_type=KeyTypes.TOTP, properties={})
+        self.assertEqual(self._status().enabled_count, 1)
+        self.assertEqual(self._status().enabled_types, [KeyTypes.TOTP])
+
+        UserKey.objects.create(user=self.user, key_type=KeyTypes.FIDO2, properties={}, enabled=False)
+        self.assertEqual(self._status().enabled_count, 1)
+        self.assertEqual(self._status().key_types, 2)
+
+        UserKey.objects.filter(user=self.user).update(enabled=True)
+        self.assertEqual(self._status().enabled_count, 2)
+        self.assertEqual(self._status().enabled_types, [KeyTypes.FIDO2, KeyTypes.TOTP])
+
+        totp.last_used = timezone.now()
+        totp.save()
+        self.assertEqual(self._status().last_used, totp.last_used)
+
+        UserKey.objects.filter(user=self.user).delete()
+        self.assertEqual(self._status().enabled_count, 0)
+        self.assertEqual(self._status().enabled_types, [])
+        self.assertIsNone(self._status().last_used)
+
+    def test_added_for_new_users(self):
+        self.assertEqual(self._status().enabled_count, 0)
+
+        with override_settings(MULTIFACTOR={}):
+            bob = get_user_model().objects.create_user(username="bob")
+        self.assertFalse(UserStatus.objects.filter(user=bob).exists())
+
+    def test_not_maintained_when_off(self):
+        with override_settings(MULTIFACTOR={}):
+            UserKey.objects.create(user=self.user, key_type=KeyTypes.TOTP, properties={})
+
+        self.assertEqual(self._status().enabled_count, 0)
+
+    def test_rebuild_command(self):
+        with override_settings(MULTIFACTOR={}):
+            UserKey.objects.create(user=self.user, key_type=KeyTypes.TOTP, properties={})
+            carol = get_user_model().objects.create_user(username="carol")
+        bob = get_user_model().objects.create_user(username="bob")
+        UserStatus.objects.filter(user=bob).update(enabled_count=3)
+
+        out = StringIO()
+        call_command("rebuild_multifactor_status", stdout=out)
+
+        self.assertEqual(self._status().enabled_count, 1)
+        self.assertEqual(UserStatus.objects.get(user=bob).enabled_count, 0)
+        self.assertEqual(UserStatus.objects.get(user=carol).enabled_count, 0)
+        self.assertIn("1 of 3 users", out.getvalue())
+
+    def test_rebuild_updates_rows_in_place(self):
+        UserKey.objects.create(user=self.user, key_type=KeyTypes.TOTP, properties={})
+
+        # deleting and reinserting would let two concurrent rebuilds insert the same user
+        with CaptureQueriesContext(connection) as queries:
+            UserStatus.objects.rebuild([self.user.pk])
+
+        self.assertEqual(self._status().enabled_count, 1)
+        self.assertFalse([q for q in queries if q["sql"].startswith("INSERT") and "ON CONFLICT" not in q["sql"]])
+        self.assertFalse([q for q in queries if q["sql"].startswith("DELETE")])
+
+    def test_rebuild_only_reads_the_users_keys(self):
+        UserKey.objects.create(user=self.user, key_type=KeyTypes.TOTP, properties={})
+
+        with CaptureQueriesContext(connection) as queries:
+            UserStatus.objects.rebuild([self.user.pk])
+
+        # every read of the key table, subqueries included, is limited to the user
+        for query in queries:
+            for part in query["sql"].split('FROM "multifactor_userkey"')[1:]:
+                self.assertRegex(part, rf"^( U0)? WHERE \S+ IN \({self.user.pk}\)")
+
+    def test_user_deletion(self):
+        UserKey.objects.create(user=self.user, key_type=KeyTypes.TOTP, properties={})
+
+        self.user.delete()
+
+        self.assertFalse(UserStatus.objects.exists())
@@ -0,0 +1,67 @@
+import base64
+import json
+
+from django.test import SimpleTestCase, override_settings
+
+from multifactor.session import RECORD, Factor, dump, get_factors, load, set_factors
+
+FACTORS = [
+    Factor("FIDO2", 42, 1717450000, 1717470000),
+    Factor("TOTP", 17, 1717450005, False),
+    Factor(None, None, 1717450010, 1717471234),
+]
+
+
+class SessionEncodingTests(SimpleTestCase):
+    def test_legacy_list_is_read(self):
+        stored = [["FIDO2", 42, 1717450000.5, 1717470000.0], ["TOTP", 17, 1717450005.0, False]]
+
+        factors = load(stored)
+
+        self.assertEqual(factors, [("FIDO2", 42, 1717450000.5, 1717470000.0), ("TOTP", 17, 1717450005.0, False)])
+        self.assertEqual(factors[0].key_id, 42)
+
+    def test_empty(self):
+        self.assertEqual(load(None), [])
+        self.assertEqual(load([]), [])
+        self.assertEqual(load(""), [])
+
+    def test_legacy_encoding_by_default(self):
+        self.assertEqual(dump(FACTORS), [tuple(f) for f in FACTORS])
+
+    @override_settings(MULTIFACTOR={"COMPACT_SESSION": True})
+    def test_compact_round_trip(self):
+        stored = dump(FACTORS)
+
+        self.assertIsInstance(stored, str)
+        self.assertTrue(stored.startswith("1:"))
+        self.assertEqual(load(stored), FACTORS)
+
+    @override_settings(MULTIFACTOR={"COMPACT_SESSION": True})
+    def test_compact_truncates_to_whole_seconds(self):
+        self.assertEqual(load(dump([Factor("TOTP", 1, 100.9, 200.2)])), [("TOTP", 1, 100, 200)])
+
+    @override_settings(MULTIFACTOR={"COMPACT_SESSION": True})
+    def test_compact_is_smaller(self):
+        legacy = [("FIDO2", 42, 1717450000.123456, 1717470000.654321), ("TOTP", 17, 1717450005.123456, False)]
+
+        self.assertLess(len(json.dumps(dump(load(legacy)))), len(json.dumps(legacy)) / 2)
+
+    def test_unreadable_values_mean_no_factors(self):
+        for value in ["2:AAAA", "1:!!!", "1:AAAA", "nonsense"]:
+            with self.subTest(value=value):
+                self.assertEqual(load(value), [])
+
+    def test_unknown_key_type_code(self):
+        payload = base64.urlsafe_b64encode(RECORD.pack(9, 1, 100, 0)).decode()
+
+        self.assertEqual(load(f"1:{payload}"), [])
+
+    @override_settings(MULTIFACTOR={"COMPACT_SESSION": True})
+    def test_session_helpers(self):
+        session = {"multifactor": [("TOTP", 1, 100.0, False)]}
+
+        set_factors(session, get_factors(session))
+
+        self.assertIsInstance(session["multifactor"], str)
+        self.assertEqual(get_factors(session), [("TOTP", 1, 100, False)])
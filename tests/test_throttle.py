@@ -0,0 +1,95 @@
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase, override_settings
+
+from multifactor import throttle
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    MULTIFACTOR={"THROTTLE": {"TOTP": (3, 60)}, "THROTTLE_MAX_LOCKOUT": 200},
+)
+@patch("multifactor.throttle.time.time", return_value=6000.0)
+class ThrottleTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(username="alice")
+        self.request = self._request(self.user, "10.0.0.1")
+
+    def _request(self, user, ip):
+        request = RequestFactory().post("/", REMOTE_ADDR=ip)
+        request.user = user
+        return request
+
+    def _fail(self, times, request=None):
+        for _ in range(times):
+            wait = throttle.record(request or self.request, "TOTP")
+        return wait
+
+    def test_locks_out_at_the_limit(self, now):
+        self.assertEqual(self._fail(2), 0)
+        self.assertEqual(throttle.check(self.request, "TOTP"), 0)
+
+        self.assertEqual(self._fail(1), 60)
+        self.assertEqual(throttle.check(self.request, "TOTP"), 60)
+
+        now.return_value += 45
+        self.assertEqual(throttle.check(self.request, "TOTP"), 15)
+
+    def test_lockouts_double_up_to_the_maximum(self, now):
+        waits = []
+        for _ in range(4):
+            waits.append(self._fail(3))
+            now.return_value += waits[-1]
+
+        self.assertEqual(waits, [60, 120, 200, 200])
+
+    def test_window_slides(self, now):
+        self._fail(2)
+        # halfway into the next bucket, the two old failures count as one
+        now.return_value += 90
+        self.assertEqual(self._fail(1), 0)
+        self.assertEqual(self._fail(1), 60)
+
+    def test_old_failures_expire(self, now):
+        self._fail(2)
+        now.return_value += 120
+        self.assertEqual(self._fail(2), 0)
+
+    def test_counts_per_user_and_per_ip(self, now):
+        other_user = self._request(get_user_model().objects.create_user(username="bob"), "10.0.0.1")
+        other_ip = self._request(self.user, "10.0.0.2")
+        stranger = self._request(get_user_model().objects.create_user(username="carol"), "10.0.0.3")
+
+        self._fail(3)
+
+        self.assertTrue(throttle.check(other_user, "TOTP"))
+        self.assertTrue(throttle.check(other_ip, "TOTP"))
+        self.assertEqual(throttle.check(stranger, "TOTP"), 0)
+
+    def test_success_clears_the_users_failures(self, now):
+        self._fail(2)
+        throttle.clear(self.request, "TOTP")
+
+        self.assertEqual(self._fail(1, self._request(self.user, "10.0.0.2")), 0)
+        # the IP's count is kept
+        self.assertEqual(
+            self._fail(1, self._request(get_user_model().objects.create_user(username="bob"), "10.0.0.1")), 60
+        )
+
+    def test_unthrottled_factors_cost_nothing(self, now):
+        with self.assertNumQueries(0), patch.object(throttle, "shared_cache") as get_cache:
+            self.assertEqual(throttle.check(self.request, "FIDO2"), 0)
+            self.assertEqual(throttle.record(self.request, "FIDO2"), 0)
+            throttle.clear(self.request, "FIDO2")
+
+        get_cache.assert_not_called()
+
+    def test_anonymous_requests_are_counted_per_ip(self, now):
+        self._fail(3, self._request(AnonymousUser(), "10.0.0.9"))
+
+        self.assertTrue(throttle.check(self._request(AnonymousUser(), "10.0.0.9"), "TOTP"))
+        self.assertEqual(throttle.check(self._request(AnonymousUser(), "10.0.0.8"), "TOTP"), 0)
@@ -0,0 +1,102 @@
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from multifactor.common import auser_matches, match_user_locally, user_matches
+
+
+class MatchUserLocallyTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user(
+            username="alice",
+            email="alice@example.com",
+            password="password123",
+            is_staff=True,
+        )
+
+    def test_simple_lookups(self):
+        self.assertTrue(match_user_locally(self.user, {"is_staff": True}))
+        self.assertFalse(match_user_locally(self.user, {"is_superuser": True}))
+        self.assertTrue(match_user_locally(self.user, {"username__in": ["alice", "bob"]}))
+        self.assertTrue(match_user_locally(self.user, {"email__iexact": "ALICE@example.com"}))
+        self.assertTrue(match_user_locally(self.user, {"last_login__isnull": True}))
+        self.assertTrue(match_user_locally(self.user, {"pk__gte": self.user.pk}))
+
+    def test_values_are_converted_like_the_orm(self):
+        self.assertTrue(match_user_locally(self.user, {"id": str(self.user.pk)}))
+        self.assertTrue(match_user_locally(self.user, {"id__in": [str(self.user.pk), "0"]}))
+        self.assertFalse(match_user_locally(self.user, {"pk": "0"}))
+        self.assertTrue(match_user_locally(self.user, {"is_staff": "1"}))
+
+    def test_unconvertible_values_fall_back_to_database(self):
+        self.assertIsNone(match_user_locally(self.user, {"id": "alice"}))
+        with self.assertNumQueries(1):
+            self.assertTrue(user_matches(self.user, {"date_joined__gte": "2000-01-01"}, local=True))
+
+    def test_unsupported_lookups_return_none(self):
+        self.assertIsNone(match_user_locally(self.user, {"groups__name": "staff"}))
+        self.assertIsNone(match_user_locally(self.user, {"username__startswith": "a"}))
+        self.assertIsNone(match_user_locally(self.user, {"nonsense": 1}))
+
+    def test_local_match_costs_no_queries(self):
+        with self.assertNumQueries(0):
+            self.assertTrue(user_matches(self.user, {"is_staff": True}, local=True))
+
+    def test_local_falls_back_to_database(self):
+        with self.assertNumQueries(1):
+            self.assertFalse(user_matches(self.user, {"groups__name": "staff"}, local=True))
+
+
+@override_settings(
+    CACHES={"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}},
+    MULTIFACTOR={"CACHE": "default"},
+)
+class CachedUserFilterTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = get_user_model().objects.create_user(
+            username="alice",
+            email="alice@example.com",
+            password="password123",
+        )
+
+    def test_decision_is_cached_per_filter(self):
+        self.assertFalse(user_matches(self.user, {"is_staff": True}, cache_timeout=60))
+        self.assertTrue(user_matches(self.user, {"is_active": True}, cache_timeout=60))
+
+        with self.assertNumQueries(0):
+            self.assertFalse(user_matches(self.user, {"is_staff": True}, cache_timeout=60))
+            self.assertTrue(user_matches(self.user, {"is_active": True}, cache_timeout=60))
+
+    def test_no_timeout_means_no_caching(self):
+        user_matches(self.user, {"is_staff": True})
+
+        with self.assertNumQueries(1):
+            user_matches(self.user, {"is_staff": True})
+
+    def test_user_save_invalidates(self):
+        self.assertFalse(user_matches(self.user, {"is_staff": True}, cache_timeout=60))
+
+        self.user.is_staff = True
+        self.user.save()
+
+        self.assertTrue(user_matches(self.user, {"is_staff": True}, cache_timeout=60))
+
+    def test_group_change_invalidates(self):
+        group = Group.objects.create(name="staff")
+        self.assertFalse(user_matches(self.user, {"groups__name": "staff"}, cache_timeout=60))
+
+        group.user_set.add(self.user)
+
+        self.assertTrue(user_matches(self.user, {"groups__name": "staff"}, cache_timeout=60))
+
+    async def test_async_decision_is_cached(self):
+        self.assertFalse(await auser_matches(self.user, {"is_staff": True}, cache_timeout=60))
+
+        with patch("multifactor.common.get_user_model") as gum:
+            self.assertFalse(await auser_matches(self.user, {"is_staff": True}, cache_timeout=60))
+
+        gum.assert_not_called()
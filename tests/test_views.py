@@ -3,7 +3,7 @@ from unittest.mock import patch
 from django.contrib.auth import get_user_model
 from django.contrib.messages.storage.fallback import FallbackStorage
 from django.shortcuts import reverse
-from django.test import RequestFactory, TestCase
+from django.test import RequestFactory, TestCase, override_settings
 from django.utils.html import format_html
 
 from multifactor.models import DisabledFallback, KeyTypes, UserKey
@@ -26,7 +26,7 @@ class ViewTests(TestCase):
         request._messages = FallbackStorage(request)
         return request
 
-    @patch("multifactor.views.disabled_fallbacks", return_value=[])
+    @patch("multifactor.common.disabled_fallbacks", return_value=[])
     @patch("multifactor.views.mf_settings", {"FALLBACKS": {"email": (lambda u: u.email, "x")}})
     def test_list_context_includes_available_fallbacks(self, disabled_fallbacks):
         request = self._request()
@@ -58,7 +58,7 @@ class ViewTests(TestCase):
 
     @patch("multifactor.views.messages")
     def test_get_context_data_triggers_warning_message(self, mocked_messages):
-        with patch("multifactor.mixins.active_factors", return_value=[]):
+        with patch("multifactor.common.active_factors", return_value=[]):
             request = self._request("/admin/multifactor/add/")
             view = List()
             view.request = request
@@ -97,8 +97,8 @@ class ViewTests(TestCase):
             enabled=True,
         )
 
-        with patch("multifactor.mixins.active_factors", return_value=[("k1", "TOTP")]), patch(
-            "multifactor.mixins.is_bypassed", return_value=False
+        with patch("multifactor.common.active_factors", return_value=[("k1", "TOTP")]), patch(
+            "multifactor.common.is_bypassed", return_value=False
         ):
             response = List.as_view()(request)
 
@@ -109,10 +109,9 @@ class ViewTests(TestCase):
         request = self._request()
         request.session["multifactor-next"] = "/go/"
 
-        with patch("multifactor.mixins.active_factors", return_value=[]), patch(
-            "multifactor.mixins.is_bypassed", return_value=False
-        ), patch("multifactor.mixins.UserKey.objects.filter") as filter_mock:
-            filter_mock.return_value.filter.return_value.exists.return_value = False
+        with patch("multifactor.common.active_factors", return_value=[]), patch(
+            "multifactor.common.is_bypassed", return_value=False
+        ), patch("multifactor.common.has_multifactor", return_value=False):
             response = List.as_view()(request)
 
         self.assertEqual(response.status_code, 302)
@@ -212,7 +211,7 @@ class ViewTests(TestCase):
         request = self._request("/admin/multifactor/authenticate/")
         request.user = self.user
 
-        with patch("multifactor.views.disabled_fallbacks", return_value=[]), patch(
+        with patch("multifactor.common.disabled_fallbacks", return_value=[]), patch(
             "multifactor.views.mf_settings", {"FALLBACKS": {}}
         ):
             response = Authenticate.as_view()(request)
@@ -231,7 +230,7 @@ class ViewTests(TestCase):
             enabled=True,
         )
 
-        with patch("multifactor.views.disabled_fallbacks", return_value=[]), patch(
+        with patch("multifactor.common.disabled_fallbacks", return_value=[]), patch(
             "multifactor.views.mf_settings", {"FALLBACKS": {}}
         ):
             response = Authenticate.as_view()(request)
@@ -248,12 +247,36 @@ class ViewTests(TestCase):
             key_type=KeyTypes.FIDO2,
             enabled=True,
             properties={"domain": "other.example.com"},
+            domain="other.example.com",
         )
 
-        with patch("multifactor.views.disabled_fallbacks", return_value=[]), patch(
+        with patch("multifactor.common.disabled_fallbacks", return_value=[]), patch(
             "multifactor.views.mf_settings", {"FALLBACKS": {"email": (lambda u: u.email, "x")}}
         ), patch("multifactor.views.messages.info") as msg_info:
             response = Authenticate.as_view()(request)
 
         self.assertEqual(response.status_code, 200)
         msg_info.assert_called_once()
+
+    @override_settings(
+        ALLOWED_HOSTS=["*"],
+        MULTIFACTOR={
+            "FIDO_SERVERS": {"*.example.org": {"id": "example.org"}},
+            "FALLBACKS": {"console": (lambda user: True, "multifactor.factors.fallback.debug_print_console")},
+        },
+    )
+    @patch("multifactor.common.disabled_fallbacks", return_value=[])
+    def test_authenticate_groups_keys_by_relying_party(self, disabled_fallbacks):
+        request = self.factory.get("/admin/multifactor/authenticate/", HTTP_HOST="shop.example.org")
+        request.user = self.user
+        request.session = {}
+        here, elsewhere = [
+            UserKey.objects.create(user=self.user, key_type=KeyTypes.FIDO2, properties={}, domain=domain)
+            for domain in ["example.org", "example.net"]
+        ]
+
+        with patch("multifactor.views.messages.info") as msg_info:
+            response = Authenticate.as_view()(request)
+
+        self.assertEqual(response.context_data["view"].available_methods, {"FIDO2": [here]})
+        self.assertIn("example.net", str(msg_info.call_args))